@@ -1,13 +1,15 @@
-import asyncio, aiohttp, json, time, logging
+import asyncio, aiohttp, logging
 
 from asyncio import Future, Task
+from functools import partial
 from aiohttp import web
 from os import getenv
 
 from handler.handler_controller import MessageHandler
-from utils import parse_msg_flags
+from utils import MSG_OUTBOX
 
-from utils import VkController
+from utils import VkController, Dispatcher, HttpSessions, LongPoll, LongPollCheckpoint, \
+    CallbackReceiver, SeenSet, backoff_delay
 from utils import Message, LongpollEvent, ChatChangeEvent, CallbackEvent
 from utils import MessageEventData
 
@@ -15,10 +17,11 @@ from utils import MessageEventData
 class Bot:
     __slots__ = (
         "api", "handler", "logger", "logger_file", "loop",
-        "tasks", "sessions", "requests", "settings"
+        "tasks", "settings", "dispatcher", "http", "longpolls", "checkpoint",
+        "callback", "received"
     )
 
-    def __init__(self, settings, logger=None, handler=None, loop=None):
+    def __init__(self, settings, logger=None, handler=None, loop=None, api=None):
         self.settings = settings
 
         if logger:
@@ -33,12 +36,33 @@ class Bot:
 
         self.logger.info("Initializing bot")
 
-        self.requests = []
-        self.sessions = []
         self.tasks = []
+        self.longpolls = []
+        self.callback = None
 
-        self.logger.info("Initializing vk clients")
-        self.api = VkController(settings, logger=self.logger, loop=self.loop)
+        # Ids of last messages from long poll, so messages received both by
+        # long poll and by `recover_long_polling` are processed once
+        self.received = SeenSet(10000)
+
+        self.http = HttpSessions(settings.HTTP_LIMIT, settings.HTTP_LIMIT_PER_HOST,
+            settings.HTTP_TIMEOUT)
+
+        self.dispatcher = Dispatcher(settings.DISPATCHER_TASKS,
+            settings.DISPATCHER_PENDING, logger=self.logger, loop=self.loop)
+
+        # Positions are saved after messages and events before them are processed
+        if settings.LONGPOLL_CHECKPOINT:
+            self.checkpoint = LongPollCheckpoint(settings.LONGPOLL_CHECKPOINT,
+                dispatcher=self.dispatcher, logger=self.logger, loop=self.loop)
+        else:
+            self.checkpoint = None
+
+        if api:
+            self.api = api
+
+        else:
+            self.logger.info("Initializing vk clients")
+            self.api = VkController(settings, logger=self.logger, loop=self.loop)
 
         self.logger.info("Loading plugins")
         if handler:
@@ -84,61 +108,57 @@ class Bot:
 
         return task
 
+    @staticmethod
+    def set_long_polling(pack, result, update=0):
+        if update == 0:
+            pack[1] = result['server']
+            pack[0]['key'] = result['key']
+            pack[0]['ts'] = result['ts']
+
+        elif update == 2:
+            pack[0]['key'] = result['key']
+
+        elif update == 3:
+            pack[0]['key'] = result['key']
+            pack[0]['ts'] = result['ts']
+
     async def init_long_polling(self, pack, update=0):
         result = None
 
-        for _ in range(4):
+        for attempt in range(4):
             result = await self.api(sender=self.api.target_client). \
                 messages.getLongPollServer(use_ssl=1, lp_version=2)
 
             if result:
                 break
 
-            time.sleep(0.5)
+            await asyncio.sleep(backoff_delay(attempt))
 
         if not result:
             self.logger.error("Unable to connect to VK's long polling server.")
             exit()
 
-        if update == 0:
-            pack[1] = "https://" + result['server']
-            pack[0]['key'] = result['key']
-            pack[0]['ts'] = result['ts']
-
-        elif update == 2:
-            pack[0]['key'] = result['key']
+        result['server'] = "https://" + result['server']
 
-        elif update == 3:
-            pack[0]['key'] = result['key']
-            pack[0]['ts'] = result['ts']
+        self.set_long_polling(pack, result, update)
 
     async def init_bots_long_polling(self, pack, update=0):
         result = None
 
-        for _ in range(4):
+        for attempt in range(4):
             result = await self.api(sender=self.api.target_client).\
                 groups.getLongPollServer(group_id=self.api.get_current_id())
 
             if result:
                 break
 
-            time.sleep(0.5)
+            await asyncio.sleep(backoff_delay(attempt))
 
         if not result:
             self.logger.error("Unable to connect to VK's bots long polling server.")
             exit()
 
-        if update == 0:
-            pack[1] = result['server']
-            pack[0]['key'] = result['key']
-            pack[0]['ts'] = result['ts']
-
-        elif update == 2:
-            pack[0]['key'] = result['key']
-
-        elif update == 3:
-            pack[0]['key'] = result['key']
-            pack[0]['ts'] = result['ts']
+        self.set_long_polling(pack, result, update)
 
     async def process_longpoll_event(self, new_event):
         if not new_event:
@@ -151,37 +171,14 @@ class Bot:
 
             return await self.process_event(evnt)
 
-        data = MessageEventData()
-        data.msg_id = new_event[1]
-        data.attaches = new_event[6]
-        data.time = int(new_event[4])
-
-        if 'from' in data.attaches and len(new_event) > 3:
-            data.user_id = int(data.attaches.pop('from'))
-            data.chat_id = int(new_event[3]) - 2000000000
-            data.is_multichat = True
-
-        else:
-            data.user_id = int(new_event[3])
-            data.is_multichat = False
-
-        # https://vk.com/dev/using_longpoll_2
-        flags = parse_msg_flags(new_event[2])
-
-        if flags['outbox']:
-            if not self.settings.READ_OUT:
-                return
-
-            data.is_out = True
-
-        data.full_text = new_event[5].replace('<br>', '\n')
+        # Sent messages are skipped before anything is created
+        if new_event[2] & MSG_OUTBOX and not self.settings.READ_OUT:
+            return
 
-        if "fwd" in data.attaches:
-            data.forwarded = MessageEventData.\
-                parse_brief_forwarded_messages_from_lp(data.attaches.pop("fwd"))
+        if self.is_received(new_event[1]):
+            return
 
-        else:
-            data.forwarded = []
+        data = MessageEventData.from_longpoll(new_event)
 
         msg = Message(self.api, data)
 
@@ -190,176 +187,111 @@ class Bot:
 
         await self.process_message(msg)
 
-    async def longpoll_processor(self):
-        pack = [{'act': 'a_check', 'key': '', 'ts': 0, 'wait': 25, 'mode': 10,
-            'version': 2}, ""]
-
-        await self.init_long_polling(pack)
-
-        session = aiohttp.ClientSession(loop=self.loop)
-        self.sessions.append(session)
-
-        while True:
-            try:
-                requ = session.get(pack[1], params=pack[0])
-            except aiohttp.ClientOSError:
-                await asyncio.sleep(0.5)
-                continue
-
-            self.requests.append(requ)
-
-            try:
-                events = json.loads(await (await requ).text())
+    def is_received(self, message_id):
+        """Returns True if message `message_id` was already received,
+        remembers it otherwise"""
 
-            except aiohttp.ClientOSError:
-                try:
-                    self.sessions.remove(session)
-                except ValueError:
-                    pass
-
-                await asyncio.sleep(0.5)
-
-                session = aiohttp.ClientSession(loop=self.loop)
-                self.sessions.append(session)
-                continue
-
-            except (asyncio.TimeoutError, aiohttp.ServerDisconnectedError):
-                self.logger.warning("Long polling server doesn't respond. Changing server.")
-
-                await asyncio.sleep(0.5)
+        if message_id in self.received:
+            return True
 
-                await self.init_long_polling(pack)
-                continue
+        self.received.add(message_id)
 
-            except ValueError:
-                await asyncio.sleep(0.5)
-                continue
+        return False
 
-            finally:
-                if requ in self.requests:
-                    self.requests.remove(requ)
+    def create_longpoll(self, name, init, process, params, recover=None):
+        """Create `LongPoll` with bot's session. Position of long poll is
+        saved with name `name` (if `LONGPOLL_CHECKPOINT` is set). Statistics
+        of created long polls are available in `longpolls`."""
 
-            failed = events.get('failed')
+        session = self.http.get("longpoll",
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=params['wait'] + 10))
 
-            if failed:
-                err_num = int(failed)
+        if self.checkpoint:
+            position = self.checkpoint.get(name)
+            checkpoint = partial(self.checkpoint.save, name)
+        else:
+            position, checkpoint = None, None
 
-                if err_num == 1:  # 1 - update timestamp
-                    if 'ts' not in events:
-                        await self.init_long_polling(pack)
-                    else:
-                        pack[0]['ts'] = events['ts']
+        longpoll = LongPoll(init, process, params, session, position=position,
+            checkpoint=checkpoint, recover=recover, logger=self.logger, loop=self.loop)
 
-                elif err_num in (2, 3):  # 2, 3 - new data for long polling
-                    await self.init_long_polling(pack, err_num)
+        self.longpolls.append(longpoll)
 
-                continue
+        return longpoll
 
-            pack[0]['ts'] = events['ts']
+    async def longpoll_processor(self):
+        # Mode 42 - attachments (2), extended events (8) and pts (32, for
+        # messages.getLongPollHistory)
+        longpoll = self.create_longpoll(f"user{self.api.get_current_id()}",
+            self.init_long_polling, self.process_longpoll_event,
+            {'wait': 25, 'mode': 42, 'version': 2}, self.recover_long_polling)
 
-            for event in events['updates']:
-                asyncio.ensure_future(self.process_longpoll_event(event))
+        await longpoll.run()
 
     async def bots_longpoll_processor(self):
-        pack = [{'act': 'a_check', 'key': '', 'ts': 0,
-            'wait': 25}, ""]
-
-        await self.init_bots_long_polling(pack)
-
-        session = aiohttp.ClientSession(loop=self.loop)
-        self.sessions.append(session)
-
-        while True:
-            try:
-                requ = session.get(pack[1], params=pack[0])
-            except aiohttp.ClientOSError:
-                await asyncio.sleep(0.5)
-                continue
-
-            self.requests.append(requ)
-
-            try:
-                events = json.loads(await (await requ).text())
-
-            except aiohttp.ClientOSError:
-                try:
-                    self.sessions.remove(session)
-                except ValueError:
-                    pass
-
-                await asyncio.sleep(0.5)
-
-                session = aiohttp.ClientSession(loop=self.loop)
-                self.sessions.append(session)
-                continue
+        longpoll = self.create_longpoll(f"group{self.api.get_current_id()}",
+            self.init_bots_long_polling, self.process_bots_longpoll_event, {'wait': 25})
 
-            except (asyncio.TimeoutError, aiohttp.ServerDisconnectedError):
-                self.logger.warning("Long polling server doesn't respond. Changing server.")
-                await asyncio.sleep(0.5)
+        await longpoll.run()
 
-                await self.init_bots_long_polling(pack)
-                continue
+    async def recover_long_polling(self, position):
+        """Process messages received after `position` (ts and pts of long
+        poll) with messages.getLongPollHistory. Messages are dispatched as
+        usual, but no more than `LONGPOLL_CATCHUP_RATE` per second, so new
+        messages are not delayed. Long polling continues while messages are
+        recovered, so history can contain messages received by long poll:
+        they are skipped (and long poll skips recovered messages)."""
 
-            except ValueError:
-                await asyncio.sleep(0.5)
-                continue
+        params = {'ts': position['ts'], 'lp_version': 2, 'msgs_limit': 200}
 
-            finally:
-                if requ in self.requests:
-                    self.requests.remove(requ)
+        if 'pts' in position:
+            params['pts'] = position['pts']
 
-            failed = events.get('failed')
+        delay = 1 / self.settings.LONGPOLL_CATCHUP_RATE
+        recovered = 0
 
-            if failed:
-                err_num = int(failed)
-
-                if err_num == 1:  # 1 - update timestamp
-                    if 'ts' not in events:
-                        await self.init_bots_long_polling(pack)
-                    else:
-                        pack[0]['ts'] = events['ts']
+        while recovered < self.settings.LONGPOLL_CATCHUP_LIMIT:
+            result = await self.api(sender=self.api.target_client).\
+                messages.getLongPollHistory(**params)
 
-                elif err_num in (2, 3):  # 2, 3 - new data for long polling
-                    await self.init_bots_long_polling(pack, err_num)
+            if not result:
+                self.logger.warning("Unable to receive lost messages.")
+                break
 
-                continue
+            messages = result.get('messages', {}).get('items', ())
 
-            pack[0]['ts'] = events['ts']
+            for message in sorted(messages, key=lambda m: m.get('id', 0)):
+                if "action" in message or (message.get('out') and not self.settings.READ_OUT):
+                    continue
 
-            for event in events['updates']:
-                if "type" not in event or "object" not in event:
+                if self.is_received(message.get('id')):
                     continue
 
-                data_type = event["type"]
-                obj = event["object"]
+                await self.process_bots_longpoll_event({'type': 'message_new',
+                    'object': message})
 
-                if "user_id" in obj:
-                    obj['user_id'] = int(obj['user_id'])
+                recovered += 1
 
-                if data_type == 'message_new':
-                    await self.process_message(
-                        Message(self.api, MessageEventData.from_message_body(obj)))
+                if recovered >= self.settings.LONGPOLL_CATCHUP_LIMIT:
+                    break
 
-                else:
-                    await self.process_event(
-                        CallbackEvent(self.api, data_type, obj))
+                await asyncio.sleep(delay)
 
-    async def callback_processor(self, request):
-        try:
-            data = await request.json()
+            if not result.get('more') or 'new_pts' not in result:
+                break
 
-            if "type" not in data or "object" not in data:
-                raise ValueError("Damaged data received.")
+            params['pts'] = result['new_pts']
 
-        except (UnicodeDecodeError, ValueError):
-            return web.Response(text="ok")
+        self.logger.info(f"Recovered {recovered} lost messages.")
 
-        data_type = data["type"]
+    async def process_bots_longpoll_event(self, event):
+        """Process event `event` from bots long poll or callback api"""
 
-        if data_type == "confirmation":
-            return web.Response(text=self.settings.CONF_CODE)
+        if "type" not in event or "object" not in event:
+            return
 
-        obj = data["object"]
+        data_type = event["type"]
+        obj = event["object"]
 
         if "user_id" in obj:
             obj['user_id'] = int(obj['user_id'])
@@ -372,8 +304,6 @@ class Bot:
             await self.process_event(
                 CallbackEvent(self.api, data_type, obj))
 
-        return web.Response(text="ok")
-
     def longpoll_run(self, custom_process=False):
         task = self.add_task(Task(self.longpoll_processor()))
 
@@ -414,27 +344,34 @@ class Bot:
 
         self.logger.info("Started to process messages")
 
+        self.callback = CallbackReceiver(self.process_bots_longpoll_event,
+            self.settings.CONF_CODE, self.settings.CALLBACK_BUFFER,
+            self.settings.CALLBACK_SEEN, logger=self.logger, loop=self.loop)
+
         try:
             app = web.Application()
-            app.router.add_post('/', self.callback_processor)
+            app.router.add_post('/', self.callback.handle)
 
             runner = web.AppRunner(app)
             self.loop.run_until_complete(runner.setup())
 
-            site = web.TCPSite(runner, host, port)
+            site = web.TCPSite(runner, host, port,
+                reuse_port=self.settings.CALLBACK_REUSE_PORT or None)
             self.loop.run_until_complete(site.start())
 
         except OSError:
             self.logger.error("Address already in use: " + str(host) + ":" + str(port))
             return
 
+        self.add_task(Task(self.callback.run()))
+
         task = self.add_task(Future())
 
         if custom_process:
             return task
 
         print("======== Running on http://{}:{} ========\n"
-              "         (Press CTRL+C to quit)".format(*server.sockets[0].getsockname()))
+              "         (Press CTRL+C to quit)".format(host, port))
 
         try:
             self.loop.run_until_complete(task)
@@ -444,7 +381,7 @@ class Bot:
             self.loop.run_until_complete(self.stop())
 
     async def process_message(self, msg):
-        asyncio.ensure_future(self.handler.process(msg), loop=self.loop)
+        await self.dispatcher.dispatch(msg.peer_id, self.handler.process, msg)
 
     async def check_event(self, user_id, chat_id, attaches):
         if chat_id != 0 and "source_act" in attaches:
@@ -461,7 +398,22 @@ class Bot:
         return False
 
     async def process_event(self, evnt):
-        asyncio.ensure_future(self.handler.process_event(evnt), loop=self.loop)
+        await self.dispatcher.dispatch(self.get_event_peer_id(evnt),
+            self.handler.process_event, evnt)
+
+    @staticmethod
+    def get_event_peer_id(evnt):
+        """Returns peer_id of event `evnt` or None if event has no peer"""
+
+        chat_id = getattr(evnt, "chat_id", 0)
+
+        if chat_id:
+            return chat_id + 2000000000
+
+        if isinstance(evnt, CallbackEvent) and isinstance(evnt.evnt_data, dict):
+            return evnt.evnt_data.get("peer_id") or evnt.evnt_data.get("user_id")
+
+        return getattr(evnt, "user_id", None) or None
 
     def coroutine_exec(self, coroutine):
         if asyncio.iscoroutine(coroutine) or isinstance(coroutine, asyncio.Future):
@@ -480,21 +432,35 @@ class Bot:
 
         self.logger.info("Stopped to process messages")
 
-    async def stop(self):
-        self.logger.info("Attempting to turn bot off")
+    @property
+    def stats(self):
+        """Statistics of dispatcher, long polls and callback receiver"""
 
-        for session in self.sessions:
-            await session.close()
+        return {
+            "dispatcher": self.dispatcher.stats,
+            "longpolls": [longpoll.stats for longpoll in self.longpolls],
+            "callback": self.callback.stats if self.callback else None,
+        }
 
-        await self.handler.stop()
-        await self.api.stop()
+    async def stop(self):
+        self.logger.info("Attempting to turn bot off")
+        self.logger.info(f"Statistics: {self.stats}")
 
+        # Updates are not received while dispatcher is stopped
         for task in self.tasks:
             try:
                 task.cancel()
             except Exception:
                 pass
 
+        await self.dispatcher.stop()
+        await self.handler.stop()
+        await self.api.stop()
+        await self.http.close()
+
+        if self.checkpoint:
+            await self.checkpoint.close()
+
         self.logger.removeHandler(self.logger_file)
         self.logger_file.close()
 
@@ -38,6 +38,12 @@ class BasePlugin:
         self.api = api
         self.handler = handler
 
+    @property
+    def session(self):
+        """Bot's shared `aiohttp.ClientSession` for requests to other services."""
+
+        return self.bot.http.session
+
     def create_executor(self, max_workers=2):
         """Create and sets new executor for this plugin"""
         self.executor = concurrent.futures.ThreadPoolExecutor(
@@ -190,8 +196,9 @@ class CommandPlugin(BasePlugin):
 
         return result
 
-    async def _check_message(self, msg):
-        msg.meta["__reserved"] = False
+    def parse_prefix(self, msg):
+        """Fills message's meta with prefix and text without prefix if it's
+        not done yet. Returns `False` if message has no prefix."""
 
         if msg.meta.get("__no_prefix"):
             return False
@@ -213,6 +220,14 @@ class CommandPlugin(BasePlugin):
                 msg.meta["__no_prefix"] = True
                 return False
 
+        return True
+
+    async def _check_message(self, msg):
+        msg.meta["__reserved"] = False
+
+        if not self.parse_prefix(msg):
+            return False
+
         for command, pattern in zip(self.commands, self.compiled_commands):
             match = pattern.match(msg.meta["__raw_full_text"])
 
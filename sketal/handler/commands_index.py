@@ -0,0 +1,69 @@
+import re
+
+from handler.base_plugin import CommandPlugin
+
+
+FIRST_WORD = re.compile(r"[^ \n]*")
+
+
+def first_word(text):
+    """Returns text's part before first space or new line in lower case."""
+
+    return FIRST_WORD.match(text).group().casefold()
+
+
+class CommandsIndex:
+    """Index of `CommandPlugin`'s commands by their first words. Plugins
+    with their own `check_message` are not indexed and should always be
+    checked."""
+
+    __slots__ = ("indexed", "words", "always")
+
+    def __init__(self, plugins=()):
+        self.indexed = set()
+        self.words = {}
+        self.always = frozenset()
+
+        self.build(plugins)
+
+    @staticmethod
+    def is_indexable(plugin):
+        """Returns `True` if plugin's checks can be replaced with index."""
+
+        if not isinstance(plugin, CommandPlugin):
+            return False
+
+        plugin_class = type(plugin)
+
+        return plugin_class.check_message is CommandPlugin.check_message and \
+            plugin_class._check_message is CommandPlugin._check_message and \
+            plugin_class.parse_prefix is CommandPlugin.parse_prefix
+
+    def build(self, plugins):
+        indexed = set()
+        words = {}
+        always = set()
+
+        for plugin in plugins:
+            if not self.is_indexable(plugin):
+                continue
+
+            indexed.add(plugin)
+
+            for command in plugin.commands:
+                word = first_word(command)
+
+                if word:
+                    words.setdefault(word, set()).add(plugin)
+                else:
+                    always.add(plugin)
+
+        self.indexed = indexed
+        self.always = frozenset(always)
+        self.words = dict((k, frozenset(v | always)) for k, v in words.items())
+
+    def lookup(self, text):
+        """Returns plugins which commands can match text `text` (text
+        without prefix)."""
+
+        return self.words.get(first_word(text), self.always)
@@ -1,8 +1,26 @@
 import traceback
 
+from handler.base_plugin import BasePlugin
+from handler.commands_index import CommandsIndex
 from utils import random_key
 
 
+# Plugin's methods that are skipped for plugins that don't override them and
+# indexes of `order` used to sort plugins for them (None - plugins are called
+# in order they are listed in settings)
+HOOKS = {
+    "global_before_message_checks": 0,
+    "global_after_message_process": -1,
+    "global_before_message": None,
+    "global_after_message": None,
+    "global_before_event_checks": None,
+    "global_after_event_process": None,
+    "global_before_event": None,
+    "global_after_event": None,
+    "check_event": None,
+}
+
+
 class MessageHandler:
     def __init__(self, bot, api, initiate_plugins=True):
         self.bot = bot
@@ -11,10 +29,14 @@ class MessageHandler:
         self.plugins = []
         self.exceptions = []
 
+        self.commands_index = None
+
         for plugin in self.bot.settings.PLUGINS:
             plugin.set_up(self.bot, self.api, self)
             self.plugins.append(plugin)
 
+        self.hooks = self.build_hooks()
+
         if initiate_plugins:
             self.initiate_plugins()
 
@@ -27,11 +49,32 @@ class MessageHandler:
             self.bot.logger.debug(f"Initiate: {plugin.name}")
             plugin.initiate()
 
+        self.commands_index = CommandsIndex(self.plugins)
+        self.hooks = self.build_hooks()
+
+    def build_hooks(self):
+        """Returns dictionary with tuples of plugins that override hooks
+        from `HOOKS` sorted in order they should be called."""
+
+        hooks = {}
+
+        for hook, order_index in HOOKS.items():
+            default = getattr(BasePlugin, hook)
+
+            plugins = [p for p in self.plugins if getattr(type(p), hook, default) is not default]
+
+            if order_index is not None:
+                plugins.sort(key=lambda x: x.order[order_index])
+
+            hooks[hook] = tuple(plugins)
+
+        return hooks
+
     async def process(self, msg):
         try:
             res = await self.core_process(msg)
 
-            for plugin in sorted(self.plugins, key=lambda x: x.order[-1]):
+            for plugin in self.hooks["global_after_message_process"]:
                 if await plugin.global_after_message_process(msg, res) is False:
                     break
 
@@ -49,12 +92,28 @@ class MessageHandler:
             )
 
     async def core_process(self, msg):
-        for plugin in sorted(self.plugins, key=lambda x: x.order[0]):
+        for plugin in self.hooks["global_before_message_checks"]:
             if await plugin.global_before_message_checks(msg) is False:
                 self.bot.logger.debug(f"Message ({msg.msg_id}) cancelled with {plugin.name}")
                 return None
 
+        index = self.commands_index
+
+        candidates = None
+        candidates_text = None
+
         for plugin in self.plugins:
+            if index is not None and plugin in index.indexed and msg.reserved_by is not plugin:
+                if candidates is None or msg.meta.get("__raw_full_text") is not candidates_text:
+                    if not plugin.parse_prefix(msg):
+                        continue
+
+                    candidates_text = msg.meta["__raw_full_text"]
+                    candidates = index.lookup(candidates_text)
+
+                if plugin not in candidates:
+                    continue
+
             if await plugin.check_message(msg):
                 subres = await self.process_with_plugin(msg, plugin)
 
@@ -65,13 +124,13 @@ class MessageHandler:
         self.bot.logger.debug(f"Processed message ({msg.msg_id})")
 
     async def process_with_plugin(self, msg, plugin):
-        for p in self.plugins:
+        for p in self.hooks["global_before_message"]:
             if await p.global_before_message(msg, plugin) is False:
                 return
 
         result = await plugin.process_message(msg)
 
-        for p in self.plugins:
+        for p in self.hooks["global_after_message"]:
             await p.global_after_message(msg, plugin, result)
 
         return result
@@ -79,17 +138,17 @@ class MessageHandler:
     async def process_event(self, evnt):
         res = await self.core_process_event(evnt)
 
-        for plugin in self.plugins:
+        for plugin in self.hooks["global_after_event_process"]:
             if await plugin.global_after_event_process(evnt, res) is False:
                 break
 
     async def core_process_event(self, evnt):
-        for plugin in self.plugins:
+        for plugin in self.hooks["global_before_event_checks"]:
             if await plugin.global_before_event_checks(evnt) is False:
                 self.bot.logger.debug(f"Event {evnt} cancelled with {plugin.name}")
                 return
 
-        for plugin in self.plugins:
+        for plugin in self.hooks["check_event"]:
             if await plugin.check_event(evnt):
                 subres = await self.process_event_with_plugin(evnt, plugin)
 
@@ -100,13 +159,13 @@ class MessageHandler:
         self.bot.logger.debug(f"Processed event ({evnt})")
 
     async def process_event_with_plugin(self, evnt, plugin):
-        for p in self.plugins:
+        for p in self.hooks["global_before_event"]:
             if await p.global_before_event(evnt, plugin) is False:
                 return
 
         result = await plugin.process_event(evnt)
 
-        for p in self.plugins:
+        for p in self.hooks["global_after_event"]:
             await p.global_after_event(evnt, plugin, result)
 
         return result
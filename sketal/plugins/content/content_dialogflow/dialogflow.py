@@ -1,6 +1,5 @@
 from handler.base_plugin import BasePlugin
 
-import aiohttp
 
 
 class DialogflowPlugin(BasePlugin):
@@ -43,9 +42,8 @@ class DialogflowPlugin(BasePlugin):
             "v": self.base_version
         }
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.post(self.base_url, json=body, headers=headers, params=params) as resp:
-                resp_json = await resp.json()
+        async with self.session.post(self.base_url, json=body, headers=headers, params=params) as resp:
+            resp_json = await resp.json()
 
         code = resp_json.get("status", {}).get("code")
         if code != 200:
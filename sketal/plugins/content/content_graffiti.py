@@ -1,7 +1,7 @@
 from handler.base_plugin import CommandPlugin
 from utils import upload_graffiti
 
-import aiohttp, io
+import io
 
 
 class GraffitiPlugin(CommandPlugin):
@@ -29,9 +29,8 @@ class GraffitiPlugin(CommandPlugin):
         if not fgra or not fgra.url:
             return await msg.answer("Пришлите файл для превращения!")
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(fgra.url) as resp:
-                at = await upload_graffiti(self.api, io.BytesIO(await resp.read()), "gra." + (fgra.raw["ext"] if fgra.raw.get("ext") else "png"))
+        async with self.session.get(fgra.url) as resp:
+            at = await upload_graffiti(self.api, io.BytesIO(await resp.read()), "gra." + (fgra.raw["ext"] if fgra.raw.get("ext") else "png"), session=self.session)
 
         if not at:
             return await msg.answer("Не удалось создать граффити!")
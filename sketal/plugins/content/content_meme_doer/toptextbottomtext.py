@@ -3,7 +3,7 @@ from utils import upload_photo
 
 from PIL import Image, ImageDraw, ImageFont
 
-import aiohttp, io
+import io
 
 
 class MemeDoerPlugin(CommandPlugin):
@@ -122,9 +122,8 @@ class MemeDoerPlugin(CommandPlugin):
             img = Image.open(io.BytesIO(self.default_photo))
 
         if not img:
-            async with aiohttp.ClientSession() as sess:
-                async with sess.get(photo.url) as response:
-                    img = Image.open(io.BytesIO(await response.read()))
+            async with self.session.get(photo.url) as response:
+                img = Image.open(io.BytesIO(await response.read()))
 
         if not img:
             return await msg.answer('К сожалению, ваше фото исчезло!')
@@ -134,6 +133,6 @@ class MemeDoerPlugin(CommandPlugin):
         if isinstance(result, str):
             return await msg.answer(result)
 
-        attachment = await upload_photo(self.api, result, msg.user_id)
+        attachment = await upload_photo(self.api, result, msg.user_id, session=self.session)
 
         return await msg.answer(attachment=str(attachment))
@@ -1,5 +1,4 @@
 import io
-import aiohttp
 from PIL import Image
 
 from handler.base_plugin import CommandPlugin
@@ -35,9 +34,8 @@ class MirrorPlugin(CommandPlugin):
             return await msg.answer("Вы не прислали фотографию.")
 
         if not img:
-            async with aiohttp.ClientSession() as sess:
-                async with sess.get(photo.url) as response:
-                    img = Image.open(io.BytesIO(await response.read()))
+            async with self.session.get(photo.url) as response:
+                img = Image.open(io.BytesIO(await response.read()))
 
         if not img:
             return await msg.answer('К сожалению, ваше фото исчезло!')
@@ -51,7 +49,7 @@ class MirrorPlugin(CommandPlugin):
         f = io.BytesIO()
         img.save(f, format='png')
         f.seek(0)
-        attachment = await upload_photo(self.bot.api, f, msg.user_id)
+        attachment = await upload_photo(self.bot.api, f, msg.user_id, session=self.session)
         f.close()
 
         return await msg.answer("Готово", attachment=str(attachment))
@@ -49,6 +49,6 @@ class QRCodePlugin(CommandPlugin):
         img.save(buf, format='png')
         buf.seek(0)
 
-        result = await upload_photo(self.api, buf)
+        result = await upload_photo(self.api, buf, session=self.session)
 
         return await msg.answer(f'Ваш QR код, с данными: \n "{text}"', attachment=str(result))
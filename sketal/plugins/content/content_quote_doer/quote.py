@@ -4,7 +4,7 @@ from utils import traverse, timestamp_to_date
 
 from PIL import Image, ImageDraw, ImageFont
 
-import aiohttp, io
+import io
 
 
 class QuoteDoerPlugin(CommandPlugin):
@@ -123,16 +123,15 @@ class QuoteDoerPlugin(CommandPlugin):
             if i is None:
                 return await msg.answer("Нечего цитировать!")
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(url) as response:
-                img = Image.open(io.BytesIO(await response.read()))
-                img = img.resize((200, 200), Image.NEAREST)
+        async with self.session.get(url) as response:
+            img = Image.open(io.BytesIO(await response.read()))
+            img = img.resize((200, 200), Image.NEAREST)
 
         result = await self.run_in_executor(self.make_image, img, text, name, last_name, timestamp, otext)
 
         if isinstance(result, str):
             return await msg.answer(result)
 
-        attachment = await upload_photo(self.api, result, msg.user_id)
+        attachment = await upload_photo(self.api, result, msg.user_id, session=self.session)
 
         return await msg.answer(attachment=str(attachment))
@@ -1,26 +1,136 @@
 from handler.base_plugin import CommandPlugin
 from utils import parse_user_name
 
-import time
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+import asyncio, heapq, time, traceback
 
 
 class StatisticsPlugin(CommandPlugin):
-    __slots__ = ()
+    __slots__ = ("collection", "pending", "flush_interval", "flusher", "indexed", "migrated")
+
+    def __init__(self, *commands, prefixes=None, strict=False, flush_interval=1):
+        """Stores amount of messages for users in chats. Requires: StoragePlugin.
+
+        With MongoDB statistics is stored in collection `chat_statistics`
+        (document for every user in chat). Counters are accumulated and
+        updated with `$inc` every `flush_interval` seconds. Without MongoDB
+        statistics is stored in chat's data.
 
-    def __init__(self, *commands, prefixes=None, strict=False):
-        """Stores amount of messages for users in chats. Requires: StoragePlugin."""
+        Statistics from chat's data is moved to collection on first message
+        from chat. Chat's data is saved separately from statistics, so if
+        it's discarded (changed by other process at the same time), moved
+        statistics is found in chat's data again. It's ignored for chats
+        already moved by this process, but can be counted twice if chat's
+        data is moved by several processes (or process is restarted before
+        chat's data is saved)."""
 
         if not commands:
             commands = ("статистика",)
 
         super().__init__(*commands, prefixes=prefixes, strict=strict)
 
+        self.collection = None
+        self.pending = {}
+        self.flush_interval = flush_interval
+        self.flusher = None
+        self.indexed = False
+        self.migrated = set()
+
+    def initiate(self):
+        for plugin in self.handler.plugins:
+            if getattr(plugin, "database", None) is not None:
+                self.collection = plugin.database["chat_statistics"]
+
+    async def stop(self):
+        if self.flusher:
+            self.flusher.cancel()
+            self.flusher = None
+
+        await self.flush()
+
+    def count(self, chat_id, user_id, messages, symbols, last_message):
+        """Add messages to user's statistics (it will be saved later)"""
+
+        self.accumulate((chat_id, user_id), messages, symbols, last_message)
+
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush_periodically())
+
+    def accumulate(self, key, messages, symbols, last_message):
+        counters = self.pending.get(key)
+
+        if counters is None:
+            self.pending[key] = [messages, symbols, last_message]
+        else:
+            counters[0] += messages
+            counters[1] += symbols
+            counters[2] = max(counters[2], last_message)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            try:
+                await self.flush()
+            except Exception:
+                self.bot.logger.error("Statistics :: Error while saving statistics:\n" +
+                    traceback.format_exc())
+
+    async def flush(self):
+        """Save accumulated statistics to database"""
+
+        if not self.pending or self.collection is None:
+            return
+
+        if not self.indexed:
+            await self.collection.create_index([("chat_id", ASCENDING),
+                ("user_id", ASCENDING)], unique=True)
+            await self.collection.create_index([("chat_id", ASCENDING),
+                ("messages", DESCENDING), ("last_message", DESCENDING)])
+
+            self.indexed = True
+
+        pending, self.pending = self.pending, {}
+
+        requests = [
+            UpdateOne({"chat_id": chat_id, "user_id": user_id},
+                {"$inc": {"messages": messages, "symbols": symbols},
+                 "$max": {"last_message": last_message}}, upsert=True)
+            for (chat_id, user_id), (messages, symbols, last_message) in pending.items()
+        ]
+
+        try:
+            await self.collection.bulk_write(requests, ordered=False)
+
+        except Exception:
+            for key, counters in pending.items():
+                self.accumulate(key, *counters)
+
+            raise
+
     async def global_before_message_checks(self, msg):
         data = msg.meta["data_chat"]
 
         if not data:
             return
 
+        if self.collection is not None:
+            if "chat_statistics" in data:
+                # Move statistics from chat's data to collection
+                if msg.chat_id not in self.migrated:
+                    for user_key, user in data["chat_statistics"]["users"].items():
+                        self.count(msg.chat_id, int(user_key), user["messages"],
+                            user["symbols"], user["last_message"])
+
+                    self.migrated.add(msg.chat_id)
+
+                del data["chat_statistics"]
+
+            self.count(msg.chat_id, msg.user_id, 1, len(msg.full_text), time.time())
+
+            return
+
         if "chat_statistics" not in data:
             data["chat_statistics"] = {"users": {}}
 
@@ -38,18 +148,35 @@ class StatisticsPlugin(CommandPlugin):
         user["symbols"] += len(msg.full_text)
         user["last_message"] = time.time()
 
+    async def get_top(self, msg, amount=10):
+        """Returns list of pairs (user_id, statistics) of users with most
+        messages in chat"""
+
+        if self.collection is not None:
+            await self.flush()
+
+            cursor = self.collection.find({"chat_id": msg.chat_id}) \
+                .sort([("messages", DESCENDING), ("last_message", DESCENDING)]) \
+                .limit(amount)
+
+            return [(u["user_id"], u) async for u in cursor]
+
+        users = msg.meta["data_chat"].get("chat_statistics", {}).get("users", {})
+
+        return [(int(uid), u) for uid, u in heapq.nlargest(amount, users.items(),
+            key=lambda item: (item[1]["messages"], item[1]["last_message"]))]
+
     async def process_message(self, msg):
         if not msg.meta["data_chat"]:
             return await msg.answer("✋ Статистика в личных сообщениях не учитывается.")
 
-        statistics = sorted(
-            msg.meta["data_chat"]["chat_statistics"]["users"].items(),
-            key=lambda item: (-item[1]["messages"], -item[1]["last_message"])
-        )[:10]
+        statistics = await self.get_top(msg)
+
+        names = await asyncio.gather(*(parse_user_name(uid, msg) for uid, _ in statistics))
 
         result = "👀 Немного статистики:\n"
 
-        for i, pack in enumerate(statistics):
+        for i, (pack, name) in enumerate(zip(statistics, names)):
             uid, u = pack
 
             if uid == self.api.get_current_id():
@@ -57,7 +184,7 @@ class StatisticsPlugin(CommandPlugin):
             else:
                 isbot = ""
 
-            result += f"{i + 1}. {isbot}" + await parse_user_name(uid, msg) + \
+            result += f"{i + 1}. {isbot}" + name + \
                 f" (сообщений: {u['messages']}, символов: {u['symbols']}).\n"
 
         await msg.answer(result)
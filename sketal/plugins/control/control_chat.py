@@ -1,4 +1,7 @@
 from handler.base_plugin import CommandPlugin
+from utils import IndexedList
+
+from collections import OrderedDict
 
 
 class ChatControlPlugin(CommandPlugin):
@@ -27,8 +30,8 @@ class ChatControlPlugin(CommandPlugin):
 
         self.order = (-88, 88)
 
-        self.banned = banned or ()
-        self.cached = []
+        self.banned = IndexedList(banned or ())
+        self.cached = OrderedDict()
 
         self.description = [
             "Администрационные команды для чатов",
@@ -44,10 +47,18 @@ class ChatControlPlugin(CommandPlugin):
 
         if banned is None:
             banned = entity.meta["data_meta"]["admin_lists_banned_chats"] = \
-                list(self.banned)
+                IndexedList(self.banned)
+
+        elif not isinstance(banned, IndexedList):
+            banned = entity.meta["data_meta"]["admin_lists_banned_chats"] = \
+                IndexedList(banned)
 
+        # 20 recent chats
         if entity.chat_id not in self.cached:
-            self.cached = self.cached[-19:] + [entity.chat_id]
+            self.cached[entity.chat_id] = True
+
+            if len(self.cached) > 20:
+                self.cached.popitem(last=False)
 
         return banned
 
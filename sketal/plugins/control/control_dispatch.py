@@ -1,7 +1,7 @@
 from handler.base_plugin import CommandPlugin
 from utils import upload_photo
 
-import asyncio, aiohttp, io
+import asyncio, io
 
 
 class DispatchPlugin(CommandPlugin):
@@ -27,14 +27,13 @@ class DispatchPlugin(CommandPlugin):
                 attachment += str(a) + ","
 
             if a.type == "photo" and a.url:
-                async with aiohttp.ClientSession() as sess:
-                    async with sess.get(a.url) as resp:
-                        new_a = await upload_photo(self.api, io.BytesIO(await resp.read()))
+                async with self.session.get(a.url) as resp:
+                    new_a = await upload_photo(self.api, io.BytesIO(await resp.read()), session=self.session)
 
-                        if not new_a:
-                            continue
+                    if not new_a:
+                        continue
 
-                        attachment += str(new_a) + ","
+                    attachment += str(new_a) + ","
 
         await msg.answer("> Приступаю к рассылке!")
 
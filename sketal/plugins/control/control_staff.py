@@ -1,6 +1,11 @@
+import asyncio
+
 from handler.base_plugin import CommandPlugin, DEFAULTS
 
-from utils import traverse, parse_user_id, parse_user_name
+from utils import traverse, parse_user_id, parse_user_name, IndexedList, ListView
+
+
+NOBODY = ListView(())
 
 
 class StaffControlPlugin(CommandPlugin):
@@ -60,6 +65,15 @@ class StaffControlPlugin(CommandPlugin):
             if hasattr(plugin, "admins"):
                 plugin.admins = self.admins
 
+    @staticmethod
+    async def get_users_list(users, msg):
+        """Returns names and links of users `users`. Names are requested
+        at once, so vk methods are merged into one request."""
+
+        names = await asyncio.gather(*(parse_user_name(m, msg) for m in users))
+
+        return [name + f" vk.com/id{m}" for m, name in zip(users, names)]
+
     async def process_message(self, msg):
         command, text = self.parse_message(msg)
 
@@ -85,10 +99,7 @@ class StaffControlPlugin(CommandPlugin):
                 if not admin_lists["admins"]:
                     return await msg.answer("Никого нет!")
 
-                usrs = []
-
-                for m in admin_lists["admins"]:
-                    usrs.append(await parse_user_name(m, msg) + f" vk.com/id{m}")
+                usrs = await self.get_users_list(admin_lists["admins"], msg)
 
                 return await msg.answer("Администраторы:\n👆 " + "\n👆 ".join(usrs))
 
@@ -96,10 +107,7 @@ class StaffControlPlugin(CommandPlugin):
                 if not moders:
                     return await msg.answer("Никого нет!")
 
-                usrs = []
-
-                for m in moders:
-                    usrs.append(await parse_user_name(m, msg) + f" vk.com/id{m}")
+                usrs = await self.get_users_list(moders, msg)
 
                 return await msg.answer("Модераторы:\n👉 " + "\n👉 ".join(usrs))
 
@@ -107,10 +115,7 @@ class StaffControlPlugin(CommandPlugin):
                 if not admin_lists["banned"]:
                     return await msg.answer("Никого нет!")
 
-                usrs = []
-
-                for m in admin_lists["banned"]:
-                    usrs.append(await parse_user_name(m, msg) + f" vk.com/id{m}")
+                usrs = await self.get_users_list(admin_lists["banned"], msg)
 
                 return await msg.answer("Заблокированные пользователи:\n👺 " +
                     "\n👺 ".join(usrs))
@@ -119,10 +124,7 @@ class StaffControlPlugin(CommandPlugin):
                 if not admin_lists["vips"]:
                     return await msg.answer("Никого нет!")
 
-                usrs = []
-
-                for m in admin_lists["vips"]:
-                    usrs.append(await parse_user_name(m, msg) + f" vk.com/id{m}")
+                usrs = await self.get_users_list(admin_lists["vips"], msg)
 
                 return await msg.answer("Особые пользователя:\n👻 " +
                     "\n👻 ".join(usrs))
@@ -142,10 +144,6 @@ class StaffControlPlugin(CommandPlugin):
 
         target_user_name = await parse_user_name(target_user, msg)
 
-        msg.meta["data_meta"].changed = True
-        if msg.meta["data_chat"]:
-            msg.meta["data_chat"].changed = True
-
         # ------------------------------------------------------------------ #
 
         if command in self.commands_add_to_list:
@@ -279,28 +277,36 @@ class StaffControlPlugin(CommandPlugin):
             admin_lists = msg.meta["data_meta"]["admin_lists"] = \
                 {"banned": [], "admins": list(self.admins), "vips": []}
 
+        # Lists are loaded from database as usual lists
+        for key in ("banned", "admins", "vips"):
+            if not isinstance(admin_lists[key], IndexedList):
+                admin_lists[key] = IndexedList(admin_lists[key])
+
         if msg.user_id in admin_lists["banned"]:
             return False
 
         if msg.meta.get("data_chat") is None:
             msg.meta["is_moder"] = False
-            msg.meta["moders"] = []
+            msg.meta["moders"] = NOBODY
         else:
-            if "moders" not in msg.meta["data_chat"]:
-                msg.meta["data_chat"]["moders"] = []
-
             moders = msg.meta["data_chat"].getraw("moders")
 
+            if moders is None:
+                moders = msg.meta["data_chat"]["moders"] = IndexedList()
+            elif not isinstance(moders, IndexedList):
+                moders = msg.meta["data_chat"]["moders"] = IndexedList(moders)
+
             msg.meta["is_moder"] = msg.user_id in moders
-            msg.meta["moders"] = tuple(moders)
+            msg.meta["moders"] = moders.view()
 
         msg.meta["is_vip"] = msg.user_id in admin_lists["vips"]
         msg.meta["is_admin"] = msg.user_id in admin_lists["admins"]
         msg.meta["is_admin_or_moder"] = msg.meta["is_admin"] or msg.meta["is_moder"]
 
-        msg.meta["vips"] = tuple(admin_lists["vips"])
-        msg.meta["admins"] = tuple(admin_lists["admins"])
-        msg.meta["banned"] = tuple(admin_lists["banned"])
+        # Read-only views instead of copies of lists
+        msg.meta["vips"] = admin_lists["vips"].view()
+        msg.meta["admins"] = admin_lists["admins"].view()
+        msg.meta["banned"] = admin_lists["banned"].view()
 
         msg.meta["get_editable_admins_lists"] = \
             (lambda: msg.meta["data_meta"]["admin_lists"])
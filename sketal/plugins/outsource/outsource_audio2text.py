@@ -78,9 +78,8 @@ class Audio2TextPlugin(CommandPlugin):
 
             for at in ats:
                 if at.type == "doc" and at.raw.get("ext") in SUPPORTED:
-                    async with aiohttp.ClientSession() as sess:
-                        async with sess.get(at.url) as resp:
-                            return await resp.read(), at.raw.get("ext")
+                    async with self.session.get(at.url) as resp:
+                        return await resp.read(), at.raw.get("ext")
 
             return None, None
 
@@ -123,13 +122,12 @@ class Audio2TextPlugin(CommandPlugin):
             '?uuid=%s&key=%s&topic=%s&lang=%s' % (uuid.uuid4().hex, \
                 self.key, 'notes', 'ru-RU')
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.post(url, data=sound_sender(),
-                    headers={"Content-Type": SUPPORTED[exten]}) as resp:
-                response = await resp.text()
+        async with self.session.post(url, data=sound_sender(),
+                headers={"Content-Type": SUPPORTED[exten]}) as resp:
+            response = await resp.text()
 
-                if resp.status != 200:
-                    return await msg.answer("Мне не получилось ничего разобрать или я больше не работаю!")
+            if resp.status != 200:
+                return await msg.answer("Мне не получилось ничего разобрать или я больше не работаю!")
 
         root = ET.fromstring(response)
 
@@ -1,6 +1,6 @@
 from handler.base_plugin import CommandPlugin
 
-import aiohttp, json, time
+import json, time
 
 
 class EmotionsDetectorPlugin(CommandPlugin):
@@ -59,34 +59,33 @@ class EmotionsDetectorPlugin(CommandPlugin):
         try:  # Execute the REST API call and get the response.
             self.dirt += 1
 
-            async with aiohttp.ClientSession() as sess:
-                async with sess.post(uri_base + '/face/v1.0/detect', data=None, json=body, headers=headers, params=params) as resp:
-                    response = await resp.text()
-                    parsed = json.loads(response)
+            async with self.session.post(uri_base + '/face/v1.0/detect', data=None, json=body, headers=headers, params=params) as resp:
+                response = await resp.text()
+                parsed = json.loads(response)
 
-                    answer = ""
+                answer = ""
 
-                    for i, e in enumerate(parsed):
-                        age = e["faceAttributes"]["age"]
-                        sex = "женский" if e["faceAttributes"]['gender'] == "female" else "мужской"
+                for i, e in enumerate(parsed):
+                    age = e["faceAttributes"]["age"]
+                    sex = "женский" if e["faceAttributes"]['gender'] == "female" else "мужской"
 
-                        fear = e["faceAttributes"]["emotion"]["fear"]
-                        anger = e["faceAttributes"]["emotion"]["anger"]
-                        contempt = e["faceAttributes"]["emotion"]["contempt"]
-                        disgust = e["faceAttributes"]["emotion"]["disgust"]
-                        happiness = e["faceAttributes"]["emotion"]["happiness"]
-                        neutral = e["faceAttributes"]["emotion"]["neutral"]
-                        sadness = e["faceAttributes"]["emotion"]["sadness"]
-                        surprise = e["faceAttributes"]["emotion"]["surprise"]
+                    fear = e["faceAttributes"]["emotion"]["fear"]
+                    anger = e["faceAttributes"]["emotion"]["anger"]
+                    contempt = e["faceAttributes"]["emotion"]["contempt"]
+                    disgust = e["faceAttributes"]["emotion"]["disgust"]
+                    happiness = e["faceAttributes"]["emotion"]["happiness"]
+                    neutral = e["faceAttributes"]["emotion"]["neutral"]
+                    sadness = e["faceAttributes"]["emotion"]["sadness"]
+                    surprise = e["faceAttributes"]["emotion"]["surprise"]
 
-                        answer += f"Анализ фотографии (лицо #{i + 1})\n💁‍♂️Возраст: {age}\n👫Пол: {sex}\n😵Страх: {fear}\n😤Злость: {anger}\n" \
-                                  f"😐Презрение: {contempt}\n🤢Отвращение: {disgust}\n🙂Счастье: {happiness}\n" \
-                                  f"😶Нейтральность: {neutral}\n😔Грусть: {sadness}\n😯Удивление: {surprise}\n\n"
+                    answer += f"Анализ фотографии (лицо #{i + 1})\n💁‍♂️Возраст: {age}\n👫Пол: {sex}\n😵Страх: {fear}\n😤Злость: {anger}\n" \
+                              f"😐Презрение: {contempt}\n🤢Отвращение: {disgust}\n🙂Счастье: {happiness}\n" \
+                              f"😶Нейтральность: {neutral}\n😔Грусть: {sadness}\n😯Удивление: {surprise}\n\n"
 
-                    if not answer:
-                        raise ValueError("No answer")
+                if not answer:
+                    raise ValueError("No answer")
 
-                    return await msg.answer(answer)
+                return await msg.answer(answer)
 
         except TypeError:
             return await msg.answer(chat_id=msg.chat_id, message="Ошибочка! Наверное, мой ключ доступа перестал работать.")
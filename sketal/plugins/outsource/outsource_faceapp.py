@@ -1,7 +1,7 @@
 from handler.base_plugin import CommandPlugin
 
 from utils import upload_photo
-import aiohttp, random, string
+import random, string
 
 BASE_API_URL = 'https://node-01.faceapp.io/api/v2.3/photos'  # Ensure no slash at the end.
 BASE_HEADERS = {'User-agent': "FaceApp/1.0.229 (Linux; Android 4.4)"}
@@ -87,9 +87,8 @@ class FacePlugin(CommandPlugin):
         await msg.answer("Одну секундочку...")
 
         image = None
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(photo_url) as resp:
-                image = await resp.read()
+        async with self.session.get(photo_url) as resp:
+            image = await resp.read()
 
         if image is None:
             return await msg.answer("Ерунда какая-то! Ошибка...")
@@ -98,24 +97,23 @@ class FacePlugin(CommandPlugin):
         headers = self._generate_headers(device_id)
 
         code = None
-        async with aiohttp.ClientSession() as sess:
-            async with sess.post(BASE_API_URL, headers=headers, data={'file': image}) as resp:
-                try:
-                    response = await resp.json()
-                except ValueError:
-                    response = None
+        async with self.session.post(BASE_API_URL, headers=headers, data={'file': image}) as resp:
+            try:
+                response = await resp.json()
+            except ValueError:
+                response = None
 
-                code = response.get('code')
+            code = response.get('code')
 
-                if code is None:
-                    error = resp.headers.get('X-FaceApp-ErrorCode')
+            if code is None:
+                error = resp.headers.get('X-FaceApp-ErrorCode')
 
-                    if error == 'photo_bad_type':
-                        return await msg.answer("Плохая у тебя картинка, пф")
-                    elif error == 'photo_no_faces':
-                        return await msg.answer("Не вижу лиц \\_C:_/")
+                if error == 'photo_bad_type':
+                    return await msg.answer("Плохая у тебя картинка, пф")
+                elif error == 'photo_no_faces':
+                    return await msg.answer("Не вижу лиц \\_C:_/")
 
-                    return await msg.answer("Хм... Ошибка...")
+                return await msg.answer("Хм... Ошибка...")
 
         filter_name = text.strip().lower()
         filter_name = self.filters.get(filter_name, filter_name)
@@ -125,22 +123,21 @@ class FacePlugin(CommandPlugin):
         else:
             cropped = 0
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(
-                    '{0}/{1}/filters/{2}?cropped={3}'.format(
-                        BASE_API_URL, code, filter_name, cropped
-                    ), headers=headers) as resp:
-                image = await resp.read()
-                error = resp.headers.get('X-FaceApp-ErrorCode')
+        async with self.session.get(
+                '{0}/{1}/filters/{2}?cropped={3}'.format(
+                    BASE_API_URL, code, filter_name, cropped
+                ), headers=headers) as resp:
+            image = await resp.read()
+            error = resp.headers.get('X-FaceApp-ErrorCode')
 
-                if error:
-                    if error == 'bad_filter_id':
-                        return await msg.answer("Какой-то фильтр у тебя неправильный очень...")
-                    else:
-                        return await msg.answer("Чо... Я сломался :(")
+            if error:
+                if error == 'bad_filter_id':
+                    return await msg.answer("Какой-то фильтр у тебя неправильный очень...")
+                else:
+                    return await msg.answer("Чо... Я сломался :(")
 
-                at = await upload_photo(self.api, image)
-                if not at:
-                    return await msg.answer("Не удалось отправить картинку!")
+            at = await upload_photo(self.api, image, session=self.session)
+            if not at:
+                return await msg.answer("Не удалось отправить картинку!")
 
-                return await msg.answer(";)", attachment=at)
+            return await msg.answer(";)", attachment=at)
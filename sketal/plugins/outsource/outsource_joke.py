@@ -1,6 +1,6 @@
 from handler.base_plugin import CommandPlugin
 
-import aiohttp, time, json, re
+import time, json, re
 #AMAZING SITE: http://nextjoke.net
 
 
@@ -18,14 +18,13 @@ class JokePlugin(CommandPlugin):
     async def process_message(self, msg):
         command, text = self.parse_message(msg)
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(f"http://nextjoke.net/Api/GetJoke?format=JSONP&ratingMin=100&NOCACHE={time.time()}") as resp:
-                html = await resp.text()
-                try:
-                    html = json.loads(html.replace("window.JokeWidget.parseResponse(", "", 1)[:-2])["text"]
-                except (KeyError, json.decoder.JSONDecodeError):
-                    return await msg.answer("Сегодня без шуток ;(")
+        async with self.session.get(f"http://nextjoke.net/Api/GetJoke?format=JSONP&ratingMin=100&NOCACHE={time.time()}") as resp:
+            html = await resp.text()
+            try:
+                html = json.loads(html.replace("window.JokeWidget.parseResponse(", "", 1)[:-2])["text"]
+            except (KeyError, json.decoder.JSONDecodeError):
+                return await msg.answer("Сегодня без шуток ;(")
 
-                html = re.sub("(\n|^| )-([A-Za-zА-Яа-я])", "- \\2", html)
+            html = re.sub("(\n|^| )-([A-Za-zА-Яа-я])", "- \\2", html)
 
         return await msg.answer(html.replace("\r", ""))
@@ -21,7 +21,8 @@ class SayerPlugin(CommandPlugin):
 
         self.key = key
         self.providers = [(lambda text, lang, key=None: gTTS(text=text, lang=lang)),
-            (lambda text, lang, key=None: yTTS(text=text, lang=lang, key=key)),]
+            (lambda text, lang, key=None: yTTS(text=text, lang=lang, key=key,
+                session=self.session)),]
 
         if use_yandex:
             self.providers[0], self.providers[1] = self.providers[1], self.providers[0]
@@ -98,14 +99,15 @@ class SayerPlugin(CommandPlugin):
         if answer_file is None:
             return await msg.answer(answer)
 
-        audio = await upload_audio_message(self.api, answer_file, msg.user_id)
+        audio = await upload_audio_message(self.api, answer_file, msg.user_id,
+            session=self.session)
         answer_file.close()
 
         return await msg.answer("", attachment=str(audio))
 
 
 class yTTS(object):
-    __slots__ = ("params",)
+    __slots__ = ("params", "session")
 
     base_url = "https://tts.voicetech.yandex.net/tts"
 
@@ -113,7 +115,9 @@ class yTTS(object):
     emotion = ["good", "neutral", "evil"]
     languages = {'en': 'en_US', 'ru': 'ru_RU', 'uk': 'uk_UK', 'tr': 'tr_TR'}
 
-    def __init__(self, text, lang='ru_RU', key=""):
+    def __init__(self, text, lang='ru_RU', key="", session=None):
+        self.session = session
+
         self.params = {
             "text": text,
             "lang": self.languages.get(lang, "ru_RU"),
@@ -133,14 +137,23 @@ class yTTS(object):
             return False
 
     async def _write_to_fp(self, f):
-        async with aiohttp.ClientSession(raise_for_status=True) as sess:
-            async with sess.get(self.base_url, params=self.params) as resp:
-                while True:
-                    chunk = await resp.content.read(1024)
+        if self.session is None:
+            # Temporary session isn't stored, it's closed after request
+            async with aiohttp.ClientSession() as sess:
+                return await self.download(sess, f)
+
+        return await self.download(self.session, f)
+
+    async def download(self, session, f):
+        async with session.get(self.base_url, params=self.params) as resp:
+            resp.raise_for_status()
+
+            while True:
+                chunk = await resp.content.read(1024)
 
-                    if not chunk:
-                        break
+                if not chunk:
+                    break
 
-                    f.write(chunk)
+                f.write(chunk)
 
         return True
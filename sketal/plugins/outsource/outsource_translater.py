@@ -1,7 +1,6 @@
 from handler.base_plugin import CommandPlugin
 
 import urllib
-import aiohttp
 
 
 class TranslatePlugin(CommandPlugin):
@@ -51,29 +50,27 @@ class TranslatePlugin(CommandPlugin):
 
         url_l = f"https://translate.yandex.net/api/v1.5/tr.json/detect?key={self.key}&text={url_text}"
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(url_l) as resp:
-                result = await resp.json()
+        async with self.session.get(url_l) as resp:
+            result = await resp.json()
 
-                check = self.check_code(result)
+            check = self.check_code(result)
 
-                if check != "ok":
-                    return await msg.answer(check)
+            if check != "ok":
+                return await msg.answer(check)
 
-                language = result["lang"]
+            language = result["lang"]
 
         language = self.pair[1] if language == self.pair[0] else self.pair[0]
 
         url = f"https://translate.yandex.net/api/v1.5/tr.json/translate?key={self.key}&text={url_text}" \
               f"&lang={language}"
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(url) as resp:
-                result = await resp.json()
+        async with self.session.get(url) as resp:
+            result = await resp.json()
 
-                check = self.check_code(result)
+            check = self.check_code(result)
 
-                if check != "ok":
-                    return await msg.answer(check)
+            if check != "ok":
+                return await msg.answer(check)
 
-                return await msg.answer("\n".join(result["text"]))
+            return await msg.answer("\n".join(result["text"]))
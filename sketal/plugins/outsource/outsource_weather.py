@@ -1,7 +1,6 @@
 from handler.base_plugin import CommandPlugin
 
 from geopy.geocoders import Photon, Yandex, Nominatim
-import aiohttp
 
 import json, time
 
@@ -70,14 +69,13 @@ class WeatherPlugin(CommandPlugin):
 
         self.api_lim_count += 1
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(url.format(key=self.key,
-                                           latitude=result.latitude,
-                                           longitude=result.longitude)) as resp:
-                try:
-                    w = json.loads(await resp.text())
-                except json.decoder.JSONDecodeError:
-                    return None
+        async with self.session.get(url.format(key=self.key,
+                                       latitude=result.latitude,
+                                       longitude=result.longitude)) as resp:
+            try:
+                w = json.loads(await resp.text())
+            except json.decoder.JSONDecodeError:
+                return None
 
         if len(self.weather_cache) > 400 and self.api_lim_count < self.api_lim:
             self.weather_cache.clear()
@@ -1,6 +1,5 @@
 from handler.base_plugin import CommandPlugin
 
-import aiohttp
 
 
 class WikiPlugin(CommandPlugin):
@@ -25,31 +24,30 @@ class WikiPlugin(CommandPlugin):
 
         answer = ""
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(url) as resp:
-                result = await resp.json()
+        async with self.session.get(url) as resp:
+            result = await resp.json()
 
-                if not result or len(result) < 4:
-                    return await msg.answer("Ничего не найдено!")
+            if not result or len(result) < 4:
+                return await msg.answer("Ничего не найдено!")
 
-                length = len(result[1])
+            length = len(result[1])
 
-                for i in range(length):
-                    try:
-                        if result[2][i][-1] == ":":
-                            answer += "Возможные значения: " + result[3][i] + "\n"
+            for i in range(length):
+                try:
+                    if result[2][i][-1] == ":":
+                        answer += "Возможные значения: " + result[3][i] + "\n"
 
-                        else:
-                            answer += result[2][i] + "\n"
-                            answer += "Подробнее: " + result[3][i] + "\n"
+                    else:
+                        answer += result[2][i] + "\n"
+                        answer += "Подробнее: " + result[3][i] + "\n"
 
-                            answer += "\n"
+                        answer += "\n"
 
-                    except Exception as e:
-                        if self.bot.settings.DEBUG:
-                            self.bot.logger.warning("WikiPlugin error: " + str(e))
+                except Exception as e:
+                    if self.bot.settings.DEBUG:
+                        self.bot.logger.warning("WikiPlugin error: " + str(e))
 
-                if not answer:
-                    return await msg.answer("Ничего не найдено!")
+            if not answer:
+                return await msg.answer("Ничего не найдено!")
 
-                return await msg.answer(answer)
+            return await msg.answer(answer)
@@ -3,7 +3,7 @@ from utils import Message
 
 from random import choice
 
-import aiohttp, xmltodict
+import xmltodict
 
 
 class YandexNewsPlugin(CommandPlugin):
@@ -59,18 +59,17 @@ class YandexNewsPlugin(CommandPlugin):
         if text.lower() in self.news:
             url = self.news[text]
 
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(url) as resp:
-                xml = xmltodict.parse(await resp.text())
+        async with self.session.get(url) as resp:
+            xml = xmltodict.parse(await resp.text())
 
-                if "rss" not in xml or "channel" not in xml["rss"] or "item" not in xml["rss"]["channel"]:
-                    return await msg.answer(self.error)
+            if "rss" not in xml or "channel" not in xml["rss"] or "item" not in xml["rss"]["channel"]:
+                return await msg.answer(self.error)
 
-                items = xml["rss"]["channel"]["item"]
-                item = choice(items)
+            items = xml["rss"]["channel"]["item"]
+            item = choice(items)
 
-                if "title" not in item or "description" not in item:
-                    return await msg.answer(self.error)
+            if "title" not in item or "description" not in item:
+                return await msg.answer(self.error)
 
-                return await msg.answer(f'👉 {item["title"]}\n'
-                                        f'👉 {item["description"]}')
+            return await msg.answer(f'👉 {item["title"]}\n'
+                                    f'👉 {item["description"]}')
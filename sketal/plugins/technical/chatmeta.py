@@ -26,7 +26,7 @@ class ChatMetaPlugin(BasePlugin):
             return True
 
         new_data = await self.api.messages.getChat(chat_id=entity.chat_id,
-            fields="sex,screen_name,nickname") or {}
+            fields="sex,screen_name,nickname", _cache=not refresh) or {}
 
         if current_data:
             new_data["prev_users"] = current_data["users"]
@@ -1,58 +1,254 @@
 from handler.base_plugin import BasePlugin
+from utils import copy_data, json_encode
 
-import json
+from bson import ObjectId
+from collections import OrderedDict
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+
+import asyncio, gc, json, os, shutil, sqlite3, traceback
 
 import motor.motor_asyncio
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(body):
+    if orjson:
+        return orjson.loads(body)
+
+    return json.loads(body)
+
+
+def is_field_name(key):
+    return isinstance(key, str) and key and "." not in key and not key.startswith("$")
+
+
+def get_update(old, new):
+    """Returns MongoDB's update (with `$set`, `$unset`, `$inc` and `$push`)
+    that turns document `old` into document `new` or None if changes can't
+    be described with field paths (not string keys, keys with dots)."""
+
+    if not all(is_field_name(k) for k in old) or not all(is_field_name(k) for k in new):
+        return None
+
+    update = {}
+
+    compare(old, new, "", update)
+
+    return update
+
+
+def compare(old, new, path, update):
+    for key, value in new.items():
+        field = path + key
+
+        if key not in old:
+            update.setdefault("$set", {})[field] = value
+            continue
+
+        previous = old[key]
+
+        if previous == value:
+            continue
+
+        if isinstance(previous, dict) and isinstance(value, dict) and \
+                all(is_field_name(k) for k in previous) and \
+                all(is_field_name(k) for k in value):
+            compare(previous, value, field + ".", update)
+
+        elif isinstance(previous, list) and isinstance(value, list) and \
+                len(previous) < len(value) and value[:len(previous)] == previous:
+            update.setdefault("$push", {})[field] = {"$each": value[len(previous):]}
+
+        elif type(previous) is int and type(value) is int:
+            update.setdefault("$inc", {})[field] = value - previous
+
+        else:
+            update.setdefault("$set", {})[field] = value
+
+    for key in old:
+        if key not in new:
+            update.setdefault("$unset", {})[path + key] = ""
+
 
 class sdict(dict):
-    """Dictionary with field `changed`. `changed` is True when any element was
-    accessed."""
+    """Dictionary with field `changed`. `changed` is True when dictionary was
+    changed (at any depth) since it was loaded or saved. Reading doesn't
+    change dictionary. Changes are saved as partial updates (see
+    `get_update`)."""
 
     def __init__(self, *args, **kwargs):
-        self.changed = False
         super().__init__(*args, **kwargs)
 
-    def __getitem__(self, item):
-        self.changed = True
-        return super().__getitem__(item)
+        self.modified = False
+        self.saved = copy_data(self)
 
-    def __setitem__(self, item, value):
-        self.changed = True
-        return super().__setitem__(item, value)
+    @property
+    def changed(self):
+        return self.modified or dict.__ne__(self, self.saved)
 
-    def __delitem__(self, item):
-        self.changed = True
-        super().__delitem__(item)
+    @changed.setter
+    def changed(self, value):
+        """Set `changed` to True to save whole dictionary (even values set
+        with `setraw`) or to False to mark dictionary as saved."""
+
+        self.modified = value
+
+        if not value:
+            self.saved = copy_data(self)
+
+    def get_update(self):
+        """Returns update with changes since dictionary was saved"""
+
+        return get_update(self.saved, self)
 
     def getraw(self, item, default=None):
-        try:
-            return super().__getitem__(item)
-        except KeyError:
-            return default
+        return super().get(item, default)
 
     def setraw(self, item, value):
+        """Set value without marking dictionary as changed"""
+
         super().__setitem__(item, value)
+        self.saved[item] = copy_data(value)
 
     def delraw(self, item):
+        """Delete value without marking dictionary as changed"""
+
         super().__delitem__(item)
+        self.saved.pop(item, None)
+
+
+class SQLiteStorage:
+    """Documents in SQLite database `path`. Every collection is a table with
+    document's key, `_version` and document in json. Database is opened on
+    first use, so it can be used by forked processes."""
+
+    __slots__ = ("path", "reader", "writer")
+
+    TABLES = ("users", "chats", "meta")
+
+    def __init__(self, path):
+        self.path = path
+
+        self.reader = None
+        self.writer = None
+
+    def connect(self, check_same_thread=True):
+        """Returns new connection to database. Reader is used in event
+        loop's thread and writer is used in executor, so every connection is
+        opened by the thread that uses it."""
+
+        connection = sqlite3.connect(self.path, check_same_thread=check_same_thread)
+
+        # Write-ahead log keeps database consistent if process crashes
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        for table in self.TABLES:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (key PRIMARY KEY, "
+                "version INTEGER NOT NULL, data TEXT NOT NULL)")
+
+        connection.commit()
+
+        return connection
+
+    def load(self, table, key):
+        if self.reader is None:
+            self.reader = self.connect()
+
+        row = self.reader.execute(f"SELECT data FROM {table} WHERE key = ?", (key,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def versions(self, table, keys):
+        """Returns dictionary with versions of documents `keys`"""
+
+        if self.reader is None:
+            self.reader = self.connect()
+
+        query = f"SELECT key, version FROM {table} WHERE key IN ({','.join('?' * len(keys))})"
+
+        return dict(self.reader.execute(query, list(keys)).fetchall())
+
+    def write(self, table, rows):
+        """Write rows (key, version, data) in one transaction if documents in
+        database have versions `version`. Returns keys of rows that weren't
+        written because of other version."""
+
+        if self.writer is None:
+            self.writer = self.connect(check_same_thread=False)
+
+        conflicts = []
+
+        with self.writer:
+            for key, version, data in rows:
+                if version == 0:
+                    cursor = self.writer.execute(f"INSERT OR IGNORE INTO {table} "
+                        "(key, version, data) VALUES (?, 1, ?)", (key, data))
+                else:
+                    cursor = self.writer.execute(f"UPDATE {table} SET version = ?, "
+                        "data = ? WHERE key = ? AND version = ?", (version + 1, data,
+                            key, version))
+
+                if cursor.rowcount == 0:
+                    conflicts.append(key)
+
+        return conflicts
+
+    def close(self):
+        for connection in (self.reader, self.writer):
+            if connection:
+                connection.close()
+
+        self.reader = None
+        self.writer = None
 
 
 class StoragePlugin(BasePlugin):
-    __slots__ = ("client", "database", "users", "chats", "meta", "cached_meta",
-        "in_memory", "save_to_file")
+    __slots__ = ("client", "database", "users", "chats", "meta", "in_memory",
+        "save_to_file", "cache", "cache_size", "dirty", "flush_interval",
+        "flusher", "flushing", "sqlite", "journal", "journal_size", "compact_after", "compactor",
+        "loading", "loader", "meta_refresh_interval", "refresher")
 
     def __init__(self, host="localhost", port=27017, database="sketal_db",
-            in_memory=False, save_to_file=False):
-        """Allows users and chats to store persistent data with MongoDB or in
-        memory. Both storages are situated in `meta` as `data_user` and
+            in_memory=False, save_to_file=False, cache_size=10000, flush_interval=1,
+            sqlite=None, compact_after=50000, meta_refresh_interval=5):
+        """Allows users and chats to store persistent data with MongoDB, SQLite
+        or in memory. Both storages are situated in `meta` as `data_user` and
         `data_chat` and represented as dictionary with possible basic values
         (dict, list, tuple, int, float, str, bool). On the beggining theese
         fields are populated and after message processing it is saved to
         database.
 
-        Data is saved only if was acessed. You can use `sdict`'s methods and
-        field `changed` for accessing data without saving it."""
+        Data is saved only if was changed. You can use `sdict`'s methods and
+        field `changed` for changing data without saving it.
+
+        `cache_size` last used documents are kept in memory. Changed
+        documents are written to MongoDB every `flush_interval` seconds
+        with one `bulk_write` for collection. Every write stores unique
+        `_wid` in document. If document was changed by someone else (other
+        `_version` or `_wid` in database), changes are discarded and
+        document is loaded again. Documents requested during the same
+        event loop's iteration are loaded with one query for collection.
+
+        Meta documents are read on every message, so they are kept in
+        memory. Every `meta_refresh_interval` seconds their `_version` are
+        checked and documents changed by other processes are loaded again.
+
+        If `sqlite` is path to file, data is stored in SQLite database in
+        this file instead of MongoDB. Documents are loaded when they are
+        needed and changed documents are written in one transaction every
+        `flush_interval` seconds.
+
+        With `in_memory` and `save_to_file` data is stored in snapshot
+        `storage.localdata.json` and journal `storage.localdata.journal`.
+        Saved documents are appended to journal every `flush_interval`
+        seconds. When journal has `compact_after` documents, new snapshot is
+        written in background. On start snapshot is loaded and journal is
+        replayed."""
 
         super().__init__()
 
@@ -66,35 +262,18 @@ class StoragePlugin(BasePlugin):
             self.chats = sdict()
             self.meta = sdict()
 
+        elif sqlite:
             if save_to_file:
-                path = self.get_path("storage.localdata.json")
+                raise AttributeError("You can't use `save_to_file` with `sqlite`")
 
-                try:
-                    with open(path) as o:
-                        u, c, m = json.load(o)
-
-                        for k, v in u.items():
-                            self.users[int(k)] = v
-
-                        for k, v in c.items():
-                            self.chats[int(k)] = v
-
-                        for k, v in m.items():
-                            if isinstance(k, str) and k.isdigit():
-                                print("Storage :: You use number in "
-                                    "string format in storage with `in_memory`."
-                                        " It can be a mistake.")
-
-                            self.meta[k] = v
-
-                except ValueError:
-                    import traceback
-                    traceback.print_exc()
+            self.client = None
+            self.database = None
 
-                    print("Storage :: File `" + path + "` is broken.")
+            self.users = None
+            self.chats = None
+            self.meta = None
 
-                except FileNotFoundError:
-                    pass
+            self.create_executor(max_workers=1)
 
         else:
             if save_to_file:
@@ -109,133 +288,676 @@ class StoragePlugin(BasePlugin):
             self.chats = self.database["chats"]
             self.meta = self.database["meta"]
 
-        self.cached_meta = None
-
         self.in_memory = in_memory
         self.save_to_file = save_to_file
 
+        self.sqlite = SQLiteStorage(sqlite) if sqlite and not in_memory else None
+
+        self.journal = None
+        self.journal_size = 0
+        self.compact_after = compact_after
+        self.compactor = None
+
+        if in_memory and save_to_file:
+            self.create_executor(max_workers=1)
+            self.load_file()
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+        self.dirty = {}
+        self.flush_interval = flush_interval
+        self.flusher = None
+        self.flushing = None
+
+        self.loading = {}
+        self.loader = None
+
+        self.meta_refresh_interval = meta_refresh_interval
+        self.refresher = None
+
     def my_path(self):
         return self.get_path("admin_lists.localdata.json")
 
     async def stop(self):
-        if not self.save_to_file:
-            return
+        if self.refresher:
+            self.refresher.cancel()
+            self.refresher = None
+
+        if self.flusher:
+            self.flusher.cancel()
+            self.flusher = None
+
+        # Write started by flusher is finished before the last one
+        if self.flushing:
+            try:
+                await self.flushing
+            except Exception:
+                self.bot.logger.error("Storage :: Error while saving data:\n" +
+                    traceback.format_exc())
+
+        await self.flush()
+
+        if self.compactor:
+            await self.compactor
+
+        if self.sqlite:
+            self.sqlite.close()
+
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def load_file(self):
+        """Load snapshot and replay journals"""
+
+        # Garbage collector slows down creating of many objects
+        gc.disable()
+
+        try:
+            self.load_snapshot()
+            self.replay_journal()
+        finally:
+            gc.enable()
+
+    def load_snapshot(self):
+        path = self.get_path("storage.localdata.json")
+
+        try:
+            with open(path, "rb") as o:
+                u, c, m = loads(o.read())
+
+            for k, v in u.items():
+                self.users[int(k)] = v
+
+            for k, v in c.items():
+                self.chats[int(k)] = v
+
+            for k, v in m.items():
+                if isinstance(k, str) and k.isdigit():
+                    print("Storage :: You use number in "
+                        "string format in storage with `in_memory`."
+                            " It can be a mistake.")
+
+                self.meta[k] = v
+
+        except ValueError:
+            traceback.print_exc()
+
+            print("Storage :: File `" + path + "` is broken.")
+
+        except FileNotFoundError:
+            pass
+
+    def replay_journal(self):
+        # Journal is renamed to ".old" while snapshot is written
+        for path in (self.get_path("storage.localdata.journal.old"),
+                     self.get_path("storage.localdata.journal")):
+            end = 0
+            broken = False
+
+            try:
+                with open(path, "rb") as o:
+                    for line in o:
+                        try:
+                            if not line.endswith(b"\n"):
+                                raise ValueError("Line is not finished")
+
+                            name, xid, d = loads(line)
+                        except ValueError:
+                            broken = True
+                            break
+
+                        getattr(self, name)[xid] = d
+                        self.journal_size += 1
+
+                        end += len(line)
+
+            except FileNotFoundError:
+                continue
 
-        target = (self.users, self.chats, self.meta)
+            # Last line can be partially written. It's removed, so new lines
+            # are not appended to it.
+            if broken:
+                os.truncate(path, end)
 
-        if not target:
+    def write_journal(self, body):
+        if self.journal is None:
+            self.journal = open(self.get_path("storage.localdata.journal"), "ab")
+
+        self.journal.write(body)
+        self.journal.flush()
+
+        os.fsync(self.journal.fileno())
+
+    def rotate_journal(self):
+        """Move journal to ".old" journal. New journal is created on next write"""
+
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+        path = self.get_path("storage.localdata.journal")
+        old = self.get_path("storage.localdata.journal.old")
+
+        if not os.path.exists(path):
             return
 
-        with open(self.get_path("storage.localdata.json"), "w") as o:
-            json.dump(target, o)
+        if os.path.exists(old):
+            with open(old, "ab") as o, open(path, "rb") as i:
+                shutil.copyfileobj(i, o)
+
+            os.remove(path)
+        else:
+            os.replace(path, old)
+
+    def write_snapshot(self, parts):
+        """Replace snapshot with collections `parts` (lists of serialized
+        "key:document" pairs) and remove ".old" journal"""
+
+        path = self.get_path("storage.localdata.json")
+
+        with open(path + ".tmp", "wb") as o:
+            o.write(b"[")
+
+            for i, part in enumerate(parts):
+                o.write(b"{" if i == 0 else b",{")
+                o.write(b",".join(part))
+                o.write(b"}")
+
+            o.write(b"]")
+            o.flush()
+
+            os.fsync(o.fileno())
+
+        os.replace(path + ".tmp", path)
+
+        try:
+            os.remove(self.get_path("storage.localdata.journal.old"))
+        except FileNotFoundError:
+            pass
+
+    async def compact(self):
+        """Write snapshot with all documents in background. Documents are
+        serialized in parts, so event loop is not blocked."""
+
+        try:
+            await self.run_in_executor(self.rotate_journal)
+            self.journal_size = 0
+
+            parts = []
+
+            for x in (self.users, self.chats, self.meta):
+                part = []
+
+                # List of keys (not items) doesn't trigger garbage collector
+                for i, k in enumerate(list(x)):
+                    v = x.get(k)
+
+                    if v is not None:
+                        part.append(json_encode(str(k)) + b":" + json_encode(v))
+
+                    if i % 1000 == 999:
+                        await asyncio.sleep(0)
+
+                parts.append(part)
+
+            await self.run_in_executor(self.write_snapshot, parts)
+
+        except Exception:
+            self.bot.logger.error("Storage :: Error while writing snapshot:\n" +
+                traceback.format_exc())
+
+        finally:
+            self.compactor = None
+
+    async def flush_journal(self, dirty):
+        """Append changed documents to journal"""
+
+        lines = []
+        written = []
+
+        for (name, xid), d in dirty.items():
+            if not d.changed:
+                continue
+
+            try:
+                lines.append(json_encode([name, xid, d]) + b"\n")
+            except (TypeError, ValueError):
+                self.bot.logger.error(f"Storage :: Document {xid} from `{name}` can't "
+                    "be saved in json:\n" + traceback.format_exc())
+                continue
 
-    async def _save(self, xid, d, x):
-        if isinstance(xid, str):
+            d.changed = False
+
+            written.append(((name, xid), d))
+
+        if lines:
+            try:
+                await self.run_in_executor(self.write_journal, b"".join(lines))
+
+            except Exception:
+                for key, d in written:
+                    d.modified = True
+                    self.dirty.setdefault(key, d)
+
+                raise
+
+            self.journal_size += len(lines)
+
+        if self.journal_size >= self.compact_after and self.compactor is None:
+            self.compactor = asyncio.ensure_future(self.compact())
+
+    @staticmethod
+    def get_field(name):
+        return "_name" if name == "meta" else "id"
+
+    def cache_document(self, key, d):
+        self.cache[key] = d
+        self.cache.move_to_end(key)
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def _save(self, name, xid, d):
+        """Save document `d`. Returns `None` if there is nothing to save,
+        `False` if document in memory was replaced (other `_version`) and
+        `True` otherwise.
+
+        With MongoDB or SQLite documents are written later by `flush`, so
+        `True` only means that document will be written. Conflicts can't be
+        reported to caller: document changed by someone else (other
+        `_version` in database) is not written, its changes are discarded
+        (see `discard`) and it's loaded again on next request."""
+
+        if isinstance(xid, str) and name != "meta":
             xid = int(xid)
 
-        if xid == 0 or not d or not d.changed:
+        if xid == 0 or not d:
             return None
 
-        if "id" not in d:
-            d["id"] = xid
-
         if self.in_memory:
+            x = getattr(self, name)
             cur = x.get(xid)
 
-            if not cur or cur["_version"] == d["_version"]:
+            if cur is d:
+                if self.save_to_file:
+                    self.mark_dirty(name, xid, d)
+
+                return True
+
+            if not d.changed:
+                return None
+
+            if cur is None or cur["_version"] == d["_version"]:
+                if name != "meta" and "id" not in d:
+                    d["id"] = xid
+
                 d["_version"] += 1
                 x[xid] = d
+
+                if self.save_to_file:
+                    self.mark_dirty(name, xid, d)
+
                 return True
 
             return False
 
-        if "_id" not in d:
-            return await x.insert_one(d)
+        if name != "meta" and "id" not in d:
+            d["id"] = xid
 
-        old_ver = d["_version"]
-        d["_version"] += 1
+        self.mark_dirty(name, xid, d)
 
-        res = await x.replace_one({"_id": {"$eq": d["_id"]},
-            "_version": {"$eq": old_ver}}, d)
+        return True
 
-        if res.modified_count == 0:
-            return False
+    def mark_dirty(self, name, xid, d):
+        # Documents are checked for changes when they are written
+        self.dirty[(name, xid)] = d
 
-        return True
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush_periodically())
 
     async def save_user(self, user_id, data):
-        return await self._save(user_id, data, self.users)
+        return await self._save("users", user_id, data)
 
     async def save_chat(self, chat_id, data):
-        return await self._save(chat_id, data, self.chats)
+        return await self._save("chats", chat_id, data)
 
-    async def _load(self, xid, x):
-        if isinstance(xid, str):
+    async def save_meta(self, d, segment="main"):
+        return await self._save("meta", segment, d)
+
+    def get_cached(self, name, xid):
+        """Returns document from memory or None"""
+
+        key = (name, xid)
+
+        d = self.dirty.get(key) or self.cache.get(key)
+
+        if d is not None:
+            self.cache_document(key, d)
+
+        return d
+
+    async def _load(self, name, xid):
+        if isinstance(xid, str) and name != "meta":
             xid = int(xid)
 
         if xid == 0:
             return None
 
-        if self.in_memory:
-            return sdict(x.get(xid) or {"id": xid, "_version": 0})
+        key = (name, xid)
+
+        d = self.get_cached(name, xid)
 
-        return sdict(await x.find_one({"id": {"$eq": xid}}) or
-            {"id": xid, "_version": 0})
+        if d is None:
+            x = getattr(self, name)
+            field = self.get_field(name)
+
+            if self.in_memory:
+                raw = x.get(xid)
+            elif self.sqlite:
+                raw = self.sqlite.load(name, xid)
+            else:
+                raw = await asyncio.shield(self.fetch(name, xid))
+
+            d = self.dirty.get(key) or self.cache.get(key)
+
+            if d is None:
+                d = raw if isinstance(raw, sdict) else sdict(raw or {field: xid, "_version": 0})
+
+            self.cache_document(key, d)
+
+            if name == "meta" and not self.in_memory and self.refresher is None:
+                self.refresher = asyncio.ensure_future(self.refresh_meta_periodically())
+
+        return d
+
+    def fetch(self, name, xid):
+        """Returns future with document from database. Documents are loaded
+        in batches by `load_pending`."""
+
+        futures = self.loading.setdefault(name, {})
+
+        future = futures.get(xid)
+
+        if future is None:
+            future = futures[xid] = self.bot.loop.create_future()
+
+            if self.loader is None:
+                self.loader = asyncio.ensure_future(self.load_pending())
+
+        return future
+
+    async def load_pending(self):
+        """Load documents requested during this event loop's iteration"""
+
+        # Let other messages from the same update request their documents
+        await asyncio.sleep(0)
+
+        loading, self.loading = self.loading, {}
+        self.loader = None
+
+        await asyncio.gather(*(self.load_collection(name, futures)
+            for name, futures in loading.items()))
+
+    async def load_collection(self, name, futures):
+        field = self.get_field(name)
+
+        try:
+            found = {d[field]: d async for d in
+                getattr(self, name).find({field: {"$in": list(futures)}})}
+
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        for xid, future in futures.items():
+            if not future.done():
+                future.set_result(found.get(xid))
 
     async def load_user(self, user_id):
-        return await self._load(user_id, self.users)
+        return await self._load("users", user_id)
 
     async def load_chat(self, chat_id):
-        return await self._load(chat_id, self.chats)
+        return await self._load("chats", chat_id)
 
     async def load_meta(self, segment="main"):
-        if self.cached_meta:
-            self.cached_meta.changed = False
-            return self.cached_meta
+        return await self._load("meta", segment)
 
-        if self.in_memory:
-            self.cached_meta = sdict(self.meta.get(segment) or
-                {"_name": segment, "_version": 0})
+    async def refresh_meta_periodically(self):
+        while True:
+            await asyncio.sleep(self.meta_refresh_interval)
+
+            try:
+                await self.refresh_meta()
+            except Exception:
+                self.bot.logger.error("Storage :: Error while refreshing meta:\n" +
+                    traceback.format_exc())
 
-            return self.cached_meta
+    async def refresh_meta(self):
+        """Load again meta documents that were changed by someone else"""
 
-        self.cached_meta = sdict(await self.meta.find_one({"_name": {"$eq": segment}}) or
-            {"_name": segment, "_version": 0})
+        cached = {xid: d for (name, xid), d in self.cache.items()
+            if name == "meta" and ("meta", xid) not in self.dirty and not d.changed}
 
-        self.cached_meta.show = True
+        if not cached:
+            return
+
+        if self.sqlite:
+            versions = self.sqlite.versions("meta", cached)
+        else:
+            versions = {d["_name"]: d["_version"] async for d in
+                self.meta.find({"_name": {"$in": list(cached)}}, {"_name": 1, "_version": 1})}
 
-        return self.cached_meta
+        stale = [xid for xid, d in cached.items()
+            if versions.get(xid, 0) > d["_version"]]
 
-    async def save_meta(self, d, segment="main"):
-        if not d or not d.changed:
+        if not stale:
             return
 
-        self.cached_meta = None
+        if self.sqlite:
+            documents = [self.sqlite.load("meta", xid) for xid in stale]
+        else:
+            documents = [d async for d in self.meta.find({"_name": {"$in": stale}})]
+
+        for raw in documents:
+            key = ("meta", raw["_name"])
+
+            # Document could be changed while it was loading
+            if key in self.dirty or self.cache.get(key) is not cached[raw["_name"]] or \
+                    cached[raw["_name"]].changed:
+                continue
+
+            self.cache[key] = sdict(raw)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            # Cancelling flusher doesn't interrupt write (see `stop`)
+            self.flushing = asyncio.ensure_future(self.flush())
+
+            try:
+                await asyncio.shield(self.flushing)
+            except Exception:
+                self.bot.logger.error("Storage :: Error while saving data:\n" +
+                    traceback.format_exc())
+
+    async def flush(self):
+        """Write changed documents to database"""
+
+        dirty, self.dirty = self.dirty, {}
 
         if self.in_memory:
-            cur = self.meta.get(segment)
+            return await self.flush_journal(dirty)
 
-            if not cur or cur["_version"] == d["_version"]:
-                d["_version"] += 1
-                self.meta[segment] = d
+        for name in ("users", "chats", "meta"):
+            documents = [(xid, d) for (n, xid), d in dirty.items() if n == name]
 
-                return True
+            if documents:
+                await self.flush_collection(name, documents)
 
-            return False
+    async def flush_collection(self, name, documents):
+        """Write documents with one `bulk_write`. Documents are replaced only
+        if they have the same `_version` and `_wid` as when they were loaded
+        or written. Written documents get new `_wid`, so writes that
+        weren't applied can be found after `bulk_write`."""
 
-        if "_id" not in d:
-            return await self.meta.insert_one(d)
+        if self.sqlite:
+            return await self.flush_sqlite(name, documents)
 
-        old_ver = d["_version"]
-        d["_version"] += 1
+        x = getattr(self, name)
 
-        res = await self.meta.replace_one({"_name": {"$eq": segment},
-            "_version": {"$eq": old_ver}}, d)
+        wid = ObjectId()
 
-        if res.modified_count == 0:
-            return False
+        requests = []
+        inserted = []
+        replaced = []
+        previous = []
 
-        return True
+        for xid, d in documents:
+            data = copy_data(d)
+
+            if "_id" not in d:
+                if not d.changed:
+                    continue
+
+                data["_wid"] = wid
+                requests.append(InsertOne(data))
+                inserted.append((d, data))
+
+            else:
+                update = None if d.modified else get_update(d.saved, data)
+
+                if update == {}:
+                    continue
+
+                query = {"_id": {"$eq": d["_id"]}, "_version": {"$eq": d["_version"]},
+                         "_wid": {"$eq": d.get("_wid")}}
+
+                data["_wid"] = wid
+
+                if update is None:
+                    data["_version"] += 1
+                    requests.append(ReplaceOne(query, data))
+                else:
+                    update.setdefault("$inc", {})["_version"] = 1
+                    update.setdefault("$set", {})["_wid"] = wid
+                    requests.append(UpdateOne(query, update))
+
+                replaced.append((xid, d))
+
+            previous.append((xid, d, d.saved, d.modified, d.get("_wid")))
+
+            data["_version"] = d["_version"] + 1
+            dict.__setitem__(d, "_version", data["_version"])
+            dict.__setitem__(d, "_wid", wid)
+
+            d.modified = False
+            d.saved = data
+
+        if not requests:
+            return
+
+        try:
+            result = await x.bulk_write(requests, ordered=False)
+
+        except Exception:
+            self.bot.logger.error("Storage :: Error while saving data:\n" +
+                traceback.format_exc())
+
+            self.restore(name, previous)
+
+            return
+
+        for d, data in inserted:
+            d.setraw("_id", data["_id"])
+
+        if replaced and result.matched_count < len(replaced):
+            await self.discard_conflicts(name, replaced, wid)
+
+    async def flush_sqlite(self, name, documents):
+        rows = []
+        previous = []
+
+        for xid, d in documents:
+            if not d.changed:
+                continue
+
+            data = copy_data(d)
+            data["_version"] = d["_version"] + 1
+
+            try:
+                rows.append((xid, d["_version"], json.dumps(data, ensure_ascii=False)))
+            except (TypeError, ValueError):
+                self.bot.logger.error(f"Storage :: Document {xid} from `{name}` can't "
+                    "be saved in json:\n" + traceback.format_exc())
+                continue
+
+            previous.append((xid, d, d.saved, d.modified, d.get("_wid")))
+
+            dict.__setitem__(d, "_version", data["_version"])
+
+            d.modified = False
+            d.saved = data
+
+        if not rows:
+            return
+
+        try:
+            conflicts = await self.run_in_executor(self.sqlite.write, name, rows)
+
+        except Exception:
+            self.bot.logger.error("Storage :: Error while saving data:\n" +
+                traceback.format_exc())
+
+            self.restore(name, previous)
+
+            return
+
+        for xid in conflicts:
+            self.discard(name, xid)
+
+    def restore(self, name, previous):
+        """Mark documents `previous` as not saved after failed write"""
+
+        for xid, d, saved, modified, wid in previous:
+            dict.__setitem__(d, "_version", d["_version"] - 1)
+
+            if wid is None:
+                dict.pop(d, "_wid", None)
+            else:
+                dict.__setitem__(d, "_wid", wid)
+
+            d.saved = saved
+            d.modified = modified
+
+            self.dirty.setdefault((name, xid), d)
+
+    def discard(self, name, xid):
+        """Forget document that was changed by someone else"""
+
+        self.bot.logger.warning(f"Storage :: Document {xid} from `{name}` was "
+            "changed by someone else, changes are discarded")
+
+        self.cache.pop((name, xid), None)
+
+    async def discard_conflicts(self, name, replaced, wid):
+        """Forget documents that weren't written with `_wid` equal to `wid`
+        (they were changed by someone else)"""
+
+        written = set()
+
+        async for raw in getattr(self, name).find({"_id": {"$in": [d["_id"] for _, d in replaced]},
+                "_wid": {"$eq": wid}}, {"_id": 1}):
+            written.add(raw["_id"])
+
+        for xid, d in replaced:
+            if d["_id"] not in written and self.cache.get((name, xid)) is d:
+                self.discard(name, xid)
 
     def prepare_ctrl(self, entity):
         async def _1l():
@@ -273,18 +995,37 @@ class StoragePlugin(BasePlugin):
         }
 
     async def global_before_message_checks(self, msg):
-        if not self.in_memory:
+        if self.client:
             msg.meta["mongodb_client"] = self.client
 
         msg.meta["data_ctrl"] = self.prepare_ctrl(msg)
 
-        msg.meta["data_meta"] = await self.load_meta()
-        msg.meta["data_user"] = await self.load_user(msg.user_id)
-        msg.meta["data_chat"] = await self.load_chat(msg.chat_id) if \
-            msg.is_multichat else None
+        targets = [("data_meta", "meta", "main"), ("data_user", "users", msg.user_id)]
+
+        if msg.is_multichat:
+            targets.append(("data_chat", "chats", msg.chat_id))
+        else:
+            msg.meta["data_chat"] = None
+
+        # Documents that are not in memory are loaded concurrently
+        loading = []
+
+        for field, name, xid in targets:
+            msg.meta[field] = self.get_cached(name, xid) if xid else None
+
+            if msg.meta[field] is None and xid:
+                loading.append((field, self._load(name, xid)))
+
+        if self.in_memory or self.sqlite or len(loading) == 1:
+            for field, l in loading:
+                msg.meta[field] = await l
+
+        elif loading:
+            for (field, _), d in zip(loading, await asyncio.gather(*(l for _, l in loading))):
+                msg.meta[field] = d
 
     async def global_before_event_checks(self, evnt):
-        if not self.in_memory:
+        if self.client:
             evnt.meta["mongodb_client"] = self.client
 
         evnt.meta["data_ctrl"] = self.prepare_ctrl(evnt)
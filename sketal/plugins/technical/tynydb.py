@@ -1,9 +1,11 @@
 from handler.base_plugin import BasePlugin
+from utils import json_encode
 
 
-from tinydb import TinyDB, Query
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
+from tinydb import TinyDB
+from tinydb.storages import Storage
+
+import asyncio, json, os, traceback
 
 """ TinyDB
 Docs: http://tinydb.readthedocs.io/en/latest/
@@ -16,38 +18,200 @@ General sample usage:
 """
 
 
+class MemoryJSONStorage(Storage):
+    """TinyDB's storage that keeps data in memory. Data is read from json
+    file `path` once and written by `TinyDBPlugin` in background."""
+
+    def __init__(self, path):
+        super().__init__()
+
+        self.path = path
+        self.data = None
+
+        self.changed = False
+        self.revision = 0
+
+    def read(self):
+        if self.data is None:
+            try:
+                with open(self.path, "rb") as o:
+                    body = o.read()
+
+                self.data = json.loads(body) if body.strip() else {}
+
+            except FileNotFoundError:
+                self.data = {}
+
+        return self.data
+
+    def write(self, data):
+        """Called by TinyDB. Tables could be replaced, so indexes are built
+        again (see `revision`)."""
+
+        self.data = data
+
+        self.changed = True
+        self.revision += 1
+
+    def close(self):
+        pass
+
+
 class TinyDBPlugin(BasePlugin):
-    __slots__ = ("tinydb", )
+    __slots__ = ("tinydb", "storage", "table", "index", "revision",
+        "flush_interval", "flusher")
 
-    def __init__(self):
+    def __init__(self, flush_interval=1):
         """Adds self to messages and event's `data` field.
         Through this instance you can access TinyDB instance (data["tinydbproxy"].tinydb).
         This plugin should be included first!
+
+        Users are found with index by `user_id`. Changes are written to file
+        every `flush_interval` seconds in background.
         """
 
         super().__init__()
 
         self.order = (-95, 95)
 
-        self.tinydb = TinyDB(path=self.get_path("tinydb_database.json"), storage=CachingMiddleware(JSONStorage))
+        self.storage = MemoryJSONStorage(self.get_path("tinydb_database.json"))
+
+        self.tinydb = TinyDB(storage=lambda: self.storage)
+        self.table = self.tinydb.table(TinyDB.DEFAULT_TABLE)
+
+        self.index = {}
+        self.revision = None
+
+        self.flush_interval = flush_interval
+        self.flusher = None
+
+        self.create_executor(max_workers=1)
+
+    async def stop(self):
+        if self.flusher:
+            self.flusher.cancel()
+            self.flusher = None
+
+        await self.flush()
+
+    def documents(self):
+        """Returns documents of default table. Index is built again if data
+        was changed through `tinydb`."""
+
+        documents = self.storage.read().setdefault(TinyDB.DEFAULT_TABLE, {})
+
+        if self.revision != self.storage.revision:
+            self.index = {d["user_id"]: doc_id for doc_id, d in documents.items()
+                if "user_id" in d}
+
+            self.revision = self.storage.revision
+
+        return documents
 
     def get_user(self, user_id):
-        User = Query()
+        documents = self.documents()
 
-        user = self.tinydb.get(User.user_id == user_id)
+        doc_id = self.index.get(user_id)
 
-        return user["data"] if user else {}
+        return documents[doc_id]['data'] if doc_id is not None else {}
 
     def save_user(self, user_id, data):
-        User = Query()
+        documents = self.documents()
+
+        doc_id = self.index.get(user_id)
 
-        if not self.tinydb.update({'user_id': user_id, 'data': data}, User.user_id == user_id):
-            self.tinydb.insert({'user_id': user_id, 'data': data})
+        if doc_id is None:
+            # Table's counter is used, so TinyDB's inserts get other ids
+            doc_id = self.index[user_id] = self.table._get_next_id()
+
+            documents[doc_id] = {'user_id': user_id, 'data': data}
+        else:
+            documents[doc_id]['data'] = data
+
+        self.changed()
 
     def delete_user(self, user_id):
-        User = Query()
+        documents = self.documents()
+
+        doc_id = self.index.pop(user_id, None)
+
+        if doc_id is not None:
+            del documents[doc_id]
+
+            self.changed()
+
+    def changed(self):
+        # Results of TinyDB's queries can be outdated
+        self.table.clear_cache()
+
+        self.storage.changed = True
+
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush_periodically())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            try:
+                await self.flush()
+            except Exception:
+                self.bot.logger.error("TinyDB :: Error while saving data:\n" +
+                    traceback.format_exc())
+
+    async def flush(self):
+        """Write data to file. Documents are serialized in parts, so event
+        loop is not blocked, and written in executor."""
+
+        if not self.storage.changed:
+            return
+
+        self.storage.changed = False
+
+        tables = []
+
+        for name, table in list(self.storage.read().items()):
+            part = []
+
+            for i, doc_id in enumerate(list(table)):
+                d = table.get(doc_id)
+
+                if d is not None:
+                    part.append(json_encode(str(doc_id)) + b":" + json_encode(d))
+
+                if i % 1000 == 999:
+                    await asyncio.sleep(0)
+
+            tables.append((name, part))
+
+        try:
+            await self.run_in_executor(self.write_file, tables)
+
+        except Exception:
+            self.storage.changed = True
+
+            raise
+
+    def write_file(self, tables):
+        """Replace file with `tables` (pairs of table's name and list of
+        serialized "doc_id:document")"""
+
+        path = self.storage.path
+
+        with open(path + ".tmp", "wb") as o:
+            o.write(b"{")
+
+            for i, (name, part) in enumerate(tables):
+                o.write((b"," if i else b"") + json_encode(name) + b":{")
+                o.write(b",".join(part))
+                o.write(b"}")
+
+            o.write(b"}")
+            o.flush()
+
+            os.fsync(o.fileno())
 
-        self.tinydb.remove(User.user_id == user_id)
+        os.replace(path + ".tmp", path)
 
     async def global_before_message_checks(self, msg):
         msg.meta["tdb"] = self.tinydb
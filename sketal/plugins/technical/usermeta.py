@@ -1,41 +1,139 @@
 from handler.base_plugin import BasePlugin
 
+from collections import OrderedDict
+
+import asyncio, time, traceback
+
 
 class UserMetaPlugin(BasePlugin):
-    __slots__ = ("users",)
+    __slots__ = ("users", "size", "ttl", "refresh_ahead", "refresh_delay", "stale",
+        "refresher", "hits", "misses", "evictions", "refreshes")
+
+    FIELDS = "sex,screen_name,nickname"
 
-    def __init__(self):
+    def __init__(self, size=50000, ttl=3600, refresh_ahead=600, refresh_delay=1):
         """Adds `user_info` to messages and events's meta with user's data
         if available (https://vk.com/dev/users.get). You can refresh data
-        with coroutine stored in `meta['user_info_refresh']`."""
+        with coroutine stored in `meta['user_info_refresh']`.
+
+        Data of `size` recently seen users is kept for `ttl` seconds. Users
+        seen during last `refresh_ahead` seconds before expiration are
+        refreshed in background (`refresh_delay` seconds after they were
+        seen, with one `users.get` for up to 1000 users). Plugin is added to
+        meta as `users_cache` and used by `parse_user_name`."""
+
         super().__init__()
 
         self.order = (-91, 91)
 
-        self.users = {}
+        self.users = OrderedDict()
+        self.size = size
+        self.ttl = ttl
+
+        self.refresh_ahead = refresh_ahead
+        self.refresh_delay = refresh_delay
+        self.stale = set()
+        self.refresher = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+
+    async def stop(self):
+        if self.refresher:
+            self.refresher.cancel()
+            self.refresher = None
+
+    @property
+    def cache_stats(self):
+        requests = self.hits + self.misses
+
+        return {
+            "size": len(self.users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "refreshes": self.refreshes,
+            "hit_rate": self.hits / requests if requests else 0,
+        }
+
+    def store(self, user_id, data):
+        self.users[user_id] = (time.time() + self.ttl, data)
+        self.users.move_to_end(user_id)
+
+        while len(self.users) > self.size:
+            self.users.popitem(last=False)
+            self.evictions += 1
 
     async def update_user_info(self, user_id, refresh=False):
         if user_id == 0 :
             return False
 
-        current_data = self.users.get(user_id)
+        current = self.users.get(user_id)
+
+        if not refresh and current:
+            expires, data = current
+
+            left = expires - time.time()
+
+            if left > 0:
+                self.hits += 1
+                self.users.move_to_end(user_id)
+
+                if left < self.refresh_ahead:
+                    self.schedule_refresh(user_id)
+
+                return data
 
-        if not refresh and current_data:
-            return current_data
+        if not refresh:
+            self.misses += 1
 
-        new_data = await self.api.users.get(user_ids=user_id,
-            fields="sex,screen_name,nickname") or {}
+        new_data = await self.api.users.get(user_ids=user_id, fields=self.FIELDS,
+            _cache=not refresh) or {}
 
         if not new_data:
             return None
 
-        if len(self.users) > 50000:
-            from random import random
-            self.users = dict((k, v) for k, v in self.users.items() if random() > 0.25)
+        self.store(user_id, new_data[0])
 
-        self.users[user_id] = new_data[0]
+        return new_data[0]
 
-        return self.users[user_id]
+    def schedule_refresh(self, user_id):
+        self.stale.add(user_id)
+
+        if self.refresher is None:
+            self.refresher = asyncio.ensure_future(self.refresh_stale())
+
+    async def refresh_stale(self):
+        """Refresh data of users from `stale` with batched `users.get`. Users
+        that became stale during refresh are refreshed after it."""
+
+        try:
+            while self.stale:
+                await asyncio.sleep(self.refresh_delay)
+
+                stale = list(self.stale)
+                self.stale.clear()
+
+                try:
+                    await self.refresh_users(stale)
+                except Exception:
+                    self.bot.logger.error("UserMeta :: Error while refreshing users:\n" +
+                        traceback.format_exc())
+
+        finally:
+            self.refresher = None
+
+    async def refresh_users(self, user_ids):
+        for i in range(0, len(user_ids), 1000):
+            users = await self.api.users.get(user_ids=",".join(str(u) for u in
+                user_ids[i: i + 1000]), fields=self.FIELDS, _cache=False) or ()
+
+            for user in users:
+                if user["id"] in self.users:
+                    self.store(user["id"], user)
+                    self.refreshes += 1
 
     def create_refresh(self, user_id):
         async def func():
@@ -44,6 +142,8 @@ class UserMetaPlugin(BasePlugin):
         return func
 
     async def global_before_message_checks(self, msg):
+        msg.meta["users_cache"] = self
+
         info = await self.update_user_info(msg.user_id)
 
         if info:
@@ -51,6 +151,8 @@ class UserMetaPlugin(BasePlugin):
             msg.meta["user_info"] = {"raw": info}
 
     async def global_before_event_checks(self, evnt):
+        evnt.meta["users_cache"] = self
+
         if not hasattr(evnt, "user_id"):
             return
 
@@ -18,3 +18,6 @@ if __name__ == "__main__":
     # bot.longpoll_run()
     # bot.bots_longpoll_run()
     # bot.callback_run()
+
+    # Or process messages with several processes (see `sharding.py`):
+    # bot = sharding.ShardedBot(BotSettings, workers=4)
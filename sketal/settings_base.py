@@ -19,5 +19,30 @@ class BaseSettings:
     DEFAULTS["PREFIXES_STRICT"] = False
     DEFAULTS["ADMINS"] = DEFAULT_ADMINS = ()  # (admin_id_1,) !Comma is required even if only element
 
+    # Limits of requests to vk per second for every token
+    USER_REQUESTS_PER_SECOND = 3
+    GROUP_REQUESTS_PER_SECOND = 20
+    BALANCE_REQUESTS = False  # Spread requests between tokens from `USERS` of the same user or group
+    REQUESTS_CACHE_SIZE = 10000  # Amount of cached results of read-only methods (0 - disable cache)
+
+    # Dispatching of messages and events
+    DISPATCHER_TASKS = 32  # Maximum amount of messages and events processed at the same time
+    DISPATCHER_PENDING = 1000  # Maximum amount of messages and events waiting for processing
+
+    # Shared sessions for requests from plugins and uploads
+    HTTP_LIMIT = 100  # Maximum amount of open connections
+    HTTP_LIMIT_PER_HOST = 10  # Maximum amount of open connections to one host
+    HTTP_TIMEOUT = 60  # Timeout of request in seconds
+
+    # Long polling
+    LONGPOLL_CHECKPOINT = "longpoll_checkpoint.json"  # File with positions of long polls, updates received while bot was off are processed after restart ("" - disable)
+    LONGPOLL_CATCHUP_RATE = 20  # Maximum amount of lost messages processed per second
+    LONGPOLL_CATCHUP_LIMIT = 1000  # Maximum amount of lost messages processed after restart or failure
+
+    # Callback API
+    CALLBACK_BUFFER = 10000  # Maximum amount of received events waiting for processing (vk sends other events again later)
+    CALLBACK_SEEN = 10000  # Amount of last events' ids remembered for skipping repeated events
+    CALLBACK_REUSE_PORT = False  # Allow several bot processes to listen on the same port (SO_REUSEPORT)
+
     # Plugins
     PLUGINS = ()
@@ -0,0 +1,457 @@
+"""Multi-process mode: main process receives updates (long poll or callback
+api) and sends them to worker processes. Updates are sharded by peer_id, so
+every chat is processed by the same worker. Workers execute vk methods
+through main process's `VkController`, so requests from all workers share
+the same queues and rate limits. Updates and methods are sent through
+separate connections, so results of methods are received even when worker
+doesn't accept new updates.
+
+Usage:
+>>> bot = ShardedBot(BotSettings, workers=4)
+>>> bot.longpoll_run()
+
+Keep in mind, that plugins's data is stored in every worker separately. Use
+`StoragePlugin` with MongoDB instead of `in_memory` storage."""
+
+import asyncio, itertools, logging, multiprocessing, pickle, socket, struct, traceback
+
+from collections import OrderedDict
+
+from bot import Bot
+from utils import VkController
+
+
+HEADER = struct.Struct("!I")
+
+
+class Connection:
+    """Sends and receives python objects through asyncio's streams."""
+
+    __slots__ = ("reader", "writer")
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @staticmethod
+    async def create(sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+
+        return Connection(reader, writer)
+
+    async def send(self, *data):
+        body = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+        self.writer.write(HEADER.pack(len(body)) + body)
+
+        await self.writer.drain()
+
+    async def receive(self):
+        length, = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+
+        return pickle.loads(await self.reader.readexactly(length))
+
+    def close(self):
+        self.writer.close()
+
+
+class RemoteVkClient:
+    """Information about main process's `VkClient`."""
+
+    __slots__ = ("user_id", "group_id")
+
+    def __init__(self, user_id, group_id):
+        self.user_id = user_id
+        self.group_id = group_id
+
+    def __str__(self):
+        return f"Group ({self.group_id})" if self.group_id else f"User ({self.user_id})"
+
+
+class RemoteVkController(VkController):
+    """`VkController` for workers. Methods are executed by main process."""
+
+    __slots__ = ("connection", "futures", "counter")
+
+    def __init__(self, connection, clients, logger=None, loop=None):
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.Logger("vk_controller")
+
+        if loop:
+            self.loop = loop
+        else:
+            self.loop = asyncio.get_event_loop()
+
+        self.settings = None
+        self.scope = None
+        self.app_id = None
+        self.proxies = ()
+        self.users_data = ()
+        self.solver = None
+
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        self.inflight = {}
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_coalesced = 0
+
+        self.connection = connection
+        self.futures = {}
+        self.counter = itertools.count(1)
+
+        self.set_clients(clients)
+
+    def set_clients(self, clients):
+        """Set clients information received from main process"""
+
+        self.target_client = clients["target_client"]
+        self.group = clients["group"]
+
+        self.balance = clients["balance"]
+        self.balance_counter = 0
+
+        self.vk_users = [RemoteVkClient(*c) for c in clients["users"]]
+        self.vk_groups = [RemoteVkClient(*c) for c in clients["groups"]]
+
+    def get_least_loaded(self, key, clients):
+        return clients[0]
+
+    async def request(self, *data, wait="yes"):
+        if wait == "no":
+            await self.connection.send(None, *data)
+            return {}
+
+        request_id = next(self.counter)
+
+        future = self.futures[request_id] = asyncio.Future(loop=self.loop)
+
+        await self.connection.send(request_id, *data)
+
+        if wait == "yes":
+            try:
+                return await asyncio.wait_for(future, 90)
+
+            except asyncio.CancelledError:
+                return {}
+
+            except Exception:
+                traceback.print_exc()
+
+                return {}
+
+            finally:
+                self.futures.pop(request_id, None)
+
+        return future
+
+    def set_result(self, request_id, result):
+        future = self.futures.pop(request_id, None)
+
+        if future and not future.done():
+            future.set_result(result)
+
+    async def method(self, key, data=None, sender=None, wait="yes"):
+        if sender is None:
+            sender = self.get_default_sender(key)
+
+        return await self.request("method", key, data, sender, wait=wait)
+
+    async def method_accumulative(self, key, stable_data=None, data=None, join_func=None,
+                                  sender=None, wait="yes"):
+        if join_func:
+            raise ValueError("`join_func` can't be used in workers")
+
+        if sender is None:
+            sender = self.get_default_sender(key)
+
+        return await self.request("method_accumulative", key, stable_data, data,
+            sender, wait=wait)
+
+    async def stop(self):
+        for future in self.futures.values():
+            future.cancel()
+
+        self.futures.clear()
+
+
+class Worker:
+    """Process with bot that processes updates from main process."""
+
+    __slots__ = ("settings", "index", "sock", "api_sock", "loop", "connection",
+                 "api_connection", "bot", "updates")
+
+    def __init__(self, settings, index, sock, api_sock):
+        self.settings = settings
+        self.index = index
+        self.sock = sock
+        self.api_sock = api_sock
+
+        self.loop = None
+        self.connection = None
+        self.api_connection = None
+        self.bot = None
+        self.updates = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.connection = self.loop.run_until_complete(Connection.create(self.sock))
+        self.api_connection = self.loop.run_until_complete(Connection.create(self.api_sock))
+
+        _, command, clients = self.loop.run_until_complete(self.connection.receive())
+
+        if command != "init":
+            return
+
+        api = RemoteVkController(self.api_connection, clients, loop=self.loop)
+
+        self.bot = Bot(self.settings, loop=self.loop, api=api)
+        api.logger = self.bot.logger
+
+        self.bot.logger.info(f"Worker #{self.index} started")
+
+        try:
+            self.loop.run_until_complete(self.process())
+
+        except (KeyboardInterrupt, SystemExit):
+            pass
+
+        finally:
+            self.loop.run_until_complete(self.bot.stop())
+
+    async def process(self):
+        """Receive updates from main process. Updates are processed by
+        `consume`, no more than `DISPATCHER_PENDING` updates are waiting for
+        it. Results of methods are received by `receive_results`, so they are
+        received even if dispatcher is full (and is waiting for them)."""
+
+        self.updates = asyncio.Queue(maxsize=self.settings.DISPATCHER_PENDING)
+
+        tasks = (asyncio.ensure_future(self.consume(), loop=self.loop),
+                 asyncio.ensure_future(self.receive_results(), loop=self.loop))
+
+        try:
+            while True:
+                try:
+                    _, command, *data = await self.connection.receive()
+                except asyncio.IncompleteReadError:
+                    return
+
+                if command in ("longpoll", "bots"):
+                    await self.updates.put((command, data[0]))
+
+                elif command == "stop":
+                    return
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def receive_results(self):
+        while True:
+            try:
+                request_id, command, *data = await self.api_connection.receive()
+            except asyncio.IncompleteReadError:
+                return
+
+            if command == "result":
+                self.bot.api.set_result(request_id, data[0])
+
+    async def consume(self):
+        while True:
+            command, update = await self.updates.get()
+
+            try:
+                if command == "longpoll":
+                    await self.bot.process_longpoll_event(update)
+                else:
+                    await self.bot.process_bots_longpoll_event(update)
+
+            except Exception:
+                self.bot.logger.error("Error while processing update:\n" + traceback.format_exc())
+
+
+def run_worker(settings, index, sock, api_sock):
+    Worker(settings, index, sock, api_sock).run()
+
+
+class Shards:
+    """Worker processes of main process. Used by `ShardedBot` as handler."""
+
+    __slots__ = ("bot", "processes", "sockets", "connections", "api_connections", "tasks")
+
+    def __init__(self, settings, workers):
+        context = multiprocessing.get_context("fork")
+
+        self.bot = None
+
+        self.processes = []
+        self.sockets = []
+        self.connections = []
+        self.api_connections = []
+        self.tasks = []
+
+        for i in range(workers):
+            sock, worker_sock = socket.socketpair()
+            api_sock, worker_api_sock = socket.socketpair()
+
+            process = context.Process(target=run_worker,
+                args=(settings, i, worker_sock, worker_api_sock), daemon=True)
+            process.start()
+
+            worker_sock.close()
+            worker_api_sock.close()
+
+            self.processes.append(process)
+            self.sockets.append((sock, api_sock))
+
+    def set_up(self, bot):
+        self.bot = bot
+        self.bot.coroutine_exec(self.connect())
+
+    async def connect(self):
+        api = self.bot.api
+
+        clients = {
+            "target_client": api.target_client,
+            "group": api.group,
+            "balance": api.balance,
+            "users": [(c.user_id, c.group_id) for c in api.vk_users],
+            "groups": [(c.user_id, c.group_id) for c in api.vk_groups],
+        }
+
+        for sock, api_sock in self.sockets:
+            connection = await Connection.create(sock)
+            api_connection = await Connection.create(api_sock)
+
+            await connection.send(None, "init", clients)
+
+            self.connections.append(connection)
+            self.api_connections.append(api_connection)
+            self.tasks.append(asyncio.ensure_future(self.serve(api_connection),
+                loop=self.bot.loop))
+
+    def get_connection(self, peer_id):
+        return self.connections[(peer_id or 0) % len(self.connections)]
+
+    async def dispatch(self, command, peer_id, update):
+        await self.get_connection(peer_id).send(None, command, update)
+
+    async def serve(self, connection):
+        """Execute vk methods requested by worker"""
+
+        while True:
+            try:
+                request = await connection.receive()
+            except asyncio.IncompleteReadError:
+                return
+
+            asyncio.ensure_future(self.execute(connection, *request), loop=self.bot.loop)
+
+    async def execute(self, connection, request_id, command, key, *data):
+        if command == "method":
+            result = await self.bot.api.method(key, *data)
+
+        elif command == "method_accumulative":
+            stable_data, data, sender = data
+            result = await self.bot.api.method_accumulative(key, stable_data, data,
+                sender=sender)
+
+        else:
+            return
+
+        if request_id is not None:
+            await connection.send(request_id, "result", result)
+
+    async def stop(self):
+        for connection in self.connections:
+            try:
+                await connection.send(None, "stop")
+            except ConnectionError:
+                pass
+
+        for task in self.tasks:
+            task.cancel()
+
+        for process in self.processes:
+            await self.bot.loop.run_in_executor(None, process.join, 10)
+
+            if process.is_alive():
+                process.terminate()
+
+        for connection in self.connections + self.api_connections:
+            connection.close()
+
+
+def get_longpoll_peer_id(event):
+    """Returns peer_id for event from long poll (https://vk.com/dev/using_longpoll_2)"""
+
+    if len(event) < 2:
+        return 0
+
+    if event[0] in (1, 2, 3, 4, 5) and len(event) > 3:
+        return event[3]
+
+    if event[0] in (51, 63, 64):
+        return event[1] + 2000000000
+
+    if event[0] == 52 and len(event) > 2:
+        return event[2]
+
+    if event[0] == 62 and len(event) > 2:
+        return event[2] + 2000000000
+
+    return event[1]
+
+
+def get_bots_longpoll_peer_id(event):
+    """Returns peer_id for event from bots long poll or callback api"""
+
+    obj = event.get("object")
+
+    if not isinstance(obj, dict):
+        return 0
+
+    if obj.get("peer_id"):
+        return obj["peer_id"]
+
+    if obj.get("chat_id"):
+        return int(obj["chat_id"]) + 2000000000
+
+    return obj.get("user_id") or obj.get("from_id") or 0
+
+
+class ShardedBot(Bot):
+    """Bot that receives updates and processes them with `workers` worker
+    processes."""
+
+    __slots__ = ("shards",)
+
+    def __init__(self, settings, workers=2, logger=None, loop=None):
+        self.shards = Shards(settings, workers)
+
+        super().__init__(settings, logger=logger, handler=self.shards, loop=loop)
+
+        self.shards.set_up(self)
+
+    async def process_longpoll_event(self, new_event):
+        if not new_event:
+            return
+
+        if new_event[0] == 4 and len(new_event) > 1 and self.is_received(new_event[1]):
+            return
+
+        await self.shards.dispatch("longpoll", int(get_longpoll_peer_id(new_event)), new_event)
+
+    async def process_bots_longpoll_event(self, event):
+        if "type" not in event or "object" not in event:
+            return
+
+        await self.shards.dispatch("bots", int(get_bots_longpoll_peer_id(event)), event)
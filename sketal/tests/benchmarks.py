@@ -0,0 +1,1306 @@
+"""Benchmarks for bot's internals. Usage: `python tests/benchmarks.py [name ...]`.
+VK isn't accessed: all methods are answered with empty responses."""
+
+import sys, os
+sys.path.append(os.path.abspath("."))
+
+import asyncio, gc, json, logging, random, tempfile, time, tracemalloc
+
+from collections import OrderedDict
+
+from aiohttp import ClientSession, web
+
+from handler.handler_controller import MessageHandler
+from utils import Message, MessageEventData, Sender, Request, RequestsQueue, VkController, \
+    VkClient, HttpSessions, LongPoll, CallbackReceiver, Dispatcher, MSG_OUTBOX, \
+    json_iter_parse
+
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def measure(title, amount, func, *args):
+    start = time.perf_counter()
+    func(*args)
+    spent = time.perf_counter() - start
+
+    print(f"{title}: {amount / spent:.0f} per second ({spent:.3f}s for {amount})")
+
+    return spent
+
+
+class EmptyApi:
+    """Answers every vk method with empty response."""
+
+    class Client:
+        group_id = 1
+        user_id = 0
+
+    def __init__(self):
+        self.calls = 0
+
+        self.target_client = Sender(group=True, target=0)
+        self.vk_groups = [self.Client()]
+        self.vk_users = []
+
+    async def method(self, key, data=None, sender=None, wait="yes"):
+        self.calls += 1
+        return {}
+
+    def __call__(self, sender=None, wait="yes"):
+        return self
+
+    class Section:
+        def __init__(self, api, outer_name):
+            self.api = api
+            self.outer_name = outer_name
+
+        def __getattr__(self, inner_name):
+            async def wrapper(**data):
+                return await self.api.method(f"{self.outer_name}.{inner_name}", data)
+
+            return wrapper
+
+    def __getattr__(self, outer_name):
+        return self.Section(self, outer_name)
+
+    def get_current_id(self):
+        return 1
+
+    def get_default_sender(self, key):
+        return None
+
+
+class BenchmarkBot:
+    """Bot's parts required by plugins and handler."""
+
+    def __init__(self, plugins, handler_class=MessageHandler):
+        class Settings:
+            PLUGINS = plugins
+            READ_OUT = False
+            DEBUG = False
+
+        self.settings = Settings
+        self.loop = asyncio.new_event_loop()
+        self.logger = logging.Logger("benchmark", level=logging.ERROR)
+        self.api = EmptyApi()
+        self.handler = handler_class(self, self.api)
+
+    def coroutine_exec(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+def all_plugins():
+    """Instances of all plugins from `plugins` that can be created with
+    default arguments (except plugins that answer to every message)."""
+
+    import plugins
+
+    plugins.DEFAULTS.setdefault("PREFIXES", ("/",))
+    plugins.DEFAULTS.setdefault("ADMINS", ())
+
+    skip = ("EchoPlugin", "DialogflowPlugin", "TinyDBPlugin", "StoragePlugin")
+
+    result = [plugins.StoragePlugin(in_memory=True)]
+
+    for name in plugins.__all__:
+        if name in skip or not name.endswith("Plugin"):
+            continue
+
+        try:
+            result.append(getattr(plugins, name)())
+        except Exception:
+            pass
+
+    return result
+
+
+def messages(amount, texts=("привет, как дела?", "/о боте", "/неизвестная команда")):
+    result = []
+
+    for i in range(amount):
+        body = {"id": i, "date": 0, "user_id": i + 2,
+            "body": texts[i % len(texts)], "out": 0}
+
+        if i % 2:
+            body["chat_id"] = i % 10 + 1
+
+        result.append(Message(None, MessageEventData.from_message_body(body)))
+
+    return result
+
+
+class LegacyMessageHandler(MessageHandler):
+    """Handler that calls every plugin for every hook and check."""
+
+    async def core_process(self, msg):
+        for plugin in sorted(self.plugins, key=lambda x: x.order[0]):
+            if await plugin.global_before_message_checks(msg) is False:
+                return None
+
+        for plugin in self.plugins:
+            if await plugin.check_message(msg):
+                subres = await self.process_with_plugin(msg, plugin)
+
+                if subres is not False:
+                    return subres
+
+    async def process_with_plugin(self, msg, plugin):
+        for p in self.plugins:
+            if await p.global_before_message(msg, plugin) is False:
+                return
+
+        result = await plugin.process_message(msg)
+
+        for p in self.plugins:
+            await p.global_after_message(msg, plugin, result)
+
+        return result
+
+    async def process(self, msg):
+        res = await self.core_process(msg)
+
+        for plugin in sorted(self.plugins, key=lambda x: x.order[-1]):
+            if await plugin.global_after_message_process(msg, res) is False:
+                break
+
+
+@benchmark
+def handler(amount=20000):
+    """Messages per second processed by handler with all plugins."""
+
+    for title, handler_class in (("Before (every plugin)", LegacyMessageHandler),
+                                 ("After (hooks and commands index)", MessageHandler)):
+        bot = BenchmarkBot(all_plugins(), handler_class)
+        targets = messages(amount)
+
+        for msg in targets:
+            msg.api = bot.api
+
+        async def work():
+            for msg in targets:
+                await bot.handler.process(msg)
+
+        print(f"Plugins loaded: {len(bot.handler.plugins)}")
+        measure(title, amount, bot.coroutine_exec, work())
+
+        bot.loop.close()
+
+
+class LegacyRequestsQueue(RequestsQueue):
+    """Queue that checks for requests with fixed delays."""
+
+    __slots__ = ()
+
+    async def queue_processor(self):
+        while True:
+            if self.requests and self.requests_done <= 2:
+                self.take()
+                await self.execute_queue()
+
+            if not self.requests:
+                await asyncio.sleep(0.44)
+
+            await asyncio.sleep(0.34)
+
+
+class DelayedClient:
+    """Client that answers `execute` after `delay` seconds."""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+
+    async def execute(self, code):
+        await asyncio.sleep(self.delay)
+        return [1] * code.count("API.")
+
+
+@benchmark
+def requests_queue(loads=((60, 0.1), (20, 0.5))):
+    """Time from enqueuing request to result with 3 requests per second."""
+
+    for amount, interval in loads:
+        print(f"{amount} requests with average interval {interval}s:")
+
+        for title, queue_class in (("Before (fixed delays)", LegacyRequestsQueue),
+                                   ("After (token bucket)", RequestsQueue)):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+
+            random.seed(0)
+
+            async def work():
+                queue = queue_class(DelayedClient(), rate=3)
+
+                tasks = []
+
+                for i in range(amount):
+                    tasks.append(await queue.enqueue(Request("users.get", {"user_ids": i})))
+                    await asyncio.sleep(random.expovariate(1 / interval))
+
+                await asyncio.gather(*tasks)
+
+                queue.processor.cancel()
+
+                return queue
+
+            queue = loop.run_until_complete(work())
+            loop.close()
+
+            print(f"{title}: p50 {queue.latency(50):.3f}s, p99 {queue.latency(99):.3f}s")
+
+
+@benchmark
+def balanced_clients(amount=5000, rate=20):
+    """Requests per second executed with several group tokens."""
+
+    for clients_amount in (1, 2, 4):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        api = VkController.__new__(VkController)
+        api.group = True
+        api.balance = True
+        api.balance_counter = 0
+        api.cache = OrderedDict()
+        api.cache_size = 0
+        api.inflight = {}
+        api.cache_hits = api.cache_misses = api.cache_coalesced = 0
+        api.logger = logging.Logger("benchmark")
+        api.vk_users = []
+        api.vk_groups = []
+
+        for _ in range(clients_amount):
+            client = DelayedClient()
+            client.user_id = 0
+            client.group_id = 1
+            client.queue = RequestsQueue(client, rate=rate, burst=1)
+
+            api.vk_groups.append(client)
+
+        async def work():
+            await asyncio.gather(*(api.users.get(user_ids=i) for i in range(amount)))
+
+        measure(f"{clients_amount} token(s)", amount, loop.run_until_complete, work())
+
+        for client in api.vk_groups:
+            client.queue.processor.cancel()
+
+        loop.run_until_complete(asyncio.sleep(0.1))
+        loop.close()
+
+
+def large_responses():
+    """Bodies similar to vk's responses for 25 `messages.getChatUsers` with
+    fields and for `groups.getMembers` with 1000 users with fields."""
+
+    random.seed(0)
+
+    def user(i):
+        return {"id": i, "first_name": "Имя" + str(i), "last_name": "Фамилия" + str(i),
+            "sex": i % 3, "screen_name": "id" + str(i), "nickname": "",
+            "photo_100": f"https://pp.userapi.com/c{i}/v{i}/{i:x}/abcdefgh.jpg",
+            "online": i % 2, "city": {"id": i % 100, "title": "Город"},
+            "invited_by": random.randint(1, 10 ** 8)}
+
+    chat_users = {"response": [[user(i * 250 + j) for j in range(250)] for i in range(25)]}
+    members = {"response": {"count": 1000, "items": [user(i) for i in range(1000)]}}
+
+    return [json.dumps(r, ensure_ascii=False).encode("utf-8") for r in (chat_users, members)]
+
+
+class LegacyDecodingClient(VkClient):
+    """Client that decodes responses like `VkClient` did before: from text
+    and on the event loop."""
+
+    __slots__ = ()
+
+    async def decode(self, body):
+        return list(json_iter_parse(body.decode("utf-8")))
+
+
+@benchmark
+def response_decoding(amount=40):
+    """Decoding of big responses and longest pause of event loop."""
+
+    bodies = large_responses()
+
+    print("Responses: " + ", ".join(f"{len(b) / 1024 ** 2:.1f}MB" for b in bodies))
+
+    for title, client_class in (("Before (text and json_iter_parse)", LegacyDecodingClient),
+                                ("After (bytes, fast backend, executor)", VkClient)):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        client = client_class.__new__(client_class)
+        client.loop = loop
+
+        pauses = []
+
+        async def ticker():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                pauses.append(time.perf_counter() - start - 0.001)
+
+        async def work():
+            tick = asyncio.ensure_future(ticker())
+
+            for i in range(amount):
+                await client.decode(bodies[i % len(bodies)])
+                await asyncio.sleep(0.002)
+
+            tick.cancel()
+
+        measure(title, amount, loop.run_until_complete, work())
+        print(f"Longest event loop pause: {max(pauses) * 1000:.1f}ms")
+
+        loop.close()
+
+
+@benchmark
+def http_sessions(amount=500):
+    """Requests per second to local http server from plugin's code."""
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def hello(request):
+        return web.Response(body=b"x" * 1024)
+
+    app = web.Application()
+    app.router.add_get("/", hello)
+
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+
+    url = "http://127.0.0.1:{}/".format(site._server.sockets[0].getsockname()[1])
+
+    async def new_sessions():
+        for _ in range(amount):
+            async with ClientSession() as sess:
+                async with sess.get(url) as resp:
+                    await resp.read()
+
+    sessions = HttpSessions()
+
+    async def shared_session():
+        for _ in range(amount):
+            async with sessions.session.get(url) as resp:
+                await resp.read()
+
+    measure("Before (new session for every request)", amount, loop.run_until_complete,
+        new_sessions())
+    measure("After (shared session)", amount, loop.run_until_complete, shared_session())
+
+    loop.run_until_complete(sessions.close())
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+class FileStoragePlugin:
+    """`StoragePlugin` with `save_to_file` in directory `path`."""
+
+    def __new__(cls, path):
+        from plugins import StoragePlugin
+
+        class Plugin(StoragePlugin):
+            __slots__ = ()
+
+            def get_path(self, name):
+                return os.path.join(path, name)
+
+        return Plugin(in_memory=True, save_to_file=True)
+
+
+def storage_document(i):
+    return {"id": i, "stats": {"messages": i, "symbols": i * 10},
+        "nickname": "Имя" + str(i), "warnings": [], "chat_statistics": {"users": {}}}
+
+
+@benchmark
+def storage_backends(amount=20000, changed=1000):
+    """Saving and loading of users data with different storage backends."""
+
+    from plugins import StoragePlugin
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    bot = BenchmarkBot([])
+    bot.loop = loop
+
+    directory = tempfile.mkdtemp()
+
+    def prepare(plugin):
+        plugin.bot = bot
+        return plugin
+
+    async def change(plugin, ids):
+        for i in ids:
+            d = await plugin.load_user(i)
+            d["stats"]["messages"] += 1
+            await plugin.save_user(i, d)
+
+    async def fill(plugin):
+        for i in range(1, amount + 1):
+            d = await plugin.load_user(i)
+            d.update(storage_document(i))
+            await plugin.save_user(i, d)
+
+    # json file: whole storage is written on stop and read on start
+    plugin = prepare(FileStoragePlugin(directory))
+    loop.run_until_complete(fill(plugin))
+    loop.run_until_complete(change(plugin, range(1, changed + 1)))
+
+    measure(f"json file, save {changed} changed of {amount}", changed,
+        loop.run_until_complete, plugin.stop())
+    measure(f"json file, start with {amount}", amount, FileStoragePlugin, directory)
+
+    # sqlite: only changed documents are written, documents are loaded on use
+    path = os.path.join(directory, "storage.sqlite3")
+
+    plugin = prepare(StoragePlugin(sqlite=path, cache_size=amount))
+    loop.run_until_complete(fill(plugin))
+    loop.run_until_complete(plugin.flush())
+    loop.run_until_complete(change(plugin, range(1, changed + 1)))
+
+    measure(f"sqlite, save {changed} changed of {amount}", changed,
+        loop.run_until_complete, plugin.flush())
+    loop.run_until_complete(plugin.stop())
+
+    def start():
+        nonlocal plugin
+
+        plugin = prepare(StoragePlugin(sqlite=path))
+        loop.run_until_complete(plugin.load_user(amount))
+
+    measure(f"sqlite, start with {amount}", amount, start)
+    measure(f"sqlite, load {changed} documents", changed, loop.run_until_complete,
+        change(plugin, range(1, changed + 1)))
+    loop.run_until_complete(plugin.stop())
+
+    # mongodb: only if server is available
+    try:
+        import pymongo
+
+        pymongo.MongoClient(serverSelectionTimeoutMS=300).server_info()
+    except Exception:
+        print("mongodb: skipped (server is not available)")
+    else:
+        plugin = prepare(StoragePlugin(database="sketal_benchmark", cache_size=amount))
+        loop.run_until_complete(plugin.client.drop_database("sketal_benchmark"))
+        loop.run_until_complete(fill(plugin))
+        loop.run_until_complete(plugin.flush())
+        loop.run_until_complete(change(plugin, range(1, changed + 1)))
+
+        measure(f"mongodb, save {changed} changed of {amount}", changed,
+            loop.run_until_complete, plugin.flush())
+        loop.run_until_complete(plugin.client.drop_database("sketal_benchmark"))
+
+    loop.close()
+
+
+@benchmark
+def storage_journal(amount=100000, changed=1000):
+    """Shutdown, startup and saving with `in_memory` and `save_to_file`."""
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    bot = BenchmarkBot([])
+    bot.loop = loop
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "storage.localdata.json")
+
+    plugin = FileStoragePlugin(directory)
+    plugin.bot = bot
+
+    for i in range(1, amount + 1):
+        plugin.users[i] = dict(storage_document(i), _version=0)
+
+    def legacy_stop():
+        with open(path, "w") as o:
+            json.dump((plugin.users, plugin.chats, plugin.meta), o)
+
+    def legacy_start():
+        with open(path) as o:
+            u, c, m = json.load(o)
+
+        return {int(k): v for k, v in u.items()}
+
+    measure(f"Before: stop with {amount} (json.dump)", amount, legacy_stop)
+    measure(f"Before: start with {amount} (json.load)", amount, legacy_start)
+
+    async def change():
+        for i in range(1, changed + 1):
+            d = await plugin.load_user(i)
+            d["stats"]["messages"] += 1
+            await plugin.save_user(i, d)
+
+        await plugin.flush()
+
+    pauses = []
+
+    async def compact():
+        async def ticker():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                pauses.append(time.perf_counter() - start - 0.001)
+
+        tick = asyncio.ensure_future(ticker())
+        await plugin.compact()
+        tick.cancel()
+
+    measure(f"After: save {changed} changed (journal)", changed, loop.run_until_complete,
+        change())
+    measure(f"After: snapshot with {amount} (background)", amount, loop.run_until_complete,
+        compact())
+    print(f"Longest event loop pause: {max(pauses) * 1000:.1f}ms")
+    measure(f"After: stop with {amount}", amount, loop.run_until_complete, plugin.stop())
+    measure(f"After: start with {amount} (snapshot and journal)", amount,
+        FileStoragePlugin, directory)
+
+    loop.close()
+
+
+class DelayedCollection:
+    """MongoDB's collection that answers queries after `delay` seconds."""
+
+    def __init__(self, field, delay=0.002):
+        self.field = field
+        self.delay = delay
+        self.queries = 0
+
+    async def find_one(self, query):
+        self.queries += 1
+        await asyncio.sleep(self.delay)
+
+        return {self.field: query[self.field]["$eq"], "_version": 1}
+
+    def find(self, query):
+        self.queries += 1
+
+        async def documents():
+            await asyncio.sleep(self.delay)
+
+            for xid in query[self.field]["$in"]:
+                yield {self.field: xid, "_version": 1}
+
+        return documents()
+
+
+@benchmark
+def storage_preload(amount=100, updates=20):
+    """Database queries for long poll updates with `amount` messages."""
+
+    from plugins import StoragePlugin
+
+    class LegacyStoragePlugin(StoragePlugin):
+        __slots__ = ()
+
+        async def fetch(self, name, xid):
+            return await getattr(self, name).find_one({self.get_field(name): {"$eq": xid}})
+
+    for title, plugin_class in (("Before (query for every document)", LegacyStoragePlugin),
+                                ("After (query for every collection)", StoragePlugin)):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        bot = BenchmarkBot([])
+        bot.loop = loop
+
+        plugin = plugin_class.__new__(plugin_class)
+        StoragePlugin.__init__(plugin, in_memory=True)
+        plugin.bot = bot
+        plugin.in_memory = False
+
+        for name in ("users", "chats", "meta"):
+            setattr(plugin, name, DelayedCollection(plugin.get_field(name)))
+
+        async def work():
+            for i in range(updates):
+                targets = messages(amount)
+
+                for msg in targets:
+                    msg.user_id += i * amount
+
+                await asyncio.gather(*(plugin.global_before_message_checks(msg)
+                    for msg in targets))
+
+        measure(title, amount * updates, loop.run_until_complete, work())
+
+        queries = plugin.users.queries + plugin.chats.queries + plugin.meta.queries
+        print(f"Queries: {queries} ({queries / updates:.1f} per update)")
+
+        loop.close()
+
+
+@benchmark
+def staff_checks(amount=20000, listed=10000):
+    """Messages per second checked by `StaffControlPlugin` with long lists."""
+
+    from plugins import StaffControlPlugin
+    from plugins.technical.storage import sdict
+
+    class LegacyStaffControlPlugin(StaffControlPlugin):
+        """Plugin that checks lists and copies them for every message."""
+
+        __slots__ = ()
+
+        async def global_before_message_checks(self, msg):
+            admin_lists = msg.meta["data_meta"].getraw("admin_lists")
+
+            if msg.user_id in admin_lists["banned"]:
+                return False
+
+            moders = msg.meta["data_chat"].getraw("moders")
+
+            msg.meta["is_moder"] = msg.user_id in moders
+            msg.meta["moders"] = tuple(moders)
+
+            msg.meta["is_vip"] = msg.user_id in admin_lists["vips"]
+            msg.meta["is_admin"] = msg.user_id in admin_lists["admins"]
+            msg.meta["is_admin_or_moder"] = msg.meta["is_admin"] or msg.meta["is_moder"]
+
+            msg.meta["vips"] = tuple(admin_lists["vips"])
+            msg.meta["admins"] = tuple(admin_lists["admins"])
+            msg.meta["banned"] = tuple(admin_lists["banned"])
+
+    loop = asyncio.new_event_loop()
+
+    users = list(range(-listed, 0))
+
+    meta = sdict({"admin_lists": {"banned": users, "admins": users[:listed // 10],
+        "vips": users[:listed // 10]}})
+    chat = sdict({"moders": users[:listed // 10]})
+
+    targets = messages(amount)
+
+    for msg in targets:
+        msg.meta["data_meta"] = meta
+        msg.meta["data_chat"] = chat
+
+    for title, plugin_class in (("Before (lists and copies)", LegacyStaffControlPlugin),
+                                ("After (indexed lists and views)", StaffControlPlugin)):
+        plugin = plugin_class(admins=(1,), prefixes=("/",))
+
+        async def work():
+            for msg in targets:
+                await plugin.global_before_message_checks(msg)
+
+        measure(title, amount, loop.run_until_complete, work())
+
+    loop.close()
+
+
+@benchmark
+def tinydb_users(sizes=(10000, 100000), operations=20000):
+    """`TinyDBPlugin`'s operations with users and writing to file."""
+
+    from tinydb import TinyDB, Query
+    from tinydb.storages import JSONStorage
+    from tinydb.middlewares import CachingMiddleware
+    from plugins.technical.tynydb import TinyDBPlugin
+
+    directory = tempfile.mkdtemp()
+
+    class Plugin(TinyDBPlugin):
+        __slots__ = ()
+
+        def get_path(self, name):
+            return os.path.join(directory, name)
+
+    for size in sizes:
+        print(f"{size} users:")
+
+        # Table is scanned for every operation, so there are less operations
+        legacy_operations = 1000000 // size
+
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+        # Before: queries scan table and flush writes file on event loop
+        db = TinyDB(path=os.path.join(directory, "legacy.json"),
+            storage=CachingMiddleware(JSONStorage))
+        db.insert_multiple({"user_id": i, "data": {"n": i}} for i in range(size))
+
+        def legacy():
+            for i in range(legacy_operations):
+                user = db.get(Query().user_id == i * 7)
+
+                if not db.update({"user_id": i * 7, "data": user["data"]},
+                        Query().user_id == i * 7):
+                    db.insert({"user_id": i * 7, "data": {}})
+
+        measure("Before: get_user and save_user", legacy_operations, legacy)
+        measure("Before: flush", size, db.close)
+
+        # After: index by user_id and writing in background
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        bot = BenchmarkBot([])
+        bot.loop = loop
+
+        plugin = Plugin()
+        plugin.bot = bot
+
+        for i in range(size):
+            plugin.save_user(i, {"n": i})
+
+        def current():
+            for i in range(operations):
+                plugin.save_user(i * 7 % size, plugin.get_user(i * 7 % size))
+
+        measure("After: get_user and save_user", operations, current)
+
+        pauses = []
+
+        async def flush():
+            async def ticker():
+                while True:
+                    start = time.perf_counter()
+                    await asyncio.sleep(0.001)
+                    pauses.append(time.perf_counter() - start - 0.001)
+
+            tick = asyncio.ensure_future(ticker())
+            await plugin.stop()
+            tick.cancel()
+
+        measure("After: flush (background)", size, loop.run_until_complete, flush())
+        print(f"Longest event loop pause: {max(pauses) * 1000:.1f}ms")
+
+        loop.close()
+
+
+class UsersApi(EmptyApi):
+    """Answers `users.get` with users after `delay` seconds."""
+
+    def __init__(self, delay=0.001):
+        super().__init__()
+
+        self.delay = delay
+
+    async def method(self, key, data=None, sender=None, wait="yes"):
+        self.calls += 1
+
+        await asyncio.sleep(self.delay)
+
+        return [{"id": int(u), "first_name": "Имя", "last_name": "Фамилия"}
+            for u in str(data["user_ids"]).split(",")]
+
+
+@benchmark
+def users_cache(amount=200000, users=100000, size=20000, hot=2000):
+    """Users information for messages from `users` users (`hot` users write
+    70% of messages) with `size` cached users."""
+
+    from plugins import UserMetaPlugin
+
+    class LegacyUserMetaPlugin(UserMetaPlugin):
+        """Plugin with dictionary that is randomly cleaned when it's full."""
+
+        __slots__ = ()
+
+        async def update_user_info(self, user_id, refresh=False):
+            current_data = self.users.get(user_id)
+
+            if not refresh and current_data:
+                return current_data
+
+            new_data = await self.api.users.get(user_ids=user_id,
+                fields="sex,screen_name,nickname", _cache=not refresh) or {}
+
+            if len(self.users) > self.size:
+                self.users = dict((k, v) for k, v in self.users.items()
+                    if random.random() > 0.25)
+
+            self.users[user_id] = new_data[0]
+
+            return self.users[user_id]
+
+    for title, plugin_class in (("Before (dictionary)", LegacyUserMetaPlugin),
+                                ("After (LRU with TTL)", UserMetaPlugin)):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        random.seed(0)
+
+        ids = [random.randint(1, hot) if random.random() < 0.7 else
+            random.randint(1, users) for _ in range(amount)]
+
+        plugin = plugin_class(size=size)
+        plugin.api = UsersApi(delay=0)
+        plugin.users = {} if plugin_class is LegacyUserMetaPlugin else plugin.users
+
+        longest = 0
+
+        # Objects from previous run shouldn't be collected during this run
+        gc.collect()
+
+        async def work():
+            nonlocal longest
+
+            for user_id in ids:
+                start = time.perf_counter()
+                await plugin.update_user_info(user_id)
+                longest = max(longest, time.perf_counter() - start)
+
+        measure(title, amount, loop.run_until_complete, work())
+        print(f"Requests to vk: {plugin.api.calls}, longest call: {longest * 1000:.1f}ms")
+
+        loop.run_until_complete(plugin.stop())
+        loop.close()
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+@benchmark
+def longpoll_pipeline(amount=200, batch=50, delay=0.01, cost=0.0002):
+    """Updates per second from local long poll server (`delay` seconds for
+    response, `cost` seconds to process one update)."""
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def check(request):
+        await asyncio.sleep(delay)
+
+        ts = int(request.query["ts"])
+
+        return web.json_response({"ts": ts + 1, "updates": [[4, ts * batch + i, 1, 1]
+            for i in range(batch)]})
+
+    app = web.Application()
+    app.router.add_get("/", check)
+
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+
+    url = "http://127.0.0.1:{}/".format(site._server.sockets[0].getsockname()[1])
+
+    total = amount * batch
+    processed = []
+
+    async def process(update):
+        busy(cost)
+        processed.append(update[1])
+        await asyncio.sleep(0)
+
+    async def init(pack, update=0):
+        pack[1] = url
+        pack[0]["ts"] = 1
+
+    async def legacy(session):
+        ts = 1
+
+        while len(processed) < total:
+            async with session.get(url, params={"ts": ts}) as resp:
+                events = json.loads(await resp.text())
+
+            ts = events["ts"]
+
+            for update in events["updates"]:
+                await process(update)
+
+    async def pipelined(session):
+        longpoll = LongPoll(init, process, {"wait": 25}, session)
+
+        task = asyncio.ensure_future(longpoll.run())
+
+        while len(processed) < total:
+            await asyncio.sleep(0.001)
+
+        task.cancel()
+
+        stats = longpoll.stats
+        print(f"Lag average: {stats['lag_average'] * 1000:.1f}ms, "
+              f"max: {stats['lag_max'] * 1000:.1f}ms")
+
+    async def create_session():
+        return ClientSession()
+
+    session = loop.run_until_complete(create_session())
+
+    for title, func in (("Before (poll, then process)", legacy),
+                        ("After (pipelined long poll)", pipelined)):
+        processed.clear()
+
+        measure(title, total, loop.run_until_complete, func(session))
+
+        assert processed[:total] == list(range(batch, batch + total))
+
+    loop.run_until_complete(session.close())
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+def callback_payload(i, repeated=False):
+    """Synthetic `message_new` event from Callback API"""
+
+    if repeated:
+        i -= 1
+
+    return json.dumps({"type": "message_new", "group_id": 1, "event_id": f"{i:x}",
+        "object": {"id": i, "user_id": i % 1000, "body": "привет", "date": 0,
+                   "out": 0, "read_state": 0}}).encode()
+
+
+@benchmark
+def callback_server(amount=10000, concurrency=100, delay=0.05):
+    """Load test of local Callback API server: `concurrency` clients post
+    `amount` events (every 20th is repeated), processing of event waits
+    `delay` seconds (request to vk)."""
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    payloads = [callback_payload(i, i % 20 == 19) for i in range(amount)]
+
+    async def work(data):
+        await asyncio.sleep(delay)
+
+    async def legacy_handle(request):
+        try:
+            data = await request.json()
+
+            if "type" not in data or "object" not in data:
+                raise ValueError("Damaged data received.")
+
+        except (UnicodeDecodeError, ValueError):
+            return web.Response(text="ok")
+
+        await dispatcher.dispatch(data["object"]["user_id"], work, data)
+
+        return web.Response(text="ok")
+
+    async def dispatch(data):
+        await dispatcher.dispatch(data["object"]["user_id"], work, data)
+
+    async def load(url):
+        latencies = []
+        posted = iter(payloads)
+
+        async def client(session):
+            for payload in posted:
+                start = time.perf_counter()
+
+                async with session.post(url, data=payload) as resp:
+                    await resp.read()
+
+                latencies.append(time.perf_counter() - start)
+
+        async with ClientSession() as session:
+            await asyncio.gather(*(client(session) for _ in range(concurrency)))
+
+        latencies.sort()
+        print(f"Answer time median: {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+              f"99%: {latencies[len(latencies) * 99 // 100] * 1000:.1f}ms")
+
+    for title in ("Before (answer after dispatching)", "After (answer, then process)"):
+        dispatcher = Dispatcher(tasks=32, pending=1000, loop=loop)
+
+        app = web.Application()
+
+        if title.startswith("Before"):
+            receiver = None
+            app.router.add_post("/", legacy_handle)
+        else:
+            receiver = CallbackReceiver(dispatch, loop=loop)
+            app.router.add_post("/", receiver.handle)
+
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        loop.run_until_complete(site.start())
+
+        url = "http://127.0.0.1:{}/".format(site._server.sockets[0].getsockname()[1])
+
+        if receiver:
+            consumer = loop.create_task(receiver.run())
+
+        measure(title, amount, loop.run_until_complete, load(url))
+
+        async def processing():
+            while dispatcher.depth or (receiver and receiver.buffer):
+                await asyncio.sleep(0.01)
+
+        start = time.perf_counter()
+        loop.run_until_complete(processing())
+
+        print(f"Processed events: {dispatcher.processed} "
+              f"({time.perf_counter() - start:.3f}s after last answer)")
+
+        if receiver:
+            consumer.cancel()
+
+        loop.run_until_complete(dispatcher.stop())
+        loop.run_until_complete(runner.cleanup())
+
+    loop.close()
+
+
+def longpoll_updates(amount, seed=0):
+    """Updates from user's long poll (mode 42, version 2) like recorded ones:
+    messages in dialogs and chats (some sent by bot, some with attachments
+    and forwarded messages) and other events."""
+
+    rnd = random.Random(seed)
+
+    def forwarded(depth):
+        return ",".join(f"{rnd.randint(1, 10 ** 9)}_{rnd.randint(1, 10 ** 6)}" +
+            (f":({forwarded(depth - 1)})" if depth and rnd.random() < 0.5 else "")
+            for _ in range(rnd.randint(1, 3)))
+
+    updates = []
+
+    for i in range(amount):
+        kind = rnd.random()
+
+        if kind > 0.7:
+            updates.append(rnd.choice(([6, 100, i], [7, 100, i], [8, -i, 1, 0],
+                [9, -i, 0, 0], [61, i, 1], [62, i, 1], [80, 5, 0])))
+            continue
+
+        flags = 1 | (2 if rnd.random() < 0.2 else 0)
+        attaches = {}
+        peer_id = rnd.randint(1, 10 ** 6)
+
+        if rnd.random() < 0.5:
+            attaches["from"] = str(peer_id)
+            attaches["title"] = " ... "
+            peer_id = 2000000000 + rnd.randint(1, 1000)
+
+        if rnd.random() < 0.1:
+            attaches["attach1_type"] = "photo"
+            attaches["attach1"] = "1_2"
+
+        if rnd.random() < 0.1:
+            attaches["fwd"] = forwarded(4)
+
+        updates.append([4, i, flags, peer_id, 1500000000 + i,
+            rnd.choice(("Привет", "/о боте", "Как дела?<br>Что нового?")), attaches])
+
+    return updates
+
+
+def legacy_parse_forwarded(data):
+    result = []
+
+    token = ""
+    i = -1
+    while True:
+        i += 1
+
+        if i >= len(data):
+            if token:
+                result.append((token, ()))
+
+            break
+
+        if data[i] in "1234567890_-":
+            token += data[i]
+            continue
+
+        if data[i] in (",", ")"):
+            if not token:
+                continue
+
+            result.append((token, ()))
+            token = ""
+            continue
+
+        if data[i] == ":":
+            stack = 1
+
+            for j in range(i + 2, len(data)):
+                if data[j] == "(":
+                    stack += 1
+
+                elif data[j] == ")":
+                    stack -= 1
+
+                if stack == 0:
+                    jump_to_i = j
+                    break
+
+            result.append((token, legacy_parse_forwarded(data[i + 2: jump_to_i])))
+
+            i = jump_to_i + 1
+            token = ""
+            continue
+
+    return tuple(result)
+
+
+def legacy_decode(new_event, read_out=False):
+    """Message from update as it was created by `Bot.process_longpoll_event`"""
+
+    if new_event[0] != 4:
+        return
+
+    data = MessageEventData()
+    data.msg_id = new_event[1]
+    data.attaches = new_event[6]
+    data.time = int(new_event[4])
+
+    if 'from' in data.attaches and len(new_event) > 3:
+        data.user_id = int(data.attaches.pop('from'))
+        data.chat_id = int(new_event[3]) - 2000000000
+        data.is_multichat = True
+
+    else:
+        data.user_id = int(new_event[3])
+        data.is_multichat = False
+
+    start, values = 1, []
+    for _ in range(1, 12):
+        values.append(bool(new_event[2] & start))
+        start *= 2
+
+    flags = dict(zip(('unread', 'outbox', 'replied', 'important', 'chat', 'friends',
+        'spam', 'deleted', 'fixed', 'media', 'hidden'), values))
+
+    if flags['outbox']:
+        if not read_out:
+            return
+
+        data.is_out = True
+
+    data.full_text = new_event[5].replace('<br>', '\n')
+
+    if "fwd" in data.attaches:
+        data.forwarded = legacy_parse_forwarded(data.attaches.pop("fwd"))
+    else:
+        data.forwarded = []
+
+    return Message(None, data)
+
+
+def decode(new_event, read_out=False):
+    """Message from update as it's created by `Bot.process_longpoll_event`"""
+
+    if new_event[0] != 4:
+        return
+
+    if new_event[2] & MSG_OUTBOX and not read_out:
+        return
+
+    return Message(None, MessageEventData.from_longpoll(new_event))
+
+
+@benchmark
+def longpoll_decoding(amount=200000, depth=200):
+    """Updates from long poll decoded per second."""
+
+    def run(func, updates):
+        for update in updates:
+            func(update)
+
+    for title, func in (("Before (flags dictionary, rescanning forwarded)", legacy_decode),
+                        ("After (flags bitmask, one pass forwarded)", decode)):
+        measure(title, amount, run, func, longpoll_updates(amount))
+
+    # Forwarded message with forwarded message with ... (`depth` times)
+    nested = "1_1:(" * depth + "1_1" + ")" * depth
+
+    for title, func in (("Before (deep forwarded)", legacy_parse_forwarded),
+                        ("After (deep forwarded)", MessageEventData.parse_brief_forwarded_messages_from_lp)):
+        measure(title, 200, run, func, [nested] * 200)
+
+
+class LegacyMessage(Message):
+    """Message that computes all fields when it's created."""
+
+    __slots__ = ("text", "answer_values")
+
+    def __init__(self, vk_api_object, message_data):
+        super().__init__(vk_api_object, message_data)
+
+        self.text = self.full_text.lower().replace("&quot;", "\"")
+
+        if self.is_multichat:
+            self.answer_values = {'chat_id': self.chat_id}
+        else:
+            self.answer_values = {'user_id': self.user_id}
+
+
+@benchmark
+def message_construction(amount=100000):
+    """Messages created per second (synthetic messages, most are dropped
+    before commands are checked)."""
+
+    words = ("Привет", "как", "дела", "&quot;бот&quot;", "/помощь", "что", "нового", "?")
+    rnd = random.Random(0)
+
+    data = []
+
+    for i in range(amount):
+        update = [4, i, 1, rnd.randint(1, 10 ** 6), 1500000000 + i,
+            " ".join(rnd.choice(words) for _ in range(rnd.randint(3, 40))), {}]
+
+        if rnd.random() < 0.5:
+            update[6]["from"] = str(update[3])
+            update[3] = 2000000000 + rnd.randint(1, 1000)
+
+        data.append(MessageEventData.from_longpoll(update))
+
+    def dropped(message_class):
+        # Antiflood or ban: only sender and meta are checked
+        for d in data:
+            msg = message_class(None, d)
+            msg.meta["checked"] = msg.user_id
+
+    def checked(message_class):
+        for d in data:
+            msg = message_class(None, d)
+
+            if msg.text.startswith("/"):
+                msg.answer_values
+
+    def memory(message_class):
+        gc.collect()
+        tracemalloc.start()
+
+        messages = [message_class(None, d) for d in data]
+
+        for msg in messages:
+            msg.meta["checked"] = msg.user_id
+
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        return size / len(messages)
+
+    for title, message_class in (("Before (all fields computed)", LegacyMessage),
+                                 ("After (fields computed on access)", Message)):
+        gc.collect()
+        measure(title + ", dropped", amount, dropped, message_class)
+        measure(title + ", checked", amount, checked, message_class)
+        print(f"Memory per message in flight: {memory(message_class):.0f} bytes")
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"# {name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name]()
+        print()
@@ -31,6 +31,8 @@ utils.parse_user_id = parse_user_id
 
 
 from bot import Bot
+from handler.base_plugin import CommandPlugin
+from handler.commands_index import CommandsIndex
 from plugins import *
 from utils import *
 
@@ -219,6 +221,123 @@ class TestSketal(unittest.TestCase):
 
         self.bot.coroutine_exec(work())
 
+class MemoryCollection:
+    """MongoDB's collection in memory with queries and updates used by
+    plugins (top level fields in queries, `bulk_write`)."""
+
+    class Cursor:
+        def __init__(self, documents):
+            self.documents = documents
+
+        def sort(self, keys):
+            for key, direction in reversed(keys):
+                self.documents.sort(key=lambda d: d.get(key), reverse=direction < 0)
+
+            return self
+
+        def limit(self, amount):
+            self.documents = self.documents[:amount]
+            return self
+
+        async def __aiter__(self):
+            for d in self.documents:
+                yield d
+
+    class Result:
+        def __init__(self):
+            self.matched_count = 0
+            self.upserted_count = 0
+
+    def __init__(self):
+        self.documents = []
+        self.queries = 0
+
+    @staticmethod
+    def matches(d, query):
+        for key, condition in query.items():
+            value = d.get(key)
+
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+
+            if "$eq" in condition and value != condition["$eq"]:
+                return False
+
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+
+        return True
+
+    @staticmethod
+    def apply(d, update):
+        for operator, fields in update.items():
+            for path, value in fields.items():
+                *parents, key = path.split(".")
+
+                target = d
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+
+                if operator == "$set":
+                    target[key] = copy_data(value)
+                elif operator == "$unset":
+                    target.pop(key, None)
+                elif operator == "$inc":
+                    target[key] = target.get(key, 0) + value
+                elif operator == "$max":
+                    target[key] = max(target.get(key, value), value)
+                elif operator == "$push":
+                    target.setdefault(key, []).extend(value["$each"])
+
+    def find(self, query, projection=None):
+        self.queries += 1
+
+        found = [copy_data(d) for d in self.documents if self.matches(d, query)]
+
+        if projection:
+            found = [{k: v for k, v in d.items() if k in projection or k == "_id"}
+                     for d in found]
+
+        return self.Cursor(found)
+
+    async def create_index(self, keys, **kwargs):
+        pass
+
+    async def bulk_write(self, requests, ordered=True):
+        from bson import ObjectId
+        from pymongo import InsertOne, ReplaceOne
+
+        result = self.Result()
+
+        for request in requests:
+            if isinstance(request, InsertOne):
+                request._doc.setdefault("_id", ObjectId())
+                self.documents.append(copy_data(request._doc))
+                continue
+
+            found = [d for d in self.documents if self.matches(d, request._filter)]
+
+            if found:
+                result.matched_count += 1
+
+                if isinstance(request, ReplaceOne):
+                    found[0].clear()
+                    found[0].update(copy_data(request._doc))
+                else:
+                    self.apply(found[0], request._doc)
+
+            elif request._upsert:
+                d = {"_id": ObjectId()}
+                d.update({k: v for k, v in request._filter.items() if not isinstance(v, dict)})
+
+                self.apply(d, request._doc)
+                self.documents.append(d)
+
+                result.upserted_count += 1
+
+        return result
+
+
 class TestSketalUtils(unittest.TestCase):
     def check(self, message):
         self.assertLessEqual(len(message), MAX_LENGHT)
@@ -241,6 +360,1091 @@ class TestSketalUtils(unittest.TestCase):
         self.assertTrue(a['outbox'])
         self.assertFalse(a['hidden'])
 
+    def test_longpoll_message(self):
+        data = MessageEventData.from_longpoll([4, 10, 1, 2000000005, 1500000000, "a<br>b",
+            {"from": "7", "fwd": "1_1:(2_2,3_3:(4_4)),5_5"}])
+
+        self.assertEqual((data.user_id, data.chat_id, data.is_multichat, data.is_out),
+            (7, 5, True, False))
+        self.assertEqual(data.full_text, "a\nb")
+        self.assertEqual(data.forwarded, (("1_1", (("2_2", ()), ("3_3", (("4_4", ()),)))),
+            ("5_5", ())))
+
+        msg = Message(None, MessageEventData.from_longpoll([4, 11, 1, 7, 1500000000,
+            "Hi &quot;Bot&quot;", {}]))
+
+        self.assertEqual(msg.text, 'hi "bot"')
+        self.assertEqual(msg.answer_values, {"user_id": 7})
+
+    def test_commands_index(self):
+        about = CommandPlugin("о боте", prefixes=("/",))
+        control = CommandPlugin("контроль", "контроль список", prefixes=("/",))
+        echo = EchoPlugin()
+
+        index = CommandsIndex((about, control, echo))
+
+        self.assertEqual(index.indexed, {about, control})
+        self.assertEqual(index.lookup("О боте"), {about})
+        self.assertEqual(index.lookup("контроль\nсписок"), {control})
+        self.assertEqual(index.lookup("ботик"), set())
+
+    def test_dispatcher(self):
+        loop = asyncio.new_event_loop()
+        dispatcher = Dispatcher(tasks=2, pending=4, loop=loop)
+
+        order = []
+
+        async def work(key, i):
+            await asyncio.sleep(0.01 * (3 - i))
+            order.append((key, i))
+
+        async def dispatch():
+            for i in range(3):
+                for key in (1, 2, 3):
+                    await dispatcher.dispatch(key, work, key, i)
+
+            while dispatcher.depth:
+                await asyncio.sleep(0.01)
+
+        loop.run_until_complete(dispatch())
+        loop.run_until_complete(dispatcher.stop())
+        loop.close()
+
+        self.assertEqual(dispatcher.processed, 9)
+
+        for key in (1, 2, 3):
+            self.assertEqual([i for k, i in order if k == key], [0, 1, 2])
+
+    def test_dispatcher_restart(self):
+        loop = asyncio.new_event_loop()
+        dispatcher = Dispatcher(tasks=1, loop=loop)
+
+        done = []
+
+        async def work(i):
+            await asyncio.sleep(0.01)
+            done.append(i)
+
+        async def dispatch(*items):
+            for i in items:
+                await dispatcher.dispatch(1, work, i)
+
+            while dispatcher.depth:
+                await asyncio.sleep(0.01)
+
+        loop.run_until_complete(dispatcher.dispatch(1, work, 0))
+        loop.run_until_complete(dispatcher.dispatch(1, work, 1))
+        loop.run_until_complete(dispatcher.stop())
+
+        self.assertEqual(dispatcher.depth, 0)
+
+        loop.run_until_complete(asyncio.wait_for(dispatch(2, 3), 1))
+        loop.run_until_complete(dispatcher.stop())
+        loop.close()
+
+        self.assertEqual(done, [2, 3])
+
+    def test_worker_results(self):
+        from sharding import Worker
+
+        loop = asyncio.new_event_loop()
+        updates, results = asyncio.Queue(), asyncio.Queue()
+        processed = []
+
+        class Connection:
+            def __init__(self, messages):
+                self.messages = messages
+
+            async def receive(self):
+                return await self.messages.get()
+
+        class Settings:
+            DISPATCHER_PENDING = 1
+
+        class Api:
+            futures = {}
+
+            def set_result(self, request_id, result):
+                self.futures.pop(request_id).set_result(result)
+
+        class WorkerBot:
+            api = Api()
+            logger = logging.Logger("worker")
+            dispatcher = Dispatcher(tasks=1, pending=1, loop=loop)
+
+            async def handle(self, update):
+                future = self.api.futures[update] = asyncio.Future()
+                processed.append(await future)
+
+            async def process_longpoll_event(self, update):
+                await self.dispatcher.dispatch(update, self.handle, update)
+
+        worker = Worker(Settings, 0, None, None)
+        worker.loop, worker.bot = loop, WorkerBot()
+        worker.connection, worker.api_connection = Connection(updates), Connection(results)
+
+        async def feed():
+            # Dispatcher and worker's queue are full, so last updates aren't read
+            for i in range(6):
+                await updates.put((None, "longpoll", i))
+
+            while 0 not in worker.bot.api.futures:
+                await asyncio.sleep(0.01)
+
+            await asyncio.sleep(0.05)
+            self.assertGreater(updates.qsize(), 0)
+
+            for i in range(6):
+                while i not in worker.bot.api.futures:
+                    await asyncio.sleep(0.01)
+
+                await results.put((i, "result", i))
+
+            await updates.put((None, "stop"))
+
+        async def run():
+            await asyncio.gather(worker.process(), feed())
+
+        loop.run_until_complete(asyncio.wait_for(run(), 2))
+        loop.run_until_complete(worker.bot.dispatcher.stop())
+        loop.close()
+
+        self.assertEqual(processed, list(range(6)))
+
+    def test_requests_queue_tokens(self):
+        from unittest import mock
+        import aiohttp
+
+        loop = asyncio.new_event_loop()
+        now = [1000.0]
+
+        class Client:
+            calls = 0
+            session = None
+
+            async def execute(self, code):
+                self.calls += 1
+
+                if self.calls == 1:
+                    raise aiohttp.ClientOSError()
+
+                return [{"id": 1}]
+
+            async def close(self):
+                pass
+
+        client = Client()
+
+        async def work():
+            queue = RequestsQueue(client, rate=100, burst=4)
+
+            # Burst is spent at once and refilled with `rate` tokens per second
+            for _ in range(4):
+                queue.take()
+
+            self.assertEqual(queue.tokens, 0)
+
+            now[0] += 0.02
+            queue.refill()
+            self.assertAlmostEqual(queue.tokens, 2)
+
+            now[0] += 10
+            queue.refill()
+            self.assertEqual(queue.tokens, 4)
+
+            for _ in range(4):
+                queue.take()
+
+            # Waiting is blocked until token is refilled
+            waiting = asyncio.ensure_future(queue.wait_request())
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiting.done())
+
+            now[0] += 0.02
+            await asyncio.wait_for(waiting, 1)
+
+            # Retry of failed execute waits for token too
+            queue.take()
+
+            request = Request("users.get", {"user_ids": 1})
+            executing = asyncio.ensure_future(queue.execute_queue([request]))
+            await asyncio.sleep(0.05)
+            self.assertEqual(client.calls, 1)
+            self.assertFalse(executing.done())
+
+            now[0] += 0.02
+            await asyncio.wait_for(executing, 1)
+            self.assertEqual(client.calls, 2)
+            self.assertEqual(request.result(), {"id": 1})
+
+            queue.processor.cancel()
+            await client.session.close()
+
+        with mock.patch("utils.api.time", mock.Mock(time=lambda: now[0])):
+            loop.run_until_complete(work())
+
+        loop.close()
+
+    def test_balanced_clients(self):
+        class Queue:
+            def __init__(self, load):
+                self.load = load
+
+        class Client:
+            def __init__(self, user_id, group_id, load):
+                self.user_id, self.group_id = user_id, group_id
+                self.queue = Queue(load)
+
+        api = VkController.__new__(VkController)
+        api.balance = True
+        api.balance_counter = 0
+
+        first, second, other = Client(0, 1, 1), Client(0, 1, 0.5), Client(0, 2, 0)
+        api.vk_users, api.vk_groups = [], [first, second, other]
+
+        # Clients of other group are never used, even for public methods
+        for key in ("messages.send", "users.get", "account.getInfo"):
+            self.assertIs(api.get_current_sender(key, Sender(group=True)), second)
+
+        self.assertIs(api.get_current_sender("users.get", Sender(group=True, target=2)), other)
+
+        # Equally loaded clients are used in turn
+        second.queue.load = 1
+        chosen = {api.get_current_sender("users.get", Sender(group=True)) for _ in range(2)}
+        self.assertEqual(chosen, {first, second})
+
+    def test_method_cache(self):
+        from collections import OrderedDict
+        from unittest import mock
+
+        loop = asyncio.new_event_loop()
+        now = [1000.0]
+        requests = []
+
+        class Queue:
+            async def enqueue(self, request):
+                requests.append(request)
+                return request
+
+        class Client:
+            user_id, group_id = 0, 1
+            queue = Queue()
+
+        api = VkController.__new__(VkController)
+        api.logger = logging.Logger("vk_controller")
+        api.balance, api.group = False, True
+        api.vk_users, api.vk_groups = [], [Client()]
+        api.cache, api.cache_size, api.inflight = OrderedDict(), 2, {}
+        api.cache_hits = api.cache_misses = api.cache_coalesced = 0
+
+        async def call(user_id, times=1, error=None):
+            """Returns results of `times` identical calls and amount of
+            requests made for them"""
+
+            before = len(requests)
+
+            tasks = [asyncio.ensure_future(api.method("users.get", {"user_ids": user_id}))
+                     for _ in range(times)]
+            await asyncio.sleep(0.01)
+
+            for request in requests[before:]:
+                if error:
+                    request.set_exception(error)
+                else:
+                    request.set_result([{"id": user_id}])
+
+            return await asyncio.gather(*tasks), len(requests) - before
+
+        async def work():
+            # Identical calls are executed once
+            self.assertEqual(await call(1, times=3), ([[{"id": 1}]] * 3, 1))
+            self.assertEqual(api.cache_coalesced, 2)
+
+            self.assertEqual(await call(1), ([[{"id": 1}]], 0))
+
+            # Results expire after method's ttl
+            now[0] += CACHED_METHODS["users.get"] + 1
+            self.assertEqual((await call(1))[1], 1)
+
+            # Least recently used result is evicted
+            await call(2)
+            await call(1)
+            await call(3)
+            self.assertEqual((await call(1))[1], 0)
+            self.assertEqual((await call(2))[1], 1)
+
+            # Failed call isn't cached and isn't waited by next calls
+            with mock.patch("traceback.print_exc"):
+                self.assertEqual(await call(4, times=2, error=ValueError()), ([{}, {}], 1))
+
+            self.assertEqual(api.inflight, {})
+            self.assertEqual(await call(4), ([[{"id": 4}]], 1))
+
+        with mock.patch("utils.plus.time", mock.Mock(time=lambda: now[0])):
+            loop.run_until_complete(work())
+
+        loop.close()
+
+    def test_batched_requests(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        tasks = [Request("users.get", {"user_ids": i, "fields": "sex"}) for i in (1, 2, 1)]
+        tasks += [Request("users.get", {"user_ids": "3,4"}), Request("users.get", {"user_ids": "durov"})]
+
+        popped, batches = [], {}
+
+        for task in tasks:
+            if not RequestsQueue.batch(task, popped, batches):
+                popped.append(task)
+
+        self.assertEqual(len(popped), 3)
+        self.assertEqual(popped[0].data["user_ids"], "1,2")
+
+        parts = popped[0].split_result([{"id": 2}, {"id": 1}])
+        self.assertEqual([part for _, part in parts], [[{"id": 1}], [{"id": 2}], [{"id": 1}]])
+
+        loop.close()
+
+    def test_storage_changes(self):
+        from plugins.technical.storage import sdict
+
+        d = sdict({"id": 1, "stats": {"messages": 1}})
+
+        d["stats"]
+        d.get("id")
+        self.assertFalse(d.changed)
+
+        d["stats"]["messages"] += 1
+        self.assertTrue(d.changed)
+
+        d.changed = False
+        d.setraw("cached", [1, 2])
+        self.assertFalse(d.changed)
+
+        d["cached"].append(3)
+        self.assertTrue(d.changed)
+
+        d["stats"]["messages"] += 1
+        self.assertEqual(d.get_update(), {"$inc": {"stats.messages": 1},
+            "$push": {"cached": {"$each": [3]}}})
+
+    def test_storage_sqlite(self):
+        from plugins.technical.storage import SQLiteStorage
+
+        storage = SQLiteStorage(":memory:")
+
+        self.assertEqual(storage.write("users", [(1, 0, '{"id": 1}')]), [])
+        self.assertEqual(storage.write("users", [(1, 0, '{"id": 1}')]), [1])
+        self.assertEqual(storage.write("users", [(1, 1, '{"id": 1, "a": 1}'),
+            (2, 3, '{"id": 2}')]), [2])
+
+        storage.reader = storage.writer
+        self.assertEqual(storage.load("users", 1), {"id": 1, "a": 1})
+        self.assertIsNone(storage.load("users", 2))
+
+        storage.close()
+
+    def test_storage_sqlite_threads(self):
+        import concurrent.futures, tempfile
+        from plugins.technical.storage import SQLiteStorage
+
+        storage = SQLiteStorage(os.path.join(tempfile.mkdtemp(), "storage.sqlite3"))
+
+        # Document is saved in executor before anything is loaded
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(storage.write, "users", [(1, 0, '{"id": 1}')]).result()
+
+        self.assertEqual(storage.load("users", 1), {"id": 1})
+
+        storage.close()
+
+    def test_storage_stop(self):
+        import tempfile
+        from plugins.technical.storage import StoragePlugin, SQLiteStorage
+
+        loop = asyncio.new_event_loop()
+
+        class Bot:
+            logger = logging.Logger("test")
+
+        Bot.loop = loop
+
+        written = []
+
+        class SlowStorage(SQLiteStorage):
+            def write(self, table, rows):
+                time.sleep(0.2)
+                written.append(super().write(table, rows))
+
+        path = os.path.join(tempfile.mkdtemp(), "storage.sqlite3")
+
+        storage = StoragePlugin(sqlite=path, flush_interval=0.01)
+        storage.bot = Bot
+        storage.sqlite = SlowStorage(path)
+
+        async def work():
+            user = await storage.load_user(1)
+            user["a"] = 1
+            await storage.save_user(1, user)
+
+            # Flusher is writing the document when plugin is stopped
+            await asyncio.sleep(0.1)
+            await storage.stop()
+
+        loop.run_until_complete(work())
+        loop.close()
+
+        self.assertEqual(written, [[]])
+
+    def test_storage_conflict(self):
+        import tempfile
+        from plugins.technical.storage import StoragePlugin
+
+        path = os.path.join(tempfile.mkdtemp(), "storage.sqlite3")
+
+        loop = asyncio.new_event_loop()
+
+        class Bot:
+            logger = logging.Logger("test")
+
+        Bot.loop = loop
+
+        first, second = StoragePlugin(sqlite=path), StoragePlugin(sqlite=path)
+        first.bot = second.bot = Bot
+
+        async def work():
+            new, stale = await first.load_user(1), await second.load_user(1)
+
+            new["name"] = "new"
+            await first.save_user(1, new)
+            await first.flush()
+
+            # Document with old `_version` is accepted, but not written
+            stale["name"] = "stale"
+            self.assertTrue(await second.save_user(1, stale))
+            await second.flush()
+
+            return await second.load_user(1)
+
+        user = loop.run_until_complete(work())
+
+        self.assertEqual((user["name"], user["_version"]), ("new", 1))
+        self.assertEqual(first.sqlite.load("users", 1)["name"], "new")
+
+        loop.run_until_complete(first.stop())
+        loop.run_until_complete(second.stop())
+        loop.close()
+
+    def test_storage_concurrent_writers(self):
+        from plugins.technical.storage import StoragePlugin
+
+        loop = asyncio.new_event_loop()
+
+        class Bot:
+            logger = logging.Logger("test")
+
+        Bot.loop = loop
+
+        users = MemoryCollection()
+        users.documents.append({"_id": 1, "id": 1, "name": "", "other": 1, "_version": 3})
+
+        # Two plugins with one collection work like two processes
+        first, second = StoragePlugin(), StoragePlugin()
+
+        for storage in (first, second):
+            storage.bot = Bot
+            storage.users = users
+
+        async def work():
+            a, b = await first.load_user(1), await second.load_user(1)
+
+            a["name"] = "A"
+            await first.save_user(1, a)
+            await first.flush()
+
+            # Both writes are made from `_version` 3
+            b["name"] = "B"
+            await second.save_user(1, b)
+            await second.flush()
+
+            self.assertIsNone(second.get_cached("users", 1))
+
+            # Stale document isn't written over document of other writer
+            b["other"] = 2
+            await second.save_user(1, b)
+            await second.flush()
+
+            fresh = await second.load_user(1)
+            self.assertEqual((fresh["name"], fresh["other"]), ("A", 1))
+
+            fresh["other"] = 2
+            await second.save_user(1, fresh)
+            await second.flush()
+
+            self.assertIs(second.get_cached("users", 1), fresh)
+
+        loop.run_until_complete(work())
+        loop.run_until_complete(first.stop())
+        loop.run_until_complete(second.stop())
+        loop.close()
+
+        document = users.documents[0]
+        self.assertEqual((document["name"], document["other"], document["_version"]), ("A", 2, 5))
+
+    def test_storage_journal(self):
+        import tempfile
+        from plugins.technical.storage import StoragePlugin
+
+        directory = tempfile.mkdtemp()
+        journal = os.path.join(directory, "storage.localdata.journal")
+
+        loop = asyncio.new_event_loop()
+
+        class Bot:
+            logger = logging.Logger("test")
+
+        Bot.loop = loop
+
+        class Plugin(StoragePlugin):
+            __slots__ = ()
+
+            def get_path(self, name):
+                return os.path.join(directory, name)
+
+        def start(compact_after=100):
+            storage = Plugin(in_memory=True, save_to_file=True, compact_after=compact_after)
+            storage.bot = Bot
+
+            return storage
+
+        async def save(storage, *user_ids):
+            for user_id in user_ids:
+                user = await storage.load_user(user_id)
+                user["saved"] = user.get("saved", 0) + 1
+                await storage.save_user(user_id, user)
+
+            await storage.flush()
+
+            if storage.compactor:
+                await storage.compactor
+
+        def crash(storage):
+            storage.flusher.cancel()
+            storage.journal.close()
+            storage.executor.shutdown()
+
+        storage = start()
+        loop.run_until_complete(save(storage, 1, 2))
+        crash(storage)
+
+        # Process is killed while line is written
+        with open(journal, "ab") as o:
+            o.write(b'["users", 3, {"id": 3, "na')
+
+        storage = start()
+        self.assertEqual((sorted(storage.users), storage.journal_size), ([1, 2], 2))
+
+        loop.run_until_complete(save(storage, 3))
+        crash(storage)
+
+        storage = start(compact_after=4)
+        self.assertEqual(sorted(storage.users), [1, 2, 3])
+        self.assertEqual(storage.users[3]["saved"], 1)
+
+        # Snapshot is written and journals are removed
+        loop.run_until_complete(save(storage, 4))
+        self.assertEqual(storage.journal_size, 0)
+        self.assertFalse(os.path.exists(journal))
+        self.assertFalse(os.path.exists(journal + ".old"))
+
+        loop.run_until_complete(save(storage, 1))
+        loop.run_until_complete(storage.stop())
+
+        storage = start()
+        self.assertEqual(sorted(storage.users), [1, 2, 3, 4])
+        self.assertEqual((storage.users[1]["saved"], storage.journal_size), (2, 1))
+
+        loop.run_until_complete(storage.stop())
+        loop.close()
+
+    def test_storage_preload(self):
+        from plugins.technical.storage import StoragePlugin
+
+        loop = asyncio.new_event_loop()
+
+        class Bot:
+            logger = logging.Logger("test")
+
+        Bot.loop = loop
+
+        users = MemoryCollection()
+        users.documents.append({"_id": 1, "id": 1, "name": "first", "_version": 1})
+
+        storage = StoragePlugin()
+        storage.bot = Bot
+        storage.users = users
+
+        async def work():
+            # Documents requested at the same time are loaded with one query
+            loaded = await asyncio.gather(*(storage.load_user(i) for i in (1, 2, 3, 2)))
+
+            self.assertEqual(users.queries, 1)
+            self.assertEqual(loaded[0]["name"], "first")
+            self.assertEqual(loaded[1], {"id": 2, "_version": 0})
+            self.assertIs(loaded[1], loaded[3])
+
+            # Missing documents are inserted when they are saved
+            loaded[1]["name"] = "second"
+            await storage.save_user(2, loaded[1])
+            await storage.flush()
+
+            loaded[1]["name"] = "changed"
+            await storage.save_user(2, loaded[1])
+            await storage.flush()
+
+            self.assertIs(await storage.load_user(2), loaded[1])
+            self.assertEqual(users.queries, 1)
+
+        loop.run_until_complete(work())
+        loop.run_until_complete(storage.stop())
+        loop.close()
+
+        documents = {d["id"]: d for d in users.documents}
+
+        self.assertEqual(sorted(documents), [1, 2])
+        self.assertEqual((documents[2]["name"], documents[2]["_version"]), ("changed", 2))
+
+    def test_storage_meta_refresh(self):
+        import tempfile
+        from plugins.technical.storage import StoragePlugin
+
+        path = os.path.join(tempfile.mkdtemp(), "storage.sqlite3")
+
+        # Two plugins with one database work like two processes
+        loop = asyncio.new_event_loop()
+
+        class Bot:
+            logger = logging.Logger("test")
+
+        Bot.loop = loop
+
+        first, second = StoragePlugin(sqlite=path), StoragePlugin(sqlite=path)
+        first.bot = second.bot = Bot
+
+        async def work():
+            meta = await first.load_meta()
+            meta["admins"] = [1]
+            await first.save_meta(meta)
+            await first.flush()
+
+            other = await second.load_meta()
+            other["admins"].append(2)
+            await second.save_meta(other)
+            await second.flush()
+
+            await first.refresh_meta()
+
+            return await first.load_meta()
+
+        self.assertEqual(loop.run_until_complete(work())["admins"], [1, 2])
+
+        loop.run_until_complete(first.stop())
+        loop.run_until_complete(second.stop())
+        loop.close()
+
+    def test_statistics(self):
+        from plugins.content.content_statistics import StatisticsPlugin
+
+        loop = asyncio.new_event_loop()
+
+        class Msg:
+            def __init__(self, user_id, text, data):
+                self.chat_id, self.user_id, self.full_text = 1, user_id, text
+                self.meta = {"data_chat": data}
+
+        def legacy_data():
+            return {"chat_statistics": {"users": {
+                "1": {"messages": 5, "symbols": 50, "last_message": 10},
+                "2": {"messages": 7, "symbols": 20, "last_message": 5},
+                "3": {"messages": 7, "symbols": 30, "last_message": 20},
+            }}}
+
+        plugin = StatisticsPlugin()
+
+        async def work():
+            # Without MongoDB the most active users are taken from chat's data
+            msg = Msg(1, "hello", legacy_data())
+            await plugin.global_before_message_checks(msg)
+
+            self.assertEqual([uid for uid, _ in await plugin.get_top(msg, 2)], [3, 2])
+
+            # With MongoDB chat's statistics is moved to collection once
+            plugin.collection = MemoryCollection()
+
+            for data in (legacy_data(), legacy_data(), {"title": ""}):
+                msg = Msg(2, "hi", data)
+                await plugin.global_before_message_checks(msg)
+                self.assertNotIn("chat_statistics", data)
+
+            top = await plugin.get_top(msg, 3)
+
+            self.assertEqual([(uid, u["messages"], u["symbols"]) for uid, u in top],
+                [(2, 10, 26), (3, 7, 30), (1, 5, 50)])
+            self.assertEqual(len(plugin.collection.documents), 3)
+
+            plugin.count(1, 3, 1, 1, 30)
+            plugin.count(1, 3, 1, 1, 25)
+            await plugin.flush()
+
+            top = await plugin.get_top(msg, 2)
+
+            self.assertEqual([(uid, u["messages"]) for uid, u in top], [(2, 10), (3, 9)])
+            self.assertEqual(top[1][1]["last_message"], 30)
+
+            await plugin.stop()
+
+        loop.run_until_complete(work())
+        loop.close()
+
+    def test_indexed_list(self):
+        items = IndexedList([1, 2, 2])
+
+        items.remove(2)
+        self.assertIn(2, items)
+
+        items.pop()
+        items.append(3)
+        self.assertNotIn(2, items)
+        self.assertIn(3, items)
+        self.assertEqual(items, [1, 3])
+
+    def test_list_view(self):
+        items = IndexedList([1, 2])
+        view = ListView(items)
+
+        items.append(3)
+        self.assertIn(3, view)
+        self.assertEqual(view, (1, 2, 3))
+        self.assertEqual(view, ListView([1, 2, 3]))
+
+        self.assertNotEqual(view, None)
+        self.assertNotEqual(view, 1)
+        self.assertNotEqual(view, "123")
+
+        with self.assertRaises(TypeError):
+            hash(view)
+
+    def test_tinydb(self):
+        import tempfile
+        from tinydb import Query
+        from plugins.technical.tynydb import TinyDBPlugin
+
+        directory = tempfile.mkdtemp()
+
+        loop = asyncio.new_event_loop()
+
+        class Plugin(TinyDBPlugin):
+            __slots__ = ()
+
+            def get_path(self, name):
+                return os.path.join(directory, name)
+
+        def start():
+            plugin = Plugin()
+            plugin.bot = type("Bot", (), {"loop": loop})
+
+            return plugin
+
+        async def write():
+            plugin = start()
+
+            plugin.save_user(1, {"name": "first"})
+            other = plugin.tinydb.insert({"note": "inserted by tinydb"})
+            plugin.save_user(2, {"name": "second"})
+
+            # Documents inserted by plugin and by TinyDB get different ids
+            self.assertEqual(len(plugin.tinydb), 3)
+            self.assertNotIn(other, plugin.index.values())
+
+            self.assertEqual(plugin.tinydb.search(Query().user_id == 1)[0]["data"],
+                {"name": "first"})
+
+            plugin.save_user(1, {"name": "changed"})
+            plugin.delete_user(2)
+            self.assertEqual(plugin.tinydb.search(Query().user_id == 1)[0]["data"],
+                {"name": "changed"})
+
+            # Changes made through TinyDB are found by index
+            plugin.tinydb.update({"data": {"name": "updated"}}, Query().user_id == 1)
+            self.assertEqual(plugin.get_user(1), {"name": "updated"})
+
+            await plugin.stop()
+
+            return other
+
+        async def read(other):
+            plugin = start()
+
+            self.assertEqual((plugin.get_user(1), plugin.get_user(2)), ({"name": "updated"}, {}))
+            self.assertEqual(plugin.tinydb.get(doc_id=other)["note"], "inserted by tinydb")
+
+            plugin.save_user(3, {"name": "third"})
+            self.assertNotEqual(plugin.index[3], other)
+
+            await plugin.stop()
+
+        loop.run_until_complete(read(loop.run_until_complete(write())))
+        loop.close()
+
+    def test_users_cache(self):
+        from unittest import mock
+        from plugins.technical.usermeta import UserMetaPlugin
+
+        loop = asyncio.new_event_loop()
+        now = [1000.0]
+
+        class Users:
+            calls = []
+
+            async def get(self, user_ids, fields, _cache=True):
+                user_ids = [int(u) for u in str(user_ids).split(",")]
+                self.calls.append(user_ids)
+
+                return [{"id": u, "seen": now[0]} for u in user_ids]
+
+        class Api:
+            users = Users()
+
+        plugin = UserMetaPlugin(size=2, ttl=100, refresh_ahead=10, refresh_delay=0.01)
+        plugin.api = Api()
+        calls = Api.users.calls
+
+        async def work():
+            for user_id in (1, 2, 1, 3):
+                await plugin.update_user_info(user_id)
+
+            # Least recently used user is evicted
+            self.assertEqual(calls, [[1], [2], [3]])
+            self.assertEqual(list(plugin.users), [1, 3])
+            self.assertEqual((plugin.hits, plugin.evictions), (1, 1))
+
+            # Expired users are requested again
+            now[0] += 101
+            self.assertEqual((await plugin.update_user_info(1))["seen"], now[0])
+            self.assertEqual((await plugin.update_user_info(3))["seen"], now[0])
+            self.assertEqual(calls[-2:], [[1], [3]])
+
+            # Users that expire soon are refreshed together in background
+            now[0] += 95
+            await plugin.update_user_info(3)
+            seen = (await plugin.update_user_info(1))["seen"]
+            self.assertEqual(seen, now[0] - 95)
+
+            await asyncio.sleep(0.05)
+
+            self.assertEqual(sorted(calls[-1]), [1, 3])
+            self.assertEqual(plugin.refreshes, 2)
+            self.assertEqual(plugin.users[1][1]["seen"], now[0])
+            self.assertIsNone(plugin.refresher)
+
+        with mock.patch("plugins.technical.usermeta.time", mock.Mock(time=lambda: now[0])):
+            loop.run_until_complete(work())
+
+        loop.run_until_complete(plugin.stop())
+        loop.close()
+
+    def test_longpoll(self):
+        loop = asyncio.new_event_loop()
+
+        responses = [b'{"ts": 2, "updates": [1, 2]}', b'{"failed": 2}', b'damaged',
+            b'{"failed": 1, "ts": 4}', b'{"ts": 5, "pts": 7, "updates": [3]}']
+        requested, processed, positions, recovered = [], [], [], []
+
+        class Response:
+            async def __aenter__(self):
+                if not responses:
+                    await asyncio.sleep(10)
+
+                return self
+
+            async def __aexit__(self, *args):
+                pass
+
+            async def read(self):
+                return responses.pop(0)
+
+        class Session:
+            def get(self, url, params):
+                requested.append(params["ts"])
+                return Response()
+
+        async def init(pack, update=0):
+            pack[1] = "server"
+            if update != 2:
+                pack[0]["ts"] = 1
+
+        async def process(update):
+            processed.append(update)
+
+        async def recover(position):
+            recovered.append(position)
+
+        longpoll = LongPoll(init, process, {"wait": 25}, Session(), position={"ts": 2},
+            checkpoint=positions.append, recover=recover, loop=loop)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            loop.run_until_complete(asyncio.wait_for(longpoll.run(), 2))
+
+        loop.close()
+
+        self.assertEqual(processed, [1, 2, 3])
+        self.assertEqual(requested[:5], [2, 2, 2, 2, 4])
+        self.assertEqual(positions, [{"ts": 2}, {"ts": 5, "pts": 7}])
+        self.assertEqual(recovered, [{"ts": 2}])
+        self.assertEqual(longpoll.attempt, 0)
+
+        self.assertLessEqual(backoff_delay(1100), 45)
+
+    def test_longpoll_recovery(self):
+        loop = asyncio.new_event_loop()
+
+        class Settings(BotSettings):
+            READ_OUT = False
+            LONGPOLL_CATCHUP_RATE = 1000
+            LONGPOLL_CATCHUP_LIMIT = 1000
+
+        class Messages:
+            async def getLongPollHistory(self, **params):
+                return {"messages": {"items": [{"id": i, "date": 0, "user_id": 7,
+                    "body": "hi", "title": "", "random_id": 0, "read_state": 1, "out": 0}
+                    for i in (13, 10, 11, 12)]}}
+
+        class Api:
+            target_client = None
+            messages = Messages()
+
+            def __call__(self, sender=None):
+                return self
+
+        class RecoveryBot(Bot):
+            __slots__ = ("processed",)
+
+            async def process_message(self, msg):
+                self.processed.append(msg.msg_id)
+
+        bot = RecoveryBot.__new__(RecoveryBot)
+        bot.settings, bot.api, bot.logger = Settings, Api(), logging.Logger("test")
+        bot.received, bot.processed = SeenSet(100), []
+
+        def live(message_id):
+            return bot.process_longpoll_event([4, message_id, 1, 7, 0, "hi", {}])
+
+        async def work():
+            # Long polling continues from new ts while lost messages are recovered
+            await live(11)
+            await live(12)
+            await bot.recover_long_polling({"ts": 1, "pts": 1})
+            await live(13)
+
+        loop.run_until_complete(work())
+        loop.close()
+
+        self.assertEqual(bot.processed, [11, 12, 10, 13])
+
+    def test_longpoll_checkpoint(self):
+        import tempfile
+
+        path = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
+
+        loop = asyncio.new_event_loop()
+        checkpoint = LongPollCheckpoint(path, interval=0.05, loop=loop)
+
+        async def work():
+            for ts in range(1, 100):
+                checkpoint.save("user1", {"ts": ts})
+
+            # Positions are written once in interval
+            await asyncio.sleep(0.1)
+            self.assertEqual(LongPollCheckpoint(path).get("user1"), {"ts": 99})
+
+            checkpoint.save("user1", {"ts": 100})
+            await checkpoint.close()
+
+        loop.run_until_complete(work())
+        loop.close()
+
+        self.assertEqual(LongPollCheckpoint(path).get("user1"), {"ts": 100})
+
+    def test_longpoll_checkpoint_dispatched(self):
+        import tempfile
+
+        path = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
+
+        loop = asyncio.new_event_loop()
+
+        dispatcher = Dispatcher(tasks=2, loop=loop)
+        checkpoint = LongPollCheckpoint(path, interval=0.01, dispatcher=dispatcher, loop=loop)
+
+        slow = asyncio.Event()
+
+        async def work():
+            async def handle(event=None):
+                if event:
+                    await event.wait()
+
+            await dispatcher.dispatch(1, handle, slow)
+            checkpoint.save("user1", {"ts": 1})
+
+            await dispatcher.dispatch(2, handle)
+            checkpoint.save("user1", {"ts": 2})
+
+            # Position is saved only after all updates before it are processed
+            await asyncio.sleep(0.05)
+            self.assertIsNone(LongPollCheckpoint(path).get("user1"))
+
+            slow.set()
+            await asyncio.sleep(0.05)
+            self.assertEqual(LongPollCheckpoint(path).get("user1"), {"ts": 2})
+
+            # Updates dropped on stop are not saved
+            await dispatcher.dispatch(1, handle, asyncio.Event())
+            checkpoint.save("user1", {"ts": 3})
+
+            await dispatcher.stop()
+            await checkpoint.close()
+
+        loop.run_until_complete(work())
+        loop.close()
+
+        self.assertEqual(LongPollCheckpoint(path).get("user1"), {"ts": 2})
+
+    def test_callback_receiver(self):
+        loop = asyncio.new_event_loop()
+        receiver = CallbackReceiver(None, "code", size=2, seen=2, loop=loop)
+
+        class Request:
+            def __init__(self, body):
+                self.body = body
+
+            async def read(self):
+                return self.body
+
+        def post(body):
+            return loop.run_until_complete(receiver.handle(Request(body))).text
+
+        self.assertEqual(post(b'{"type": "confirmation"}'), "code")
+        self.assertEqual(post(b'{"type": "message_new", "event_id": "a"}'), "ok")
+        self.assertEqual(post(b'{"type": "message_new", "event_id": "a"}'), "ok")
+        self.assertEqual(post(b'{"type": "message_new", "event_id": "b"}'), "ok")
+        self.assertEqual(post(b'{"type": "message_new", "event_id": "c"}'), "busy")
+
+        loop.close()
+
+        self.assertEqual([d["event_id"] for d, _ in receiver.buffer], ["a", "b"])
+        self.assertEqual(receiver.repeated, 1)
+        self.assertNotIn("c", receiver.seen)
+
     def test_traverse(self):
         a = [10, 20, [10, 20, [10, 20]]]
         self.assertEqual(list(traverse(a)), [10, 20, 10, 20, 10, 20])
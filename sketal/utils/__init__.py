@@ -6,10 +6,15 @@ from .methods import *
 from .plus import *
 from .utils import *
 from .routine import *
+from .dispatcher import *
+from .sessions import *
+from .longpoll import *
+from .callback import *
 
 __all__ = []
 
-for m in (helpers, api, auth, data, methods, plus, utils, routine):
+for m in (helpers, api, auth, data, methods, plus, utils, routine, dispatcher, sessions, longpoll,
+          callback):
     for n in dir(m):
         if n.startswith("_"):
             continue
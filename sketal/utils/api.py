@@ -2,9 +2,12 @@ import asyncio, json, logging, time
 
 import aiohttp
 
+from collections import deque
+
 from .auth import Auth
-from .utils import RequestAccumulative
-from .routine import json_iter_parse
+from .utils import Request, RequestAccumulative, RequestBatched, parse_batch_ids
+from .methods import BATCHED_METHODS
+from .routine import json_decode
 
 AUTHORIZATION_FAILED = 5
 CAPTCHA_IS_NEEDED = 14
@@ -13,6 +16,12 @@ INTERNAL_ERROR = 10
 EXECUTE_ERROR = 10000
 VERSION = "5.68"
 
+# Responses bigger than this amount of bytes are decoded in executor
+DECODE_IN_EXECUTOR_SIZE = 256 * 1024
+
+# Methods that can't be executed with `execute`
+SEPARATE_METHODS = ("photos.saveWallPhoto", "messages.setChatPhoto",)
+
 class VkClient:
     """Class for organazing, controlling and processing requests to vk from group or user."""
 
@@ -87,7 +96,7 @@ class VkClient:
 
         async with self.session.post(url, data=data, **self.req_kwargs) as resp:
             try:
-                results = json_iter_parse(await resp.text())
+                results = await self.decode(await resp.read())
 
                 for data in results:
                     if 'response' in data:
@@ -100,6 +109,15 @@ class VkClient:
 
         return {}
 
+    async def decode(self, body):
+        """Returns list of json objects from response's body `body`. Big
+        responses are decoded in executor."""
+
+        if len(body) > DECODE_IN_EXECUTOR_SIZE:
+            return await self.loop.run_in_executor(None, json_decode, body)
+
+        return json_decode(body)
+
     async def execute(self, code, **additional_values):
         """Execute a `code` from vk's `execute` method"""
 
@@ -107,11 +125,13 @@ class VkClient:
                 data={"code": code, "access_token": self.token, "v": VERSION,
                 **additional_values}, **self.req_kwargs) as resp:
             try:
-                response = await resp.text()
+                response = await resp.read()
 
-                self.logger.debug(f"Request with code:\n{code}\nResponse:\n{response}")
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(f"Request with code:\n{code}\nResponse:\n"
+                        f"{response.decode('utf-8', 'replace')}")
 
-                results = json_iter_parse(response)
+                results = await self.decode(response)
 
             except json.JSONDecodeError:
                 self.logger.error("Error while executing vk method: vk's response is wrong!")
@@ -269,10 +289,18 @@ class VkClient:
 
 
 class RequestsQueue:
+    """Queue of requests to vk for client `vk_client`. Requests are packed
+    into `execute` calls (up to 25 requests) and executed as soon as client's
+    limit (`rate` requests per second, up to `burst` requests at once)
+    allows. When only one request to vk can be made right now, queue waits
+    `linger` seconds for more requests to fill `execute`."""
+
     __slots__ = ("vk_client", "queue", "requests_done_clear_time",
-                 "_requests_done", "processor", "logger")
+                 "_requests_done", "processor", "logger", "rate", "burst",
+                 "tokens", "tokens_time", "linger", "wakeup", "executing",
+                 "latencies")
 
-    def __init__(self, vk_client, logger=None):
+    def __init__(self, vk_client, rate=3, burst=None, linger=0.05, logger=None):
         if logger:
             self.logger = logger
         else:
@@ -280,22 +308,40 @@ class RequestsQueue:
 
         self.vk_client = vk_client
 
-        self.processor = asyncio.ensure_future(self.queue_processor())
-
         self._requests_done = 0
         self.requests_done_clear_time = 0
 
-        self.queue = asyncio.Queue()
+        self.queue = deque()
+        self.wakeup = asyncio.Event()
+        self.executing = set()
+
+        self.latencies = deque(maxlen=1000)
+
+        self.rate = rate
+        self.burst = burst or rate
+        self.linger = linger
+        self.tokens = self.burst
+        self.tokens_time = time.time()
+
+        self.processor = asyncio.ensure_future(self.queue_processor())
+
+    def set_rate(self, rate, burst=None):
+        """Set limit of requests per second for this queue"""
+
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = min(self.tokens, self.burst)
 
     def get_nowait(self):
-        return self.queue.get_nowait()
+        return self.queue.popleft()
 
     def put_nowait(self, data):
-        return self.queue.put_nowait(data)
+        self.queue.append(data)
+        self.wakeup.set()
 
     @property
     def requests(self):
-        return self.queue.qsize()
+        return len(self.queue)
 
     @property
     def requests_done(self):
@@ -305,59 +351,209 @@ class RequestsQueue:
 
         return self._requests_done
 
+    @property
+    def load(self):
+        """Estimated time (in seconds) before new request will be executed"""
+
+        self.refill()
+
+        return max(0, self.requests // 25 + 1 - self.tokens) / self.rate
+
+    def latency(self, percent):
+        """Returns `percent` percentile of time between request's enqueuing
+        and receiving result (for last 1000 requests)"""
+
+        if not self.latencies:
+            return 0
+
+        latencies = sorted(self.latencies)
+
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    @property
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "executing": len(self.executing),
+            "latency_p50": self.latency(50),
+            "latency_p99": self.latency(99),
+        }
+
+    def refill(self):
+        now = time.time()
+
+        self.tokens = min(self.burst, self.tokens + (now - self.tokens_time) * self.rate)
+        self.tokens_time = now
+
+    def take(self):
+        """Spend one request to vk"""
+
+        self.refill()
+
+        self.tokens -= 1
+        self._requests_done = self.requests_done + 1
+
+    async def wait_request(self):
+        """Wait until one more request to vk can be made"""
+
+        self.refill()
+
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.refill()
+
+    async def wait_tasks(self, timeout):
+        """Wait for new tasks until there are 25 tasks in queue or timeout"""
+
+        deadline = time.time() + timeout
+
+        while len(self.queue) < 25:
+            left = deadline - time.time()
+
+            if left <= 0:
+                break
+
+            self.wakeup.clear()
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), left)
+            except asyncio.TimeoutError:
+                break
+
     async def queue_processor(self):
         while True:
             try:
                 await self._queue_processor()
+            except asyncio.CancelledError:
+                raise
             except Exception:
                 import traceback
                 traceback.print_exc()
 
-            if not self.requests:
-                await asyncio.sleep(0.44)
-
-            await asyncio.sleep(0.34)
+                await asyncio.sleep(0.25)
 
     async def _queue_processor(self):
         """Process queue"""
 
-        if not self.requests:
+        if not self.queue:
+            self.wakeup.clear()
+            await self.wakeup.wait()
+
+        await self.wait_request()
+
+        if self.tokens < 2 and self.linger:
+            await self.wait_tasks(self.linger)
+
+        tasks = self.pop_tasks()
+
+        if not tasks:
             return
 
-        if self.requests_done > 2:
-            return await asyncio.sleep(
-                max(0, self.requests_done_clear_time - time.time())
-            )
+        self.take()
+
+        task = asyncio.ensure_future(self.execute_queue(tasks))
 
-        await self.execute_queue()
+        self.executing.add(task)
+        task.add_done_callback(self.executing.discard)
 
     async def enqueue(self, task):
         """Add task to client's queue and update queue processor"""
         if not task:
             return False
 
-        self.queue.put_nowait(task)
+        task.time = time.time()
+
+        self.put_nowait(task)
 
         return task
 
-    async def execute_queue(self):
-        """Execute 25 or less tasks from client's queue"""
+    def set_result(self, task, result):
+        if isinstance(task, RequestBatched):
+            for request, part in task.split_result(result):
+                self.set_result(request, part)
 
-        if not self.requests or self.requests_done > 2:
             return
 
-        current_tasks = []
+        if isinstance(task, RequestAccumulative):
+            task.process_result(result)
+        else:
+            try:
+                task.set_result(result)
+            except asyncio.InvalidStateError:
+                return
 
-        execute_code = "return ["
+        self.latencies.append(time.time() - task.time)
+
+    def pop_tasks(self):
+        """Take 25 or less tasks that can be executed together from queue"""
+
+        tasks = []
+        batches = {}
+
+        while self.queue and len(tasks) < 25:
+            if self.queue[0].key in SEPARATE_METHODS:
+                if not tasks:
+                    tasks.append(self.queue.popleft())
 
-        for _ in range(25):
-            if self.queue.empty():
                 break
 
-            task = self.queue.get_nowait()
+            task = self.queue.popleft()
+
+            if not self.batch(task, tasks, batches):
+                tasks.append(task)
+
+        return tasks
+
+    @staticmethod
+    def batch(task, tasks, batches):
+        """Merge task `task` with task from `tasks` for the same method with
+        the same parameters (except ids). `batches` - indexes of tasks in
+        `tasks` by method and parameters. Returns True if task was merged."""
+
+        if task.key not in BATCHED_METHODS or type(task) is not Request:
+            return False
+
+        field, limit = BATCHED_METHODS[task.key]
+
+        ids = parse_batch_ids(task.data.get(field))
+
+        if ids is None:
+            return False
+
+        ident = (task.key, tuple(sorted((k, str(v)) for k, v in task.data.items()
+            if k != field)))
 
-            if task.key in ("photos.saveWallPhoto", "messages.setChatPhoto",):
-                self._requests_done += 1
+        index = batches.get(ident)
+
+        if index is not None:
+            batched = tasks[index]
+
+            if not isinstance(batched, RequestBatched):
+                batched = tasks[index] = RequestBatched(batched, field)
+
+            if batched.add(task, ids, limit):
+                return True
+
+        batches[ident] = len(tasks)
+
+        return False
+
+    async def execute_queue(self, tasks=None):
+        """Execute 25 or less tasks from client's queue (or tasks `tasks`)"""
+
+        if tasks is None:
+            tasks = self.pop_tasks()
+
+        if not tasks:
+            return
+
+        current_tasks = []
+
+        execute_code = "return ["
+
+        for task in tasks:
+            if task.key in SEPARATE_METHODS:
+                result = None
 
                 try:
                     result = await self.vk_client.method(task.key, **task.data)
@@ -366,7 +562,7 @@ class RequestsQueue:
                     traceback.print_exc()
 
                 if not task.done() and not task.cancelled():
-                    task.set_result(result or {})
+                    self.set_result(task, result or {})
 
                 return
 
@@ -404,8 +600,10 @@ class RequestsQueue:
 
         result = []
 
-        for _ in range(2):
-            self._requests_done += 1
+        for i in range(2):
+            if i > 0:
+                await self.wait_request()
+                self.take()
 
             try:
                 result = await self.vk_client.execute(execute_code)
@@ -424,18 +622,12 @@ class RequestsQueue:
                 break
 
         for task in current_tasks:
-            if task.done() or task.cancelled():
-                continue
-
             try:
                 task_result = result.pop(0)
             except (KeyError, IndexError, AttributeError):
                 task_result = {}
 
-            if isinstance(task, RequestAccumulative):
-                task.process_result(task_result)
-            else:
-                try:
-                    task.set_result(task_result)
-                except asyncio.InvalidStateError:
-                    pass
+            if task.done() or task.cancelled():
+                continue
+
+            self.set_result(task, task_result)
@@ -0,0 +1,152 @@
+import asyncio, logging, time, traceback
+
+from collections import deque
+
+from aiohttp import web
+
+from .routine import json_decode
+
+
+class SeenSet:
+    """Set that remembers only `size` last added items"""
+
+    __slots__ = ("size", "items", "order")
+
+    def __init__(self, size):
+        self.size = size
+
+        self.items = set()
+        self.order = deque()
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        if item in self.items:
+            return
+
+        if len(self.order) >= self.size:
+            self.items.discard(self.order.popleft())
+
+        self.items.add(item)
+        self.order.append(item)
+
+
+class CallbackReceiver:
+    """Receives events from vk's Callback API (https://vk.com/dev/callback_api).
+    Events are accepted with "ok" as soon as they are decoded and stored in
+    buffer, `process` coroutine is called for them in background (in order
+    they were received). Events are not accepted if buffer has `size`
+    events, so vk sends them again later. Events with `event_id` of one of
+    `seen` last events are accepted, but not processed (these are repeated
+    events sent by vk).
+
+    Every process listening on the same port has it's own receiver, so
+    repeated events can be processed if they are received by other
+    process."""
+
+    __slots__ = ("process", "confirmation", "size", "buffer", "ready", "seen",
+                 "logger", "loop", "received", "repeated", "rejected",
+                 "processed", "lag_total", "lag_max")
+
+    def __init__(self, process, confirmation="", size=10000, seen=10000,
+                 logger=None, loop=None):
+        self.process = process
+        self.confirmation = confirmation
+
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.Logger("callback")
+
+        if loop:
+            self.loop = loop
+        else:
+            self.loop = asyncio.get_event_loop()
+
+        self.size = size
+        self.buffer = deque()
+        self.ready = asyncio.Event()
+
+        self.seen = SeenSet(seen)
+
+        self.received = 0
+        self.repeated = 0
+        self.rejected = 0
+        self.processed = 0
+
+        self.lag_total = 0
+        self.lag_max = 0
+
+    @property
+    def stats(self):
+        """Events statistics. Lag is time from receiving event to
+        dispatching of it."""
+
+        return {
+            "buffered": len(self.buffer),
+            "received": self.received,
+            "repeated": self.repeated,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "lag_average": self.lag_total / self.processed if self.processed else 0,
+            "lag_max": self.lag_max,
+        }
+
+    async def handle(self, request):
+        """aiohttp's handler for requests from vk"""
+
+        try:
+            data = json_decode(await request.read())[0]
+
+            if not isinstance(data, dict) or "type" not in data:
+                raise ValueError("Damaged data received.")
+
+        except (IndexError, UnicodeDecodeError, ValueError):
+            return web.Response(text="ok")
+
+        if data["type"] == "confirmation":
+            return web.Response(text=self.confirmation)
+
+        event_id = data.get("event_id")
+
+        if event_id is not None and event_id in self.seen:
+            self.repeated += 1
+            return web.Response(text="ok")
+
+        if len(self.buffer) >= self.size:
+            self.rejected += 1
+            return web.Response(status=503, text="busy")
+
+        if event_id is not None:
+            self.seen.add(event_id)
+
+        self.received += 1
+
+        self.buffer.append((data, time.time()))
+        self.ready.set()
+
+        return web.Response(text="ok")
+
+    async def run(self):
+        while True:
+            if not self.buffer:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            data, received = self.buffer.popleft()
+
+            try:
+                await self.process(data)
+            except Exception:
+                self.logger.error("Error while processing event:\n" + traceback.format_exc())
+
+            lag = time.time() - received
+
+            self.processed += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
@@ -10,7 +10,7 @@ class Message:
     "Класс, объект которого передаётся в плагин для упрощённого ответа"
 
     __slots__ = ('message_data', 'api', 'is_multichat', 'chat_id', 'user_id', 'is_out', 'true_user_id',
-                 'timestamp', 'answer_values', 'msg_id', 'text', 'full_text', 'meta', 'is_event',
+                 'timestamp', '_answer_values', 'msg_id', '_text', 'full_text', 'meta', 'is_event',
                  'brief_attaches', 'brief_forwarded', '_full_attaches', '_full_forwarded',
                  'peer_id', "is_forwarded", 'true_msg_id', 'reserved_by')
 
@@ -30,7 +30,7 @@ class Message:
         self.chat_id = message_data.chat_id
         self.peer_id = (message_data.chat_id or message_data.user_id) + self.is_multichat * 2000000000
         self.full_text = message_data.full_text
-        self.text = self.full_text.lower().replace("&quot;", "\"")
+        self._text = None
 
         self.msg_id = message_data.msg_id
         self.true_msg_id = message_data.true_msg_id
@@ -43,10 +43,37 @@ class Message:
         self.brief_attaches = message_data.attaches
         self._full_attaches = None
 
-        if self.is_multichat:
-            self.answer_values = {'chat_id': self.chat_id}
-        else:
-            self.answer_values = {'user_id': self.user_id}
+        self._answer_values = None
+
+    @property
+    def text(self):
+        """Message's text in lower case (computed on first access, many
+        messages are never checked for commands)"""
+
+        if self._text is None:
+            self._text = self.full_text.lower().replace("&quot;", "\"")
+
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+
+    @property
+    def answer_values(self):
+        """Values for `messages.send` when answering this message"""
+
+        if self._answer_values is None:
+            if self.is_multichat:
+                self._answer_values = {'chat_id': self.chat_id}
+            else:
+                self._answer_values = {'user_id': self.user_id}
+
+        return self._answer_values
+
+    @answer_values.setter
+    def answer_values(self, value):
+        self._answer_values = value
 
     async def get_full_attaches(self):
         """Get list of all attachments as `Attachment` for this message"""
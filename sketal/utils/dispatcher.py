@@ -0,0 +1,164 @@
+import asyncio, logging, time, traceback
+
+from collections import deque
+
+
+class Dispatcher:
+    """Runs coroutines with limited concurrency. Coroutines with the same key
+    (peer_id for messages) are executed one after another in order they were
+    dispatched, coroutines with different keys are executed concurrently by
+    `tasks` workers. No more than `pending` coroutines can wait for execution,
+    `dispatch` waits for free space otherwise.
+
+    Coroutines are numbered in order they were dispatched: `dispatched` is
+    amount of dispatched coroutines and `completed` is the biggest number,
+    such that all coroutines up to it are finished."""
+
+    __slots__ = ("logger", "loop", "tasks", "workers", "queues", "ready",
+                 "free", "pending", "dispatched", "completed", "finished",
+                 "processed", "wait_time_total", "wait_time_max")
+
+    def __init__(self, tasks=32, pending=1000, logger=None, loop=None):
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.Logger("dispatcher")
+
+        if loop:
+            self.loop = loop
+        else:
+            self.loop = asyncio.get_event_loop()
+
+        self.tasks = tasks
+        self.workers = []
+
+        self.queues = {}
+        self.ready = None
+        self.free = None
+
+        self.pending = pending
+
+        self.dispatched = 0
+        self.completed = 0
+        self.finished = set()
+
+        self.processed = 0
+        self.wait_time_total = 0
+        self.wait_time_max = 0
+
+    def start(self):
+        """Create workers (called with first dispatched coroutine)"""
+
+        self.ready = asyncio.Queue()
+        self.free = asyncio.Semaphore(self.pending)
+
+        # Coroutines dropped by `stop` are not waited
+        self.completed = self.dispatched
+        self.finished.clear()
+
+        for _ in range(self.tasks):
+            self.workers.append(asyncio.ensure_future(self.worker(), loop=self.loop))
+
+    @property
+    def depth(self):
+        """Amount of coroutines waiting for execution or being executed"""
+
+        return sum(len(queue) for queue in self.queues.values())
+
+    @property
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "peers": len(self.queues),
+            "processed": self.processed,
+            "wait_time_average": self.wait_time_total / self.processed if self.processed else 0,
+            "wait_time_max": self.wait_time_max,
+        }
+
+    async def dispatch(self, key, func, *args):
+        """Schedule `func(*args)` for execution after other coroutines with
+        key `key`. If `key` is None coroutine is not ordered with others."""
+
+        if not self.workers:
+            self.start()
+
+        await self.free.acquire()
+
+        if key is None:
+            key = object()
+
+        queue = self.queues.get(key)
+
+        if queue is None:
+            queue = self.queues[key] = deque()
+
+        self.dispatched += 1
+
+        queue.append((func, args, time.time(), self.dispatched))
+
+        if len(queue) == 1:
+            self.ready.put_nowait(key)
+
+    async def worker(self):
+        while True:
+            key = await self.ready.get()
+
+            queue = self.queues[key]
+            func, args, dispatched, number = queue[0]
+
+            wait_time = time.time() - dispatched
+
+            self.wait_time_total += wait_time
+            if wait_time > self.wait_time_max:
+                self.wait_time_max = wait_time
+
+            try:
+                await func(*args)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                self.logger.error("Error while dispatching:\n" + traceback.format_exc())
+
+            finally:
+                self.processed += 1
+                self.free.release()
+
+                queue.popleft()
+
+                if queue:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.queues[key]
+
+            # Cancelled coroutines are not finished
+            self.finish(number)
+
+    def finish(self, number):
+        self.finished.add(number)
+
+        while self.completed + 1 in self.finished:
+            self.completed += 1
+            self.finished.remove(self.completed)
+
+    async def stop(self):
+        """Stop workers. Coroutines waiting for execution are dropped, so
+        dispatcher can be started again with empty queues."""
+
+        for worker in self.workers:
+            worker.cancel()
+
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+        self.workers.clear()
+
+        dropped = self.depth
+
+        if dropped:
+            self.logger.warning(f"Dispatcher stopped, {dropped} coroutines weren't executed")
+
+        self.queues.clear()
+
+        self.ready = None
+        self.free = None
@@ -5,7 +5,19 @@ from .utils import Attachment
 from .routine import traverse
 
 
-async def upload_audio_message(api, multipart_data, peer_id):
+async def upload_file(upload_url, data, session=None):
+    """Send `data` to vk's upload server `upload_url` with session `session`
+    (new session if None) and return server's response"""
+
+    if session is None:
+        async with aiohttp.ClientSession() as sess:
+            return await upload_file(upload_url, data, sess)
+
+    async with session.post(upload_url, data=data) as resp:
+        return json.loads(await resp.text())
+
+
+async def upload_audio_message(api, multipart_data, peer_id, session=None):
     """Upload audio file `multipart_data` and return Attachment for sending to user with id `peer_id`(possibly)"""
 
     sender = api.get_default_sender("docs.getMessagesUploadServer")
@@ -26,9 +38,7 @@ async def upload_audio_message(api, multipart_data, peer_id):
 
     upload_url = response['upload_url']
 
-    async with aiohttp.ClientSession() as sess:
-        async with sess.post(upload_url, data=data) as resp:
-            result = json.loads(await resp.text())
+    result = await upload_file(upload_url, data, session)
 
     if not result:
         return None
@@ -41,10 +51,11 @@ async def upload_audio_message(api, multipart_data, peer_id):
 
     return Attachment.from_upload_result(result[0], "doc")
 
-async def upload_graffiti(api, multipart_data, filename):
-    return await upload_doc(api, multipart_data, filename, {"type": "graffiti"})
+async def upload_graffiti(api, multipart_data, filename, session=None):
+    return await upload_doc(api, multipart_data, filename, {"type": "graffiti"}, session)
 
-async def upload_doc(api, multipart_data, filename="image.png", additional_params=None):
+async def upload_doc(api, multipart_data, filename="image.png", additional_params=None,
+                     session=None):
     """Upload file `multipart_data` and return Attachment for sending to user"""
 
     if additional_params is None:
@@ -70,9 +81,7 @@ async def upload_doc(api, multipart_data, filename="image.png", additional_param
 
     upload_url = response['upload_url']
 
-    async with aiohttp.ClientSession() as sess:
-        async with sess.post(upload_url, data=data) as resp:
-            result = json.loads(await resp.text())
+    result = await upload_file(upload_url, data, session)
 
     if not result or not result.get("file"):
         print(result)
@@ -87,7 +96,7 @@ async def upload_doc(api, multipart_data, filename="image.png", additional_param
     return Attachment.from_upload_result(result[0], "doc")
 
 
-async def upload_photo(api, multipart_data, peer_id=None):
+async def upload_photo(api, multipart_data, peer_id=None, session=None):
     """Upload photo file `multipart_data` and return Attachment for sending to
     user with id `peer_id`(optional but recommended)"""
 
@@ -109,9 +118,7 @@ async def upload_photo(api, multipart_data, peer_id=None):
 
     upload_url = response['upload_url']
 
-    async with aiohttp.ClientSession() as sess:
-        async with sess.post(upload_url, data=data) as resp:
-            result = json.loads(await resp.text())
+    result = await upload_file(upload_url, data, session)
 
     if not result:
         return None
@@ -139,6 +146,15 @@ async def parse_user_name(user_id, entity):
                 if u and u["id"] == user_id:
                     return u["first_name"] + " " + u["last_name"]
 
+        # Cache of `UserMetaPlugin`
+        if entity.meta.get("users_cache"):
+            u = await entity.meta["users_cache"].update_user_info(user_id)
+
+            if not u:
+                return str(user_id)
+
+            return u["first_name"] + " " + u["last_name"]
+
     us = await entity.api.users.get(user_ids=user_id, fields="sex,screen_name,nickname")
 
     if not us:
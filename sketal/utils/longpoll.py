@@ -0,0 +1,392 @@
+import asyncio, concurrent.futures, json, logging, os, random, time, traceback
+
+import aiohttp
+
+from collections import deque
+
+from .routine import json_decode
+
+
+def backoff_delay(attempt, base=0.5, limit=30):
+    """Returns delay before retry after `attempt` failed attempts: grows
+    exponentially and has random jitter, so clients don't retry together."""
+
+    return min(limit, base * 2 ** min(attempt, 16)) * random.uniform(0.5, 1.5)
+
+
+class LongPoll:
+    """Receives updates from vk's long poll server (users' or bots'). `init`
+    is coroutine that requests server, key and ts (see
+    `Bot.init_long_polling`), `process` is coroutine that processes one
+    update. Next request is sent as soon as response is decoded, while
+    updates from response are processed (in order they were received).
+
+    Polling continues from `position` (dictionary with ts and pts) if it is
+    passed. `checkpoint` is called with position after updates before it
+    were passed to `process`. `recover` is coroutine called with position after which
+    updates were lost by server (it's executed in background)."""
+
+    __slots__ = ("init", "process", "session", "logger", "loop", "pack",
+                 "position", "checkpoint", "recover", "recovering", "attempt",
+                 "processing", "started", "polls", "updates", "failures",
+                 "reconnects", "poll_time_total", "lag_total", "lag_max")
+
+    def __init__(self, init, process, params, session, position=None,
+                 checkpoint=None, recover=None, logger=None, loop=None):
+        self.init = init
+        self.process = process
+        self.session = session
+
+        self.position = position
+        self.checkpoint = checkpoint
+        self.recover = recover
+        self.recovering = set()
+
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.Logger("longpoll")
+
+        if loop:
+            self.loop = loop
+        else:
+            self.loop = asyncio.get_event_loop()
+
+        self.pack = [dict(params, act="a_check", key="", ts=0), ""]
+
+        self.processing = None
+
+        # Failed attempts since last successful poll
+        self.attempt = 0
+
+        self.started = None
+        self.polls = 0
+        self.updates = 0
+        self.failures = 0
+        self.reconnects = 0
+
+        self.poll_time_total = 0
+        self.lag_total = 0
+        self.lag_max = 0
+
+    @property
+    def stats(self):
+        """Polls statistics. Lag is time from receiving response to
+        dispatching of it's updates."""
+
+        elapsed = time.time() - self.started if self.started else 0
+
+        return {
+            "polls": self.polls,
+            "updates": self.updates,
+            "failures": self.failures,
+            "reconnects": self.reconnects,
+            "updates_per_second": self.updates / elapsed if elapsed else 0,
+            "poll_time_average": self.poll_time_total / self.polls if self.polls else 0,
+            "lag_average": self.lag_total / self.polls if self.polls else 0,
+            "lag_max": self.lag_max,
+        }
+
+    async def run(self):
+        await self.init(self.pack)
+
+        if self.position:
+            # Updates received while bot was off are requested
+            self.pack[0]["ts"] = self.position["ts"]
+        else:
+            self.position = {"ts": self.pack[0]["ts"]}
+
+        self.started = time.time()
+
+        try:
+            while True:
+                try:
+                    events = await self.poll()
+
+                except (asyncio.TimeoutError, aiohttp.ServerDisconnectedError):
+                    self.logger.warning("Long polling server doesn't respond. Changing server.")
+
+                    self.failures += 1
+
+                    await asyncio.sleep(backoff_delay(self.attempt))
+                    self.attempt += 1
+
+                    await self.reconnect()
+                    continue
+
+                except (aiohttp.ClientError, ValueError):
+                    self.failures += 1
+
+                    await asyncio.sleep(backoff_delay(self.attempt))
+                    self.attempt += 1
+
+                    continue
+
+                if events.get("failed"):
+                    await self.handle_failed(events)
+                    continue
+
+                self.attempt = 0
+
+                # Next request is sent with new ts, while updates are processed
+                self.pack[0]["ts"] = events["ts"]
+
+                self.position = {"ts": events["ts"]}
+
+                if "pts" in events:
+                    self.position["pts"] = events["pts"]
+
+                await self.schedule(events.get("updates") or (), self.position)
+
+        finally:
+            if self.processing:
+                self.processing.cancel()
+
+            for task in list(self.recovering):
+                task.cancel()
+
+    async def poll(self):
+        start = time.time()
+
+        async with self.session.get(self.pack[1], params=self.pack[0]) as resp:
+            body = await resp.read()
+
+        self.polls += 1
+        self.poll_time_total += time.time() - start
+
+        events = json_decode(body)
+
+        if not events or not isinstance(events[0], dict):
+            raise ValueError("Damaged response from long polling server")
+
+        return events[0]
+
+    async def handle_failed(self, events):
+        """Handle error from https://vk.com/dev/using_longpoll_2. Updates
+        are requested with the same ts, unless server reports that they are
+        lost."""
+
+        failed = int(events["failed"])
+
+        if failed == 1:  # 1 - update timestamp, history is lost
+            if "ts" in events:
+                self.pack[0]["ts"] = events["ts"]
+            else:
+                await self.init(self.pack)
+
+            self.lost()
+
+        elif failed == 2:  # 2 - new key
+            await self.init(self.pack, failed)
+
+        elif failed == 3:  # 3 - new key and ts, history is lost
+            await self.init(self.pack, failed)
+
+            self.lost()
+
+        else:
+            self.logger.error(f"Long polling server returned error: {events}")
+
+            self.failures += 1
+
+            await asyncio.sleep(backoff_delay(self.attempt))
+            self.attempt += 1
+
+            await self.reconnect()
+
+    def lost(self):
+        """Server lost updates after current position, request them with
+        `recover` and continue from new ts"""
+
+        position, self.position = self.position, {"ts": self.pack[0]["ts"]}
+
+        if not self.recover:
+            self.logger.warning(f"Long polling server lost updates after {position}")
+            return
+
+        task = asyncio.ensure_future(self.recover(position), loop=self.loop)
+
+        self.recovering.add(task)
+        task.add_done_callback(self.recovering.discard)
+
+    async def reconnect(self):
+        """Request new server and key, keeping current ts"""
+
+        ts = self.pack[0]["ts"]
+
+        await self.init(self.pack)
+
+        if ts:
+            self.pack[0]["ts"] = ts
+
+        self.reconnects += 1
+
+    async def schedule(self, updates, position):
+        """Start processing of `updates` after updates from previous
+        response. Waits if updates from previous response are not processed
+        yet, so no more than one response is processed during polling."""
+
+        previous = self.processing
+
+        self.processing = asyncio.ensure_future(self.process_updates(updates, previous,
+            time.time(), position), loop=self.loop)
+
+        if previous and not previous.done():
+            await asyncio.shield(previous)
+
+    async def process_updates(self, updates, previous, received, position):
+        if previous:
+            await previous
+
+        for update in updates:
+            try:
+                await self.process(update)
+            except Exception:
+                self.logger.error("Error while processing update:\n" + traceback.format_exc())
+
+        lag = time.time() - received
+
+        self.updates += len(updates)
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+
+        if self.checkpoint:
+            try:
+                self.checkpoint(position)
+            except Exception:
+                self.logger.error("Error while saving position:\n" + traceback.format_exc())
+
+
+class LongPollCheckpoint:
+    """Positions of long polls stored in json file `path`. Changed positions
+    are written in background no more than once in `interval` seconds. File
+    is written to disk and then replaced, so it always contains saved
+    positions.
+
+    If `dispatcher` is passed, position is saved only when coroutines
+    dispatched before it are finished, so updates dropped on stop are
+    received again after restart."""
+
+    __slots__ = ("path", "positions", "pending", "dispatcher", "interval", "changed",
+                 "writer", "executor", "logger", "loop")
+
+    def __init__(self, path, interval=1, dispatcher=None, logger=None, loop=None):
+        self.path = path
+        self.positions = None
+
+        # Positions waiting for dispatched coroutines by long poll's name
+        self.pending = {}
+        self.dispatcher = dispatcher
+
+        self.interval = interval
+        self.changed = False
+        self.writer = None
+
+        # Files are written one after another, in order they were requested
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.Logger("checkpoint")
+
+        if loop:
+            self.loop = loop
+        else:
+            self.loop = asyncio.get_event_loop()
+
+    def load(self):
+        if self.positions is None:
+            try:
+                with open(self.path) as o:
+                    self.positions = json.load(o)
+
+            except (FileNotFoundError, ValueError):
+                self.positions = {}
+
+        return self.positions
+
+    def get(self, name):
+        return self.load().get(name)
+
+    def save(self, name, position):
+        """Save `position` of long poll `name` after coroutines that were
+        dispatched before it"""
+
+        dispatched = self.dispatcher.dispatched if self.dispatcher else 0
+
+        pending = self.pending.get(name)
+
+        if pending is None:
+            pending = self.pending[name] = deque()
+
+        if pending and pending[-1][0] == dispatched:
+            pending[-1] = (dispatched, position)
+        else:
+            pending.append((dispatched, position))
+
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self.write_periodically(), loop=self.loop)
+
+    def advance(self):
+        """Move positions to the last positions with finished coroutines"""
+
+        completed = self.dispatcher.completed if self.dispatcher else 0
+
+        positions = self.load()
+
+        for name, pending in self.pending.items():
+            position = None
+
+            while pending and pending[0][0] <= completed:
+                position = pending.popleft()[1]
+
+            if position is not None and positions.get(name) != position:
+                positions[name] = position
+                self.changed = True
+
+    async def write_periodically(self):
+        try:
+            while self.changed or any(self.pending.values()):
+                await asyncio.sleep(self.interval)
+                await self.flush()
+
+        finally:
+            self.writer = None
+
+    async def flush(self):
+        """Write changed positions to file"""
+
+        self.advance()
+
+        if not self.changed:
+            return
+
+        self.changed = False
+
+        try:
+            await self.loop.run_in_executor(self.executor, self.write_file,
+                json.dumps(self.positions))
+
+        except Exception:
+            self.changed = True
+
+            self.logger.error("Error while saving positions of long polls:\n" +
+                traceback.format_exc())
+
+    def write_file(self, body):
+        with open(self.path + ".tmp", "w") as o:
+            o.write(body)
+            o.flush()
+
+            os.fsync(o.fileno())
+
+        os.replace(self.path + ".tmp", self.path)
+
+    async def close(self):
+        if self.writer:
+            self.writer.cancel()
+
+        await self.flush()
+
+        self.executor.shutdown()
@@ -55,6 +55,24 @@ def is_available_from_group(key):
     return False
 
 
+# Методы, результаты которых можно кэшировать, и время жизни результатов в секундах
+CACHED_METHODS = {
+    'users.get': 60,
+    'groups.getById': 300,
+    'messages.getChat': 30,
+    'messages.getChatUsers': 30,
+    'utils.resolveScreenName': 300,
+}
+
+
+# Методы, одновременные запросы которых объединяются в один: поле со списком
+# идентификаторов и максимальное количество идентификаторов в запросе
+BATCHED_METHODS = {
+    'users.get': ('user_ids', 1000),
+    'messages.getById': ('message_ids', 100),
+}
+
+
 # Методы, которые можно выполнять без авторизации API
 ALLOWED_PUBLIC = {
     'apps': ('get', 'getCatalog'),
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 from captcha_solver import CaptchaSolver
 
 from .api import *
@@ -9,7 +11,8 @@ from .methods import *
 class VkController:
     __slots__ = ("logger", "vk_users", "vk_groups", "scope", "group", "app_id",
                  "proxies", "users_data", "solver", "target_client", "settings",
-                 "loop")
+                 "loop", "balance", "balance_counter", "cache", "cache_size",
+                 "inflight", "cache_hits", "cache_misses", "cache_coalesced")
 
     def __init__(self, settings, logger=None, loop=None):
         if logger:
@@ -32,6 +35,17 @@ class VkController:
 
         self.target_client = None
 
+        self.balance = settings.BALANCE_REQUESTS
+        self.balance_counter = 0
+
+        self.cache = OrderedDict()
+        self.cache_size = settings.REQUESTS_CACHE_SIZE
+        self.inflight = {}
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_coalesced = 0
+
         self.proxies = settings.PROXIES or []
 
         if not isinstance(settings.USERS, (list, tuple)) or not settings.USERS:
@@ -72,6 +86,8 @@ class VkController:
 
                 await client.group(user[1])
 
+                client.queue.set_rate(self.settings.GROUP_REQUESTS_PER_SECOND)
+
                 if self.target_client is None: self.target_client = Sender(group=True, target=i)
 
                 self.vk_groups.append(client)
@@ -86,6 +102,8 @@ class VkController:
                 else:
                     await client.user(user[1], user[2], self.app_id, self.scope)
 
+                client.queue.set_rate(self.settings.USER_REQUESTS_PER_SECOND)
+
                 if self.target_client is None: self.target_client = Sender(user=True, target=i)
 
                 self.vk_users.append(client)
@@ -128,6 +146,11 @@ class VkController:
             self.logger.error(f"No account to execute: \"{key}\"!")
             return {}
 
+        use_cache = data.pop("_cache", True) if data else True
+
+        if wait == "yes" and self.cache_size and key in CACHED_METHODS:
+            return await self.method_cached(client, key, data, sender, use_cache)
+
         task = await client.queue.enqueue(Request(key, data, sender))
 
         if wait == "no":
@@ -148,6 +171,80 @@ class VkController:
 
         return task
 
+    async def method_cached(self, client, key, data=None, sender=None, use_cache=True):
+        """Execute read-only vk method `key` with parameters `data`. Results
+        are cached for `CACHED_METHODS[key]` seconds and identical requests
+        are executed once. If `use_cache` is False, cached result is ignored
+        and replaced."""
+
+        ident = (key, client.user_id, client.group_id,
+            tuple(sorted((k, str(v)) for k, v in (data or {}).items())))
+
+        task = None
+
+        if use_cache:
+            cached = self.cache.get(ident)
+
+            if cached:
+                if cached[0] > time.time():
+                    self.cache_hits += 1
+                    self.cache.move_to_end(ident)
+
+                    return copy_data(cached[1])
+
+                del self.cache[ident]
+
+            task = self.inflight.get(ident)
+
+            if task:
+                self.cache_coalesced += 1
+
+        if task is None:
+            self.cache_misses += 1
+
+            task = await client.queue.enqueue(Request(key, data, sender))
+
+            self.inflight[ident] = task
+
+            task.add_done_callback(lambda t: self.cache_result(ident, t, CACHED_METHODS[key]))
+
+        try:
+            return copy_data(await asyncio.wait_for(asyncio.shield(task), 90))
+
+        except asyncio.CancelledError:
+            return {}
+
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+            return {}
+
+    def cache_result(self, ident, task, ttl):
+        if self.inflight.get(ident) is task:
+            del self.inflight[ident]
+
+        if task.cancelled() or task.exception() or not task.result():
+            return
+
+        self.cache[ident] = (time.time() + ttl, task.result())
+        self.cache.move_to_end(ident)
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    @property
+    def cache_stats(self):
+        requests = self.cache_hits + self.cache_misses + self.cache_coalesced
+
+        return {
+            "size": len(self.cache),
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "coalesced": self.cache_coalesced,
+            "hit_rate": (self.cache_hits + self.cache_coalesced) / requests if requests else 0,
+        }
+
     async def method_accumulative(self, key, stable_data=None, data=None, join_func=None,
                                   sender=None, wait="yes"):
         """Execute vk method `key` with static data `stable_data` and
@@ -222,24 +319,53 @@ class VkController:
             sender = self.get_default_sender(key)
 
         if self.vk_users and sender.user:
-            return self.vk_users[0 if sender.target is None else sender.target]
+            clients = self.vk_users
 
         elif self.vk_groups and sender.group:
-            return self.vk_groups[0 if sender.target is None else sender.target]
+            clients = self.vk_groups
+
+        else:
+            return None
+
+        if sender.target is not None:
+            return clients[sender.target]
+
+        if not self.balance:
+            return clients[0]
+
+        return self.get_least_loaded(key, clients)
+
+    def get_least_loaded(self, key, clients):
+        """Get least loaded client from `clients` that can execute method
+        `key`. Only clients of the same user or group as first client in
+        `clients` are used, because results of some methods (even available
+        without authorization) depend on caller."""
 
-        return None
+        eligible = [c for c in clients if c.user_id == clients[0].user_id and
+            c.group_id == clients[0].group_id]
+
+        if len(eligible) == 1:
+            return eligible[0]
+
+        self.balance_counter += 1
+
+        start = self.balance_counter % len(eligible)
+
+        return min(eligible[start:] + eligible[:start], key=lambda c: c.queue.load)
 
     def get_default_sender(self, key):
         """Get sender settings for method `key`"""
 
+        target = None if self.balance else 0
+
         if self.group and is_available_from_group(key):
-            sender = Sender(group=True, target=0)
+            sender = Sender(group=True, target=target)
 
         elif is_available_from_public(key):
-            sender = Sender(user=True, target=0)
+            sender = Sender(user=True, target=target)
 
         else:
-            sender = Sender(user=True, target=0)
+            sender = Sender(user=True, target=target)
 
         return sender
 
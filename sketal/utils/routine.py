@@ -1,6 +1,11 @@
 import datetime, string, random, html, json
 from dateutil.relativedelta import relativedelta
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def random_key(length=8, upper=False):
     return ''.join(
@@ -55,17 +60,15 @@ def age(date):
     return res.years
 
 
-def parse_msg_flags(bitmask, keys=('unread', 'outbox', 'replied', 'important', 'chat',
-        'friends', 'spam', 'deleted', 'fixed', 'media', 'hidden')):
+# Flags of messages from long poll (https://vk.com/dev/using_longpoll_2)
+MSG_FLAGS = {key: 1 << i for i, key in enumerate(('unread', 'outbox', 'replied',
+    'important', 'chat', 'friends', 'spam', 'deleted', 'fixed', 'media', 'hidden'))}
+
+
+def parse_msg_flags(bitmask, keys=tuple(MSG_FLAGS)):
     "Функция для чтения битовой маски и возврата словаря значений"
 
-    start = 1
-    values = []
-    for _ in range(1, 12):
-        result = bitmask & start
-        start *= 2
-        values.append(bool(result))
-    return dict(zip(keys, values))
+    return {key: bool(bitmask & MSG_FLAGS[key]) for key in keys}
 
 
 def unquote(data: (str, dict, list)):
@@ -90,9 +93,185 @@ def unquote(data: (str, dict, list)):
     return temp
 
 
+def copy_data(data):
+    """Returns copy of data made of dicts, lists and basic values (faster
+    than `copy.deepcopy`)"""
+
+    if isinstance(data, dict):
+        return {k: copy_data(v) for k, v in data.items()}
+
+    if isinstance(data, list):
+        return [copy_data(v) for v in data]
+
+    return data
+
+
+class IndexedList(list):
+    """List with index of items for fast `in` checks. Items must be
+    hashable. It's stored and copied as usual list."""
+
+    __slots__ = ("counts", "readonly")
+
+    def __init__(self, iterable=()):
+        super().__init__(iterable)
+
+        self.readonly = None
+
+        self.reindex()
+
+    def view(self):
+        """Returns read-only view of this list"""
+
+        if self.readonly is None:
+            self.readonly = ListView(self)
+
+        return self.readonly
+
+    def reindex(self):
+        self.counts = {}
+
+        for item in self:
+            self.counts[item] = self.counts.get(item, 0) + 1
+
+    def __reduce__(self):
+        return IndexedList, (list(self),)
+
+    def __contains__(self, item):
+        try:
+            return item in self.counts
+        except TypeError:
+            return False
+
+    def count(self, item):
+        return self.counts.get(item, 0)
+
+    def append(self, item):
+        super().append(item)
+
+        self.counts[item] = self.counts.get(item, 0) + 1
+
+    def extend(self, iterable):
+        for item in iterable:
+            self.append(item)
+
+    def __iadd__(self, iterable):
+        self.extend(iterable)
+
+        return self
+
+    def discard(self, item):
+        amount = self.counts.get(item, 0)
+
+        if amount > 1:
+            self.counts[item] = amount - 1
+        elif amount:
+            del self.counts[item]
+
+    def remove(self, item):
+        super().remove(item)
+
+        self.discard(item)
+
+    def pop(self, i=-1):
+        item = super().pop(i)
+
+        self.discard(item)
+
+        return item
+
+    def clear(self):
+        super().clear()
+
+        self.counts.clear()
+
+    def insert(self, i, item):
+        super().insert(i, item)
+
+        self.counts[item] = self.counts.get(item, 0) + 1
+
+    def __setitem__(self, i, value):
+        super().__setitem__(i, value)
+        self.reindex()
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self.reindex()
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self.reindex()
+
+        return self
+
+
+class ListView:
+    """Read-only view of list. Changes of list are visible through view.
+    View is equal to lists and tuples with the same items, but unlike tuple
+    it's not hashable (items can change)."""
+
+    __slots__ = ("items",)
+
+    __hash__ = None
+
+    def __init__(self, items):
+        self.items = items
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        return self.items[i]
+
+    def __eq__(self, other):
+        if isinstance(other, ListView):
+            other = other.items
+
+        elif not isinstance(other, (list, tuple)):
+            return NotImplemented
+
+        return tuple(self.items) == tuple(other)
+
+    def __repr__(self):
+        return f"ListView({list(self.items)!r})"
+
+
 def json_iter_parse(response_text):
     decoder = json.JSONDecoder(strict=False)
     idx = 0
     while idx < len(response_text):
         obj, idx = decoder.raw_decode(response_text, idx)
         yield obj
+
+
+def json_encode(data):
+    """Returns `data` in json as bytes. Uses `orjson` if it's installed."""
+
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+def json_decode(body):
+    """Returns list of json objects from `body` (bytes or str). Uses `orjson`
+    if it's installed. Concatenated objects are supported too."""
+
+    try:
+        if orjson:
+            return [orjson.loads(body)]
+
+        return [json.loads(body, strict=False)]
+
+    except ValueError:
+        pass
+
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+
+    return list(json_iter_parse(body))
@@ -0,0 +1,51 @@
+import aiohttp
+
+
+class HttpSessions:
+    """Shared `aiohttp` sessions for outgoing requests (uploads, plugins'
+    requests to other services). Sessions are created on first use and keep
+    connections alive, cache resolved hosts and limit amount of connections
+    (`limit` in total and `limit_per_host` for every host)."""
+
+    __slots__ = ("limit", "limit_per_host", "timeout", "dns_cache_ttl",
+                 "keepalive_timeout", "sessions")
+
+    def __init__(self, limit=100, limit_per_host=10, timeout=60, dns_cache_ttl=300,
+                 keepalive_timeout=30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+
+        self.sessions = {}
+
+    @property
+    def session(self):
+        """Default session"""
+
+        return self.get()
+
+    def get(self, name="default", **kwargs):
+        """Returns session `name`. Arguments `kwargs` are passed to
+        `aiohttp.ClientSession` when session is created."""
+
+        session = self.sessions.get(name)
+
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                limit_per_host=self.limit_per_host, ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout)
+
+            kwargs.setdefault("timeout", aiohttp.ClientTimeout(total=self.timeout))
+
+            session = self.sessions[name] = aiohttp.ClientSession(connector=connector,
+                **kwargs)
+
+        return session
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+
+        self.sessions.clear()
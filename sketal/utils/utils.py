@@ -1,5 +1,7 @@
 from enum import Enum
-import asyncio
+import asyncio, re, time
+
+from .routine import MSG_FLAGS
 
 
 class EventType(Enum):
@@ -40,12 +42,13 @@ class Proxy:
 
 
 class Request(asyncio.Future):
-    __slots__ = ("key", "data", "sender")
+    __slots__ = ("key", "data", "sender", "time")
 
     def __init__(self, key, data, sender=None):
         self.key = key
         self.data = data if data else {}
         self.sender = sender
+        self.time = time.time()
 
         super().__init__()
 
@@ -95,6 +98,93 @@ class RequestAccumulative(Request):
                 pass
 
 
+def parse_batch_ids(value):
+    """Returns list of numeric ids from `value` ("1,2,3" or 1) or None if
+    `value` contains something else."""
+
+    if isinstance(value, int) and not isinstance(value, bool):
+        return [value]
+
+    if not isinstance(value, str) or not value:
+        return None
+
+    ids = []
+
+    for part in value.split(","):
+        part = part.strip()
+
+        if not part.isdigit():
+            return None
+
+        ids.append(int(part))
+
+    return ids
+
+
+class RequestBatched(Request):
+    """Request that executes requests with the same method and parameters
+    (except ids in field `field`) as one request and returns every request
+    only it's own objects."""
+
+    __slots__ = ("field", "requests", "ids", "all_ids")
+
+    def __init__(self, request, field):
+        super().__init__(request.key, dict(request.data), request.sender)
+
+        self.field = field
+
+        self.requests = []
+        self.ids = []
+        self.all_ids = {}
+
+        self.add(request, parse_batch_ids(request.data[field]))
+
+    def add(self, request, ids, limit=None):
+        """Add request `request` for ids `ids` to batch. Returns False if
+        there would be more than `limit` ids in batch."""
+
+        new_ids = [i for i in dict.fromkeys(ids) if i not in self.all_ids]
+
+        if limit and len(self.all_ids) + len(new_ids) > limit:
+            return False
+
+        self.requests.append(request)
+        self.ids.append(ids)
+        self.all_ids.update(dict.fromkeys(new_ids))
+
+        self.data[self.field] = ",".join(str(i) for i in self.all_ids)
+
+        return True
+
+    def split_result(self, result):
+        """Returns pairs of requests and their parts of `result`"""
+
+        if isinstance(result, dict) and isinstance(result.get("items"), list):
+            items = result["items"]
+        elif isinstance(result, list):
+            items = result
+        else:
+            return [(request, {}) for request in self.requests]
+
+        objects = {}
+
+        for item in items:
+            if isinstance(item, dict):
+                objects[item.get("id")] = item
+
+        parts = []
+
+        for request, ids in zip(self.requests, self.ids):
+            part = [objects[i] for i in ids if i in objects]
+
+            if isinstance(result, dict):
+                part = {"count": len(part), "items": part}
+
+            parts.append((request, part))
+
+        return parts
+
+
 class Sender:
     __slots__ = ('target', 'user', 'group')
 
@@ -159,6 +249,12 @@ class Attachment(object):
         return self.value()
 
 
+MSG_OUTBOX = MSG_FLAGS['outbox']
+
+# Ids of forwarded messages and brackets in long poll's "fwd"
+FORWARDED_TOKENS = re.compile(r"[\d_-]+|:\(|\)")
+
+
 class MessageEventData(object):
     __slots__ = ("is_multichat", "user_id", "full_text", "full_message_data",
                  "time", "msg_id", "attaches", "is_out", "forwarded", "chat_id",
@@ -215,53 +311,70 @@ class MessageEventData(object):
         return tuple(result)
 
     @staticmethod
-    def parse_brief_forwarded_messages_from_lp(data):
-        result = []
+    def from_longpoll(update):
+        """Create data from message's update from long poll (https://vk.com/dev/using_longpoll_2)"""
 
-        token = ""
-        i = -1
-        while True:
-            i += 1
+        data = MessageEventData()
 
-            if i >= len(data):
-                if token:
-                    result.append((token, ()))
+        attaches = update[6]
 
-                break
+        data.msg_id = update[1]
+        data.attaches = attaches
+        data.time = int(update[4])
+        data.is_out = bool(update[2] & MSG_OUTBOX)
 
-            if data[i] in "1234567890_-":
-                token += data[i]
-                continue
+        if 'from' in attaches:
+            data.user_id = int(attaches.pop('from'))
+            data.chat_id = int(update[3]) - 2000000000
+            data.is_multichat = True
 
-            if data[i] in (",", ")"):
-                if not token:
-                    continue
+        else:
+            data.user_id = int(update[3])
 
-                result.append((token, ()))
-                token = ""
-                continue
+        data.full_text = update[5].replace('<br>', '\n')
 
-            if data[i] == ":":
-                stack = 1
+        if "fwd" in attaches:
+            data.forwarded = MessageEventData.\
+                parse_brief_forwarded_messages_from_lp(attaches.pop("fwd"))
 
-                for j in range(i + 2, len(data)):
-                    if data[j] == "(":
-                        stack += 1
+        else:
+            data.forwarded = []
+
+        return data
 
-                    elif data[j] == ")":
-                        stack -= 1
+    @staticmethod
+    def parse_brief_forwarded_messages_from_lp(data):
+        """Parse forwarded messages from long poll ("id,id:(id,id:(id))") in
+        one pass. Returns tuple of pairs (id, forwarded messages)."""
 
-                    if stack == 0:
-                        jump_to_i = j
-                        break
+        result = []
+        stack = []
 
-                sub_data = data[i + 2: jump_to_i]
+        for token in FORWARDED_TOKENS.findall(data):
+            if token == ":(":
+                if not result:
+                    continue
 
-                result.append((token, MessageEventData.parse_brief_forwarded_messages_from_lp(sub_data)))
+                stack.append(result)
+                result = []
 
-                i = jump_to_i + 1
-                token = ""
-                continue
+            elif token == ")":
+                if not stack:
+                    continue
+
+                forwarded = tuple(result)
+                result = stack.pop()
+
+                result[-1] = (result[-1][0], forwarded)
+
+            else:
+                result.append((token, ()))
+
+        while stack:
+            forwarded = tuple(result)
+            result = stack.pop()
+
+            result[-1] = (result[-1][0], forwarded)
 
         return tuple(result)
 